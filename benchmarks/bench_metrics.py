@@ -0,0 +1,93 @@
+"""
+指标记录的热路径开销基准测试
+
+分别测量每次调用的平均耗时（纳秒），减去空循环的基线：
+
+- counter:  Counter.inc
+- histogram: Histogram.observe
+- request:  一次非流式请求的全部记录（状态码计数 + 延迟直方图 + usage 统计）
+- usage:    其中从原始响应字节读取 usage 的部分
+- chunk:    流式转发每个分块的记录（分块间隔直方图 + UsageReader 查找 usage）
+- render:   导出一次 /metrics 文本（不在热路径上，仅供参考）
+
+运行：python -m benchmarks.bench_metrics [--iterations 1000000]
+"""
+import argparse
+import time
+
+from src.services.metrics import ServiceMetrics, UsageReader
+from src.services.openai_service import OpenAIService
+from src.utils.metrics import Counter, Histogram, render_metrics
+
+INSTANCES = [{"name": f"bench{i}", "url": f"https://bench{i}.openai.azure.com", "api_key": "bench"} for i in range(4)]
+CHUNK = b'data: {"id":"chatcmpl-1","object":"chat.completion.chunk","choices":[{"index":0,"delta":{"content":"tok "}}]}\n\n'
+RESULT = b'{"choices": [], "usage": {"prompt_tokens": 120, "completion_tokens": 40, "total_tokens": 160}}'
+
+
+def per_call_ns(fn, iterations: int) -> float:
+    start = time.perf_counter_ns()
+    fn(iterations)
+    return (time.perf_counter_ns() - start) / iterations
+
+
+def main(iterations: int):
+    service = OpenAIService([dict(i) for i in INSTANCES])
+    metrics: ServiceMetrics = service.metrics
+    labels = ("bench1", "gpt-4o")
+    counter = Counter("bench_total", "Bench", ("instance", "deployment"))
+    histogram = Histogram("bench_seconds", "Bench", ("instance", "deployment"))
+
+    def baseline(n):
+        for i in range(n):
+            pass
+
+    def count(n):
+        inc = counter.inc
+        for i in range(n):
+            inc(labels)
+
+    def observe(n):
+        record = histogram.observe
+        for i in range(n):
+            record(labels, 0.3)
+
+    def request(n):
+        for i in range(n):
+            metrics.observe_response(labels, 200, 0.42)
+            metrics.observe_usage(labels, RESULT)
+
+    def usage(n):
+        for i in range(n):
+            metrics.observe_usage(labels, RESULT)
+
+    def chunk(n):
+        gap = metrics.chunk_gap.observe
+        reader = UsageReader()
+        previous = time.perf_counter()
+        for i in range(n):
+            now = time.perf_counter()
+            gap(labels, now - previous)
+            previous = now
+            if not reader.done:
+                usage = reader.feed(CHUNK)
+                if usage is not None:
+                    metrics.observe_tokens(labels, usage)
+
+    base = per_call_ns(baseline, iterations)
+    results = {}
+    for name, fn in (("counter", count), ("histogram", observe), ("request", request), ("usage", usage), ("chunk", chunk)):
+        results[name] = per_call_ns(fn, iterations) - base
+        print(f"{name:<10} {results[name]:8.1f} ns/call")
+
+    collectors = metrics.collectors()
+    start = time.perf_counter()
+    text = render_metrics(collectors)
+    print(f"{'render':<10} {(time.perf_counter() - start) * 1000:8.2f} ms ({len(text.splitlines())} lines)")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=1000000)
+    args = parser.parse_args()
+    main(args.iterations)
@@ -0,0 +1,123 @@
+"""
+流式转发的单块附加延迟基准测试
+
+用 httpx.MockTransport 模拟上游 SSE 流，每个分块在产生时记录时间戳，
+比较三种消费方式收到同一分块的时间差：
+
+- direct: 直接从上游读取（基线）
+- relay:  经过 OpenAIService.forward_streaming_request 的字节级转发
+- legacy: 旧实现（每次新建客户端 + aiter_lines + re.sub）
+
+运行：python -m benchmarks.bench_stream_relay [--chunks 2000] [--rounds 5]
+"""
+import argparse
+import asyncio
+import json
+import re
+import statistics
+import time
+
+import httpx
+
+from src.services.openai_service import OpenAIService
+
+INSTANCES = [{"name": "bench", "url": "https://bench.openai.azure.com", "api_key": "bench"}]
+PATH = "openai/deployments/gpt-4o/chat/completions?api-version=2025-01-01-preview"
+BODY = b'{"messages":[{"role":"user","content":"hi"}],"stream":true}'
+
+
+class SSEStream(httpx.AsyncByteStream):
+    def __init__(self, chunks: int, emitted: list):
+        self.chunks = chunks
+        self.emitted = emitted
+
+    async def __aiter__(self):
+        for i in range(self.chunks):
+            payload = {"id": f"chatcmpl-{i}", "object": "chat.completion.chunk",
+                       "choices": [{"index": 0, "delta": {"content": f"tok{i} "}}]}
+            self.emitted.append(time.perf_counter_ns())
+            yield b"data: " + json.dumps(payload).encode() + b"\n\n"
+            # 让出事件循环，模拟逐个到达的 token
+            await asyncio.sleep(0)
+        self.emitted.append(time.perf_counter_ns())
+        yield b"data: [DONE]\n\n"
+
+
+def make_transport(chunks: int, emitted: list) -> httpx.MockTransport:
+    def handler(request: httpx.Request):
+        return httpx.Response(200, headers={"content-type": "text/event-stream"},
+                              stream=SSEStream(chunks, emitted))
+    return httpx.MockTransport(handler)
+
+
+async def run_direct(chunks: int):
+    emitted, received = [], []
+    async with httpx.AsyncClient(transport=make_transport(chunks, emitted)) as client:
+        cpu_start = time.process_time()
+        async with client.stream("POST", f"{INSTANCES[0]['url']}/{PATH}", content=BODY) as response:
+            async for _ in response.aiter_raw():
+                received.append(time.perf_counter_ns())
+        cpu = time.process_time() - cpu_start
+    return emitted, received, cpu
+
+
+async def run_relay(chunks: int):
+    emitted, received = [], []
+    service = OpenAIService([dict(i) for i in INSTANCES])
+    await service.client.aclose()
+    service.client = httpx.AsyncClient(transport=make_transport(chunks, emitted))
+    cpu_start = time.process_time()
+    response = await service.forward_streaming_request("POST", PATH, BODY, {"content-type": "application/json"})
+    async for _ in response.body_iterator:
+        received.append(time.perf_counter_ns())
+    cpu = time.process_time() - cpu_start
+    await service.close()
+    return emitted, received, cpu
+
+
+async def run_legacy(chunks: int):
+    emitted, received = [], []
+    transport = make_transport(chunks, emitted)
+    cpu_start = time.process_time()
+    # 旧实现每次请求都新建客户端，因此客户端创建也计入开销
+    async with httpx.AsyncClient(timeout=600.0, transport=transport) as client:
+        async with client.stream("POST", f"{INSTANCES[0]['url']}/{PATH}", content=BODY) as response:
+            async for line in response.aiter_lines():
+                if line.strip():
+                    line = re.sub(r'^data: ', '', line)
+                    if line != "[DONE]":
+                        received.append(time.perf_counter_ns())
+    # 旧实现丢弃了 [DONE]，用最后一个分块的时间补齐以便对齐
+    received.append(received[-1])
+    return emitted, received, time.process_time() - cpu_start
+
+
+def summarize(name: str, samples: list, cpu_seconds: float, chunks: int):
+    samples.sort()
+    p50 = samples[len(samples) // 2] / 1000
+    p99 = samples[int(len(samples) * 0.99)] / 1000
+    print(f"{name:<8} p50={p50:8.2f}us  p99={p99:8.2f}us  mean={statistics.mean(samples) / 1000:8.2f}us  "
+          f"cpu/chunk={cpu_seconds / chunks * 1e6:6.2f}us")
+    return {"p50_us": p50, "p99_us": p99, "cpu_per_chunk_us": cpu_seconds / chunks * 1e6}
+
+
+async def main(chunks: int, rounds: int):
+    results = {}
+    for name, runner in (("direct", run_direct), ("relay", run_relay), ("legacy", run_legacy)):
+        samples, cpu_total = [], 0.0
+        for _ in range(rounds):
+            emitted, received, cpu = await runner(chunks)
+            cpu_total += cpu
+            samples.extend(r - e for e, r in zip(emitted, received))
+        results[name] = summarize(name, samples, cpu_total, chunks * rounds)
+    added = results["relay"]["p50_us"] - results["direct"]["p50_us"]
+    print(f"proxy added latency per chunk (p50): {added:.2f}us")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args.chunks, args.rounds))
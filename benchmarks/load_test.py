@@ -0,0 +1,335 @@
+"""
+代理的端到端压测
+
+启动本地模拟 Azure 后端（benchmarks.mock_azure，一个进程模拟多个实例）和真实的
+src.main:app（uvicorn 子进程），先把同一批请求直接发给模拟后端作为基线，
+再经过代理发送，报告：
+
+- 吞吐量（请求/秒）和错误率
+- 代理附加的延迟 p50/p95/p99（非流式为完整响应时间，流式为首字时间）
+- 故障转移率（来自代理 /metrics 的 lb_failovers_total）
+- 每个并发连接占用的内存（代理进程 RSS 峰值减去空闲值，仅 Linux）
+
+结果可保存为 JSON，并与之前保存的结果对比。--replay 可以重放 JSONL 格式的请求记录：
+每行的 path/method/headers 可选，body 为 JSON 对象或字符串（非 JSON 字符串作为用户消息发送）。
+
+运行：python -m benchmarks.load_test --instances 3 --concurrency 32 --requests 2000 --stream-ratio 0.5 \\
+          --latency lognormal:100,0.3 --rate-429 0.02 --output results.json --compare baseline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from benchmarks.mock_azure import add_profile_arguments
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHAT_PATH = "openai/deployments/gpt-4o/chat/completions?api-version=2024-10-21"
+PROMPTS = ["Summarize the plot of Hamlet.", "Write a haiku about load balancers.",
+           "Explain TCP slow start in two sentences.", "List three prime numbers above 100."]
+
+
+class Workload:
+    """一个请求：相对路径、方法、请求体和是否流式"""
+
+    __slots__ = ("method", "path", "body", "headers", "stream")
+
+    def __init__(self, method: str, path: str, body: bytes, headers: Dict[str, str], stream: bool):
+        self.method = method
+        self.path = path
+        self.body = body
+        self.headers = headers
+        self.stream = stream
+
+
+def synthetic_workload(count: int, stream_ratio: float, rng: random.Random) -> List[Workload]:
+    workload = []
+    for i in range(count):
+        stream = rng.random() < stream_ratio
+        body = {"messages": [{"role": "user", "content": f"{rng.choice(PROMPTS)} #{i}"}], "max_tokens": 64}
+        if stream:
+            body["stream"] = True
+        workload.append(Workload("POST", CHAT_PATH, json.dumps(body).encode(), {}, stream))
+    return workload
+
+
+def replay_workload(path: str, count: Optional[int], stream_ratio: float, rng: random.Random) -> List[Workload]:
+    """读取 JSONL 请求记录；不足 count 条时循环使用"""
+    entries = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            body = record.get("body", record)
+            if isinstance(body, str):
+                try:
+                    body = json.loads(body)
+                except ValueError:
+                    body = {"messages": [{"role": "user", "content": body}], "max_tokens": 64}
+            if not isinstance(body, dict):
+                continue
+            if "stream" not in body and rng.random() < stream_ratio:
+                body["stream"] = True
+            entries.append(Workload(
+                record.get("method", "POST"),
+                record.get("path", CHAT_PATH).lstrip("/"),
+                json.dumps(body).encode(),
+                record.get("headers", {}),
+                bool(body.get("stream")),
+            ))
+    if not entries:
+        raise SystemExit(f"No requests found in {path}")
+    count = count or len(entries)
+    return [entries[i % len(entries)] for i in range(count)]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def rss_bytes(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+async def wait_ready(url: str, process: subprocess.Popen, timeout: float = 20.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise SystemExit(f"Process exited early with code {process.returncode}: {url}")
+            try:
+                await client.get(url, timeout=1.0)
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.1)
+    raise SystemExit(f"Timed out waiting for {url}")
+
+
+def percentile(samples: List[float], q: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+def summarize(samples: List[float]) -> Dict[str, Optional[float]]:
+    return {f"p{int(q * 100)}_ms": (None if percentile(samples, q) is None else round(percentile(samples, q) * 1000, 3))
+            for q in (0.5, 0.95, 0.99)}
+
+
+async def run_phase(base_urls: List[str], workload: List[Workload], concurrency: int,
+                    on_tick=None) -> Dict[str, Any]:
+    """按固定并发发送整批请求，base_urls 轮流使用"""
+    latencies, ttfts, statuses = [], [], {}
+    queue: asyncio.Queue = asyncio.Queue()
+    for i, item in enumerate(workload):
+        queue.put_nowait((base_urls[i % len(base_urls)], item))
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=120.0) as client:
+        async def worker():
+            while not queue.empty():
+                base_url, item = queue.get_nowait()
+                headers = {"content-type": "application/json", **item.headers}
+                started = time.perf_counter()
+                try:
+                    async with client.stream(item.method, f"{base_url}/{item.path}", content=item.body,
+                                             headers=headers) as response:
+                        first = None
+                        async for _ in response.aiter_raw():
+                            if first is None:
+                                first = time.perf_counter()
+                        status = response.status_code
+                except httpx.HTTPError:
+                    status = "error"
+                    first = None
+                elapsed = time.perf_counter() - started
+                statuses[status] = statuses.get(status, 0) + 1
+                if status == 200:
+                    if item.stream:
+                        ttfts.append((first or time.perf_counter()) - started)
+                    else:
+                        latencies.append(elapsed)
+
+        async def ticker():
+            while True:
+                on_tick()
+                await asyncio.sleep(0.1)
+
+        tick_task = asyncio.ensure_future(ticker()) if on_tick else None
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        duration = time.perf_counter() - started
+        if tick_task:
+            tick_task.cancel()
+
+    ok = statuses.get(200, 0)
+    return {
+        "requests": len(workload),
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(len(workload) / duration, 2) if duration else None,
+        "error_rate": round(1 - ok / len(workload), 4) if workload else 0.0,
+        "statuses": {str(k): v for k, v in statuses.items()},
+        "latency": summarize(latencies),
+        "ttft": summarize(ttfts),
+        "_latencies": latencies,
+        "_ttfts": ttfts,
+    }
+
+
+def overhead(direct: Dict[str, Any], proxied: Dict[str, Any], key: str) -> Dict[str, Optional[float]]:
+    result = {}
+    for name in ("p50_ms", "p95_ms", "p99_ms"):
+        a, b = direct[key][name], proxied[key][name]
+        result[name] = None if a is None or b is None else round(b - a, 3)
+    return result
+
+
+def scrape_failovers(metrics_text: str) -> float:
+    return sum(float(m.group(1)) for m in re.finditer(r"^lb_failovers_total\{[^}]*\} (\S+)$", metrics_text, re.M))
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]):
+    """打印与基线结果的差异，正数表示变慢或变差"""
+    rows = [("throughput_rps", ("proxy", "throughput_rps")), ("failover_rate", ("failover_rate",)),
+            ("memory_per_connection_bytes", ("memory_per_connection_bytes",))]
+    for group in ("latency_overhead", "ttft_overhead"):
+        for name in ("p50_ms", "p95_ms", "p99_ms"):
+            rows.append((f"{group}.{name}", (group, name)))
+    print("\ncompared with baseline:")
+    for label, path in rows:
+        old, new = baseline, current
+        for key in path:
+            old = old.get(key) if isinstance(old, dict) else None
+            new = new.get(key) if isinstance(new, dict) else None
+        if isinstance(old, (int, float)) and isinstance(new, (int, float)):
+            change = f"{(new - old) / abs(old) * 100:+.1f}%" if old else "n/a"
+            print(f"  {label:<34} {old:>12} -> {new:>12}  ({change})")
+
+
+async def main(args: argparse.Namespace) -> Dict[str, Any]:
+    rng = random.Random(args.seed)
+    if args.replay:
+        workload = replay_workload(args.replay, args.requests, args.stream_ratio, rng)
+    else:
+        workload = synthetic_workload(args.requests or 1000, args.stream_ratio, rng)
+
+    mock_port, proxy_port = free_port(), free_port()
+    names = [f"i{i}" for i in range(args.instances)]
+    mock_url = f"http://127.0.0.1:{mock_port}"
+    instances = [{"name": name, "url": f"{mock_url}/{name}", "api_key": "mock-key"} for name in names]
+
+    mock_cmd = [sys.executable, "-m", "benchmarks.mock_azure", "--port", str(mock_port),
+                "--latency", args.latency, "--tokens", str(args.tokens),
+                "--tokens-per-second", str(args.tokens_per_second), "--rate-429", str(args.rate_429),
+                "--retry-after", str(args.retry_after), "--rate-5xx", str(args.rate_5xx),
+                "--slow-first-byte", str(args.slow_first_byte), "--slow-first-byte-ms", str(args.slow_first_byte_ms)]
+    if args.profiles:
+        mock_cmd += ["--profiles", args.profiles]
+    if args.seed is not None:
+        mock_cmd += ["--seed", str(args.seed)]
+
+    proxy_env = {**os.environ, "OPENAI_INSTANCES": json.dumps({"instances": instances}), "API_KEY": "",
+                 "LOG_FILE": os.devnull}
+    for item in args.proxy_env:
+        key, _, value = item.partition("=")
+        proxy_env[key] = value
+    proxy_cmd = [sys.executable, "-m", "uvicorn", "src.main:app", "--host", "127.0.0.1",
+                 "--port", str(proxy_port), "--log-level", "warning", "--no-access-log"]
+
+    mock = subprocess.Popen(mock_cmd, cwd=ROOT)
+    proxy = subprocess.Popen(proxy_cmd, env=proxy_env, cwd=ROOT)
+    try:
+        await wait_ready(f"{mock_url}/_mock/stats", mock)
+        proxy_url = f"http://127.0.0.1:{proxy_port}"
+        await wait_ready(f"{proxy_url}/health", proxy)
+
+        print(f"direct: {len(workload)} requests, concurrency {args.concurrency}, {len(names)} instances")
+        direct = await run_phase([f"{mock_url}/{name}" for name in names], workload, args.concurrency)
+
+        idle_rss = rss_bytes(proxy.pid)
+        peak = {"rss": idle_rss}
+
+        def sample_rss():
+            rss = rss_bytes(proxy.pid)
+            if rss is not None and (peak["rss"] is None or rss > peak["rss"]):
+                peak["rss"] = rss
+
+        print("proxy: same workload through src.main:app")
+        proxied = await run_phase([proxy_url], workload, args.concurrency, on_tick=sample_rss)
+
+        async with httpx.AsyncClient() as client:
+            metrics_text = (await client.get(f"{proxy_url}/metrics")).text
+    finally:
+        for process in (proxy, mock):
+            process.terminate()
+        for process in (proxy, mock):
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    for phase in (direct, proxied):
+        phase.pop("_latencies")
+        phase.pop("_ttfts")
+    memory_per_connection = None
+    if idle_rss is not None and peak["rss"] is not None:
+        memory_per_connection = max(peak["rss"] - idle_rss, 0) // args.concurrency
+    results = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "direct": direct,
+        "proxy": proxied,
+        "latency_overhead": overhead(direct, proxied, "latency"),
+        "ttft_overhead": overhead(direct, proxied, "ttft"),
+        "failover_rate": round(scrape_failovers(metrics_text) / len(workload), 4),
+        "memory_per_connection_bytes": memory_per_connection,
+    }
+
+    print(json.dumps({k: results[k] for k in ("latency_overhead", "ttft_overhead", "failover_rate",
+                                              "memory_per_connection_bytes")}, indent=2))
+    print(f"throughput: direct {direct['throughput_rps']} rps, proxy {proxied['throughput_rps']} rps; "
+          f"proxy error rate {proxied['error_rate']}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"results saved to {args.output}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(results, json.load(f))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--instances", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, help="number of requests (default 1000, or the replay file length)")
+    parser.add_argument("--stream-ratio", type=float, default=0.5)
+    parser.add_argument("--replay", help="JSONL file of captured requests to replay")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--proxy-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra environment for the proxy, e.g. LOAD_BALANCING_STRATEGY=least_in_flight")
+    parser.add_argument("--output", help="save results as JSON")
+    parser.add_argument("--compare", help="compare with a previously saved results JSON")
+    add_profile_arguments(parser)
+    asyncio.run(main(parser.parse_args()))
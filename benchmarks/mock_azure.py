@@ -0,0 +1,199 @@
+"""
+本地模拟的 Azure OpenAI 后端
+
+一个服务器模拟多个实例：实例 URL 为 http://host:port/<实例名>，
+收到的路径形如 /<实例名>/openai/deployments/<deployment>/chat/completions。
+每个实例可以配置不同的故障画像：
+
+- 延迟分布：fixed:200 / uniform:100,400 / lognormal:200,0.5（中位数毫秒, sigma）
+- 流式响应的 token 数和每秒 token 速率
+- 按概率注入 429（带 Retry-After）、5xx 和首字节慢响应
+
+运行：python -m benchmarks.mock_azure --port 9100 --latency lognormal:200,0.5 --rate-429 0.05
+      python -m benchmarks.mock_azure --profiles profiles.json
+profiles.json 形如 {"default": {"latency": "fixed:50"}, "i0": {"rate_5xx": 0.5}}
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+from typing import Any, Dict, Optional
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+
+class LatencyModel:
+    """按规格字符串生成延迟样本（秒）"""
+
+    def __init__(self, spec: str = "fixed:0"):
+        kind, _, args = spec.partition(":")
+        values = [float(v) for v in args.split(",") if v] or [0.0]
+        if kind not in ("fixed", "uniform", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {spec}")
+        self.spec = spec
+        self.kind = kind
+        self.values = values
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "fixed":
+            return self.values[0] / 1000
+        if self.kind == "uniform":
+            low, high = self.values[0], self.values[-1]
+            return rng.uniform(low, high) / 1000
+        median, sigma = self.values[0], (self.values[1] if len(self.values) > 1 else 0.5)
+        return rng.lognormvariate(math.log(max(median, 1e-3)), sigma) / 1000
+
+
+class MockProfile:
+    """一个模拟实例的行为"""
+
+    def __init__(self, latency: str = "fixed:50", tokens: int = 50, tokens_per_second: float = 100.0,
+                 rate_429: float = 0.0, retry_after: float = 1.0, rate_5xx: float = 0.0,
+                 slow_first_byte: float = 0.0, slow_first_byte_ms: float = 5000.0):
+        self.latency = LatencyModel(latency)
+        self.tokens = tokens
+        self.tokens_per_second = tokens_per_second
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.rate_5xx = rate_5xx
+        self.slow_first_byte = slow_first_byte
+        self.slow_first_byte_ms = slow_first_byte_ms
+
+    @classmethod
+    def from_dict(cls, options: Dict[str, Any]) -> "MockProfile":
+        return cls(**options)
+
+
+def _chunk(index: int, content: Optional[str], finish: Optional[str] = None) -> bytes:
+    delta = {"content": content} if content is not None else {}
+    payload = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "model": "mock",
+               "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]}
+    return b"data: " + json.dumps(payload, separators=(",", ":")).encode() + b"\n\n"
+
+
+def create_app(profiles: Optional[Dict[str, MockProfile]] = None, default: Optional[MockProfile] = None,
+               seed: Optional[int] = None) -> Starlette:
+    """创建模拟服务器；profiles 按实例名覆盖 default"""
+    profiles = profiles or {}
+    default = default or MockProfile()
+    rng = random.Random(seed)
+    counters: Dict[str, int] = {}
+
+    async def handle(request: Request):
+        instance = request.path_params["instance"]
+        profile = profiles.get(instance, default)
+        counters[instance] = counters.get(instance, 0) + 1
+        body = await request.body()
+        try:
+            payload = json.loads(body) if body else {}
+        except ValueError:
+            payload = {}
+        headers = {"x-ratelimit-remaining-requests": "1000", "x-ratelimit-remaining-tokens": "1000000",
+                   "x-mock-instance": instance}
+
+        roll = rng.random()
+        if roll < profile.rate_429:
+            headers["retry-after"] = str(max(int(math.ceil(profile.retry_after)), 1))
+            headers["retry-after-ms"] = str(int(profile.retry_after * 1000))
+            return JSONResponse({"error": {"code": "429", "message": "Rate limit is exceeded."}},
+                                status_code=429, headers=headers)
+        if roll < profile.rate_429 + profile.rate_5xx:
+            return JSONResponse({"error": {"code": "InternalServerError", "message": "Injected failure"}},
+                                status_code=500, headers=headers)
+
+        delay = profile.latency.sample(rng)
+        if rng.random() < profile.slow_first_byte:
+            delay += profile.slow_first_byte_ms / 1000
+        prompt_tokens = max(len(body) // 4, 1)
+
+        if "embeddings" in request.url.path:
+            await asyncio.sleep(delay)
+            inputs = payload.get("input", "")
+            inputs = inputs if isinstance(inputs, list) else [inputs]
+            data = [{"object": "embedding", "index": i, "embedding": [0.0] * 8} for i in range(len(inputs))]
+            return JSONResponse({"object": "list", "data": data, "model": "mock",
+                                 "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens}},
+                                headers=headers)
+
+        if payload.get("stream"):
+            interval = 1.0 / profile.tokens_per_second if profile.tokens_per_second > 0 else 0.0
+
+            async def events():
+                await asyncio.sleep(delay)
+                yield _chunk(0, "")
+                for i in range(profile.tokens):
+                    if interval:
+                        await asyncio.sleep(interval)
+                    yield _chunk(i + 1, "tok ")
+                yield _chunk(profile.tokens + 1, None, "stop")
+                yield b"data: [DONE]\n\n"
+
+            return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
+
+        await asyncio.sleep(delay + (profile.tokens / profile.tokens_per_second if profile.tokens_per_second > 0 else 0))
+        return JSONResponse({
+            "id": "chatcmpl-mock", "object": "chat.completion", "created": int(time.time()), "model": "mock",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "tok " * profile.tokens},
+                         "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": profile.tokens,
+                      "total_tokens": prompt_tokens + profile.tokens},
+        }, headers=headers)
+
+    async def stats(request: Request):
+        return JSONResponse(counters)
+
+    app = Starlette(routes=[
+        Route("/_mock/stats", stats),
+        Route("/{instance}/{path:path}", handle, methods=["GET", "POST"]),
+    ])
+    app.state.counters = counters
+    return app
+
+
+def load_profiles(path: Optional[str], default_options: Dict[str, Any]):
+    """读取 profiles.json；default 中的字段覆盖命令行参数"""
+    overrides: Dict[str, Any] = {}
+    if path:
+        with open(path, encoding="utf-8") as f:
+            overrides = json.load(f)
+    default = MockProfile.from_dict({**default_options, **overrides.pop("default", {})})
+    profiles = {name: MockProfile.from_dict({**default_options, **options}) for name, options in overrides.items()}
+    return profiles, default
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency", default="fixed:50", help="fixed:MS, uniform:LOW,HIGH or lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--tokens", type=int, default=50, help="completion tokens per response")
+    parser.add_argument("--tokens-per-second", type=float, default=100.0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--rate-5xx", type=float, default=0.0)
+    parser.add_argument("--slow-first-byte", type=float, default=0.0, help="probability of a slow first byte")
+    parser.add_argument("--slow-first-byte-ms", type=float, default=5000.0)
+    parser.add_argument("--profiles", help="JSON file with per-instance overrides")
+
+
+def profile_options(args: argparse.Namespace) -> Dict[str, Any]:
+    return {
+        "latency": args.latency, "tokens": args.tokens, "tokens_per_second": args.tokens_per_second,
+        "rate_429": args.rate_429, "retry_after": args.retry_after, "rate_5xx": args.rate_5xx,
+        "slow_first_byte": args.slow_first_byte, "slow_first_byte_ms": args.slow_first_byte_ms,
+    }
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--seed", type=int)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    profiles, default = load_profiles(args.profiles, profile_options(args))
+    uvicorn.run(create_app(profiles, default, args.seed), host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,324 @@
+"""
+离线批量运行器
+
+    python -m src.batch input.jsonl output.jsonl [--concurrency 16] [--deployment gpt-4o]
+
+输入为 Azure OpenAI Batch API 格式的 JSONL，每行一个请求：
+    {"custom_id": "task-1", "method": "POST", "url": "/chat/completions", "body": {"model": "gpt-4o", ...}}
+url 为 /chat/completions、/embeddings 等时，deployment 取 body.model（或 --deployment），
+也可以直接写完整路径 /openai/deployments/<name>/...?api-version=...
+
+请求通过 OpenAIService 在所有实例之间转发（负载均衡、重试、熔断和限流额度与代理相同），
+结果按完成顺序逐行写入输出文件，格式与 Batch API 的输出相同：
+    {"custom_id": "task-1", "response": {"status_code": 200, "request_id": "...", "body": {...}}, "error": null}
+
+输入按行流式读取，同时处理的行数有上限，内存占用与输入文件大小无关。
+进度定期写入检查点文件（默认为 output.jsonl.checkpoint），崩溃后用相同参数重新运行即可从检查点继续：
+输出文件被截断到检查点记录的长度，已完成的行不会重复执行，也不会重复写出。
+输出文件已有内容但没有检查点时拒绝运行（不知道其中哪些行已经完成），除非指定 --overwrite。
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, Optional, Set
+
+from fastapi import HTTPException
+
+from src.config.settings import settings
+from src.services.openai_service import OpenAIService
+from src.services.upstream_response import UpstreamResponse
+from src.utils import fast_json
+from src.utils.access_log import access_log
+
+DEFAULT_API_VERSION = "2024-10-21"
+
+# 这些状态表示暂时没有容量（本地限流额度不足、所有实例冷却中或上游限流），稍后重试而不是写出错误
+_THROTTLED_STATUS = (429, 503)
+
+
+class Checkpoint:
+    """
+    批量任务的进度
+
+    watermark 之前的输入行全部完成，之后已完成的行记录在 done 中；由于读取进度最多领先
+    watermark 一个窗口，done 的大小有上限。output_size 是保存检查点时输出文件的长度。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.watermark = 0
+        self.done: Set[int] = set()
+        self.output_size = 0
+
+    @classmethod
+    def load(cls, path: str) -> "Checkpoint":
+        checkpoint = cls(path)
+        try:
+            with open(path, "rb") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return checkpoint
+        checkpoint.watermark = int(data["watermark"])
+        checkpoint.done = set(data.get("done", ()))
+        checkpoint.output_size = int(data["output_size"])
+        return checkpoint
+
+    def is_done(self, line_no: int) -> bool:
+        return line_no < self.watermark or line_no in self.done
+
+    def mark(self, line_no: int):
+        self.done.add(line_no)
+        while self.watermark in self.done:
+            self.done.discard(self.watermark)
+            self.watermark += 1
+
+    def save(self, output_size: int):
+        """先写临时文件再替换，崩溃时检查点要么是旧的要么是新的"""
+        self.output_size = output_size
+        data = {"watermark": self.watermark, "done": sorted(self.done), "output_size": output_size}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(fast_json.dumps(data))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+def request_path(entry: Dict[str, Any], deployment: Optional[str], api_version: str) -> str:
+    """把一行请求的 url 转换为转发路径；缺少 deployment 时抛出 ValueError"""
+    url = str(entry.get("url") or "/chat/completions").lstrip("/")
+    if url.startswith("openai/"):
+        return url
+    body = entry.get("body")
+    name = (body.get("model") if isinstance(body, dict) else None) or deployment
+    if not name:
+        raise ValueError("request has no deployment: set body.model or --deployment")
+    path = f"openai/deployments/{name}/{url}"
+    if "api-version=" not in path:
+        path += ("&" if "?" in path else "?") + f"api-version={api_version}"
+    return path
+
+
+class BatchRunner:
+    """
+    把 JSONL 输入中的请求并发地交给 OpenAIService，结果逐行写入输出文件
+
+    最多 concurrency 个请求同时进行，读取进度最多领先最早未完成的行 window 行。
+    任一请求因限流（429/503）失败时，所有 worker 暂停到 Retry-After 之后再发送，
+    该请求重新排队，最多尝试 max_attempts 次。
+
+    输出文件非空而检查点不存在时 run 抛出 FileExistsError，不截断已有的结果；overwrite 为 True 时从头开始。
+    """
+
+    def __init__(self, service: OpenAIService, input_path: str, output_path: str,
+                 checkpoint_path: Optional[str] = None, concurrency: int = 16, window: Optional[int] = None,
+                 deployment: Optional[str] = None, api_version: str = DEFAULT_API_VERSION,
+                 max_attempts: int = 10, checkpoint_interval: float = 1.0, overwrite: bool = False):
+        self.service = service
+        self.input_path = input_path
+        self.output_path = output_path
+        self.checkpoint_path = checkpoint_path or output_path + ".checkpoint"
+        self.concurrency = max(concurrency, 1)
+        self.window = max(window or self.concurrency * 4, self.concurrency)
+        self.deployment = deployment
+        self.api_version = api_version
+        self.max_attempts = max(max_attempts, 1)
+        self.checkpoint_interval = checkpoint_interval
+        self.overwrite = overwrite
+        self.paused_until = 0.0
+        self.counts = {"succeeded": 0, "failed": 0, "skipped": 0}
+        self._checkpoint: Optional[Checkpoint] = None
+        self._output = None
+        self._progress = asyncio.Event()
+        self._last_save = 0.0
+
+    async def run(self) -> Dict[str, int]:
+        if (not self.overwrite and not os.path.exists(self.checkpoint_path)
+                and os.path.exists(self.output_path) and os.path.getsize(self.output_path) > 0):
+            raise FileExistsError(f"{self.output_path} already has results but no checkpoint "
+                                  f"({self.checkpoint_path}); use --overwrite to start over")
+        checkpoint = self._checkpoint = Checkpoint.load(self.checkpoint_path)
+        mode = "r+b" if os.path.exists(self.output_path) else "w+b"
+        with open(self.output_path, mode) as output:
+            # 丢弃上次运行在检查点之后写出的结果，这些行会重新执行
+            output.truncate(checkpoint.output_size)
+            output.seek(checkpoint.output_size)
+            self._output = output
+            queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency)
+            workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.concurrency)]
+            reader = asyncio.create_task(self._feed(queue, len(workers)))
+            tasks = [reader, *workers]
+            try:
+                # 工作协程意外退出时读取会一直阻塞在有界队列上：任何一个任务出错就停止并抛出
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+                for task in done:
+                    if task.exception() is not None:
+                        raise task.exception()
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                self._save()
+        return dict(self.counts)
+
+    async def _feed(self, queue: asyncio.Queue, workers: int):
+        """读取全部输入后给每个工作协程发送一个结束标记"""
+        await self._read(queue)
+        for _ in range(workers):
+            await queue.put(None)
+
+    async def _read(self, queue: asyncio.Queue):
+        checkpoint = self._checkpoint
+        with open(self.input_path, "rb") as f:
+            for line_no, line in enumerate(f):
+                if checkpoint.is_done(line_no):
+                    self.counts["skipped"] += 1
+                    continue
+                if not line.strip():
+                    checkpoint.mark(line_no)
+                    continue
+                # 最早未完成的行迟迟不结束时停止读取，保证 done 集合和内存占用有上限
+                while line_no - checkpoint.watermark >= self.window:
+                    self._progress.clear()
+                    await self._progress.wait()
+                await queue.put((line_no, line))
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            line_no, line = item
+            record = await self._process(line_no, line)
+            failed = record["error"] is not None or record["response"]["status_code"] >= 400
+            self.counts["failed" if failed else "succeeded"] += 1
+            self._output.write(fast_json.dumps(record) + b"\n")
+            self._checkpoint.mark(line_no)
+            self._progress.set()
+            if time.monotonic() - self._last_save >= self.checkpoint_interval:
+                self._save()
+
+    def _save(self):
+        self._output.flush()
+        os.fsync(self._output.fileno())
+        self._checkpoint.save(self._output.tell())
+        self._last_save = time.monotonic()
+
+    async def _process(self, line_no: int, line: bytes) -> Dict[str, Any]:
+        custom_id = f"line-{line_no + 1}"
+        try:
+            entry = fast_json.loads(line)
+            if not isinstance(entry, dict):
+                raise ValueError("each line must be a JSON object")
+            custom_id = entry.get("custom_id", custom_id)
+            path = request_path(entry, self.deployment, self.api_version)
+            body = entry.get("body")
+            if isinstance(body, dict):
+                # 批量任务只取完整响应
+                body = {k: v for k, v in body.items() if k not in ("stream", "stream_options")}
+            payload = fast_json.dumps(body) if body is not None else b""
+        except ValueError as e:
+            return self._error(custom_id, "invalid_request", str(e))
+
+        method = str(entry.get("method") or "POST").upper()
+        headers = {"content-type": "application/json"}
+        for attempt in range(1, self.max_attempts + 1):
+            await self._wait_for_pause()
+            try:
+                result = await self.service.forward_full_request(method, path, payload, headers, raw=True)
+            except HTTPException as e:
+                if e.status_code in _THROTTLED_STATUS and attempt < self.max_attempts:
+                    self._pause((e.headers or {}).get("Retry-After"), attempt)
+                    continue
+                detail = e.detail.get("error", {}) if isinstance(e.detail, dict) else {}
+                return self._error(custom_id, str(detail.get("code", e.status_code)),
+                                   str(detail.get("message", e.detail)))
+            if result.status_code in _THROTTLED_STATUS and attempt < self.max_attempts:
+                self._pause(result.headers.get("retry-after"), attempt)
+                continue
+            return self._response(custom_id, result)
+        return self._error(custom_id, "max_attempts", "request was throttled on every attempt")
+
+    async def _wait_for_pause(self):
+        delay = self.paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _pause(self, retry_after: Optional[str], attempt: int):
+        """按 Retry-After（没有时按指数退避）暂停所有 worker"""
+        try:
+            delay = float(retry_after) if retry_after is not None else None
+        except ValueError:
+            delay = None
+        if delay is None:
+            delay = min(0.5 * 2 ** (attempt - 1), 30.0)
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+    @staticmethod
+    def _response(custom_id: Any, result: UpstreamResponse) -> Dict[str, Any]:
+        try:
+            body = result.json()
+        except ValueError:
+            body = result.content.decode("utf-8", "replace")
+        request_id = result.headers.get("apim-request-id") or result.headers.get("x-request-id")
+        return {
+            "custom_id": custom_id,
+            "response": {"status_code": result.status_code, "request_id": request_id, "body": body},
+            "error": None,
+        }
+
+    @staticmethod
+    def _error(custom_id: Any, code: str, message: str) -> Dict[str, Any]:
+        return {"custom_id": custom_id, "response": None, "error": {"code": code, "message": message}}
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m src.batch",
+                                     description="Run a JSONL file of Azure OpenAI requests across all instances")
+    parser.add_argument("input", help="input JSONL (Azure OpenAI Batch API format)")
+    parser.add_argument("output", help="output JSONL; appended to when resuming")
+    parser.add_argument("--checkpoint", help="checkpoint file (default: OUTPUT.checkpoint)")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight at once (default 16)")
+    parser.add_argument("--deployment", help="deployment for requests without body.model")
+    parser.add_argument("--api-version", default=DEFAULT_API_VERSION,
+                        help=f"api-version for short urls (default {DEFAULT_API_VERSION})")
+    parser.add_argument("--max-attempts", type=int, default=10,
+                        help="attempts per request while throttled (default 10)")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="discard an existing output file that has no checkpoint")
+    return parser.parse_args(argv)
+
+
+async def run(args: argparse.Namespace) -> Dict[str, int]:
+    service = OpenAIService(settings.instances)
+    if not service.instances:
+        raise SystemExit("No OpenAI instances configured")
+    try:
+        await service.warm_up()
+        runner = BatchRunner(service, args.input, args.output, checkpoint_path=args.checkpoint,
+                             concurrency=args.concurrency, deployment=args.deployment,
+                             api_version=args.api_version, max_attempts=args.max_attempts,
+                             overwrite=args.overwrite)
+        return await runner.run()
+    finally:
+        await service.close()
+        access_log.close()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    started = time.monotonic()
+    try:
+        counts = asyncio.run(run(args))
+    except FileExistsError as e:
+        raise SystemExit(str(e))
+    elapsed = time.monotonic() - started
+    print(f"succeeded={counts['succeeded']} failed={counts['failed']} skipped={counts['skipped']} "
+          f"elapsed={elapsed:.1f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,10 +3,15 @@ import json
 from pathlib import Path
 from typing import List, Dict, Any, Optional
 
+# Connection pool settings an instance may override in its `pool` field
+POOL_FIELDS = ("max_connections", "max_keepalive_connections", "keepalive_expiry", "prewarm_connections")
+
 class Settings:
     def __init__(self):
-        self.instances = self._load_openai_instances()
-        
+        # Config file the instances were read from (None when they came from OPENAI_INSTANCES)
+        self.config_path: Optional[Path] = None
+        self.instances = self._normalize_instances(self._load_openai_instances())
+
     def _load_openai_instances(self) -> List[Dict[str, str]]:
         """
         Load OpenAI instances configuration from environment variables or external config file.
@@ -32,6 +37,7 @@ class Settings:
                 try:
                     with open(config_file, 'r') as f:
                         instances_data = json.load(f)
+                        self.config_path = config_file
                         return instances_data.get("instances", [])
                 except (json.JSONDecodeError, IOError) as e:
                     print(f"Error loading config from {config_path}: {e}")
@@ -48,6 +54,7 @@ class Settings:
                 try:
                     with open(path, 'r') as f:
                         instances_data = json.load(f)
+                        self.config_path = path
                         return instances_data.get("instances", [])
                 except (json.JSONDecodeError, IOError):
                     continue
@@ -56,6 +63,75 @@ class Settings:
         print("Warning: No OpenAI instances configuration found")
         return []
 
+    def parse_instances(self, data: Any) -> List[Dict[str, Any]]:
+        """
+        Validate a reloaded configuration ({"instances": [...]}) and normalize its entries.
+
+        Unlike the startup path, problems raise ValueError instead of falling back to
+        an empty list, so a bad edit can never swap out every instance.
+        """
+        if not isinstance(data, dict) or not isinstance(data.get("instances"), list):
+            raise ValueError('Instance configuration must be an object with an "instances" list')
+        instances = self._normalize_instances(data["instances"])
+        if not instances:
+            raise ValueError("Instance configuration contains no valid instances")
+        return instances
+
+    def load_instances_file(self, path: Path) -> List[Dict[str, Any]]:
+        """Read and validate an instance configuration file; raises ValueError or OSError."""
+        with open(path, 'r') as f:
+            try:
+                data = json.load(f)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Invalid JSON in {path}: {e}") from e
+        return self.parse_instances(data)
+
+    def _normalize_instances(self, instances: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Validate instance entries and their optional routing fields.
+
+        Each instance needs `name`, `url` and `api_key`. Optional fields:
+        - `deployments`: deployment names hosted by the instance; without it the
+          instance is assumed to host every deployment
+        - `aliases`: client-facing deployment name -> deployment name on this instance
+        - `weight`: relative share of traffic for weighted strategies
+        - `pool`: connection pool overrides for this instance (`max_connections`,
+          `max_keepalive_connections`, `keepalive_expiry`, `prewarm_connections`)
+        """
+        normalized = []
+        seen_names = set()
+        for instance in instances:
+            if not isinstance(instance, dict) or not all(instance.get(key) for key in ("name", "url", "api_key")):
+                print(f"Warning: Skipping OpenAI instance without name/url/api_key: {instance!r:.80}")
+                continue
+            if instance["name"] in seen_names:
+                print(f"Warning: Skipping duplicate OpenAI instance name: {instance['name']}")
+                continue
+            deployments = instance.get("deployments")
+            if deployments is not None and (
+                not isinstance(deployments, list) or not all(isinstance(d, str) for d in deployments)
+            ):
+                print(f"Warning: Ignoring invalid deployments for instance {instance['name']}")
+                instance = {k: v for k, v in instance.items() if k != "deployments"}
+            aliases = instance.get("aliases")
+            if aliases is not None and (
+                not isinstance(aliases, dict) or not all(isinstance(k, str) and isinstance(v, str) for k, v in aliases.items())
+            ):
+                print(f"Warning: Ignoring invalid aliases for instance {instance['name']}")
+                instance = {k: v for k, v in instance.items() if k != "aliases"}
+            pool = instance.get("pool")
+            if pool is not None and (
+                not isinstance(pool, dict) or not all(
+                    k in POOL_FIELDS and isinstance(v, (int, float)) and not isinstance(v, bool) and v >= 0
+                    for k, v in pool.items()
+                )
+            ):
+                print(f"Warning: Ignoring invalid pool settings for instance {instance['name']}")
+                instance = {k: v for k, v in instance.items() if k != "pool"}
+            seen_names.add(instance["name"])
+            normalized.append(instance)
+        return normalized
+
     def get_log_level(self) -> str:
         """Get log level from environment variable or default to INFO"""
         return os.environ.get("LOG_LEVEL", "INFO")
@@ -64,6 +140,261 @@ class Settings:
         """Get log file path from environment variable"""
         return os.environ.get("LOG_FILE")
 
+    def get_stream_ttft_timeout(self) -> float:
+        """Get the time-to-first-token deadline (seconds) before a streaming request fails over"""
+        return float(os.environ.get("STREAM_TTFT_TIMEOUT", "30"))
+
+    def get_retry_options(self) -> Dict[str, Any]:
+        """
+        Get the retry policy settings.
+        REQUEST_TIMEOUT is the total deadline of a request across all attempts (for streams,
+        until the first event); each attempt's timeout is what is left of it.
+        RETRY_AFTER_MAX_WAIT is how long a request may wait for a throttled instance to
+        recover once every candidate has been tried.
+        """
+        return {
+            "timeout": float(os.environ.get("REQUEST_TIMEOUT", "600")),
+            "max_attempts": int(os.environ.get("RETRY_MAX_ATTEMPTS", "3")),
+            "backoff_base": float(os.environ.get("RETRY_BACKOFF_BASE", "0.05")),
+            "backoff_max": float(os.environ.get("RETRY_BACKOFF_MAX", "1")),
+            "max_wait": float(os.environ.get("RETRY_AFTER_MAX_WAIT", "2")),
+        }
+
+    def get_retry_budget_options(self) -> Dict[str, Any]:
+        """
+        Get the global retry budget: retries may add at most RETRY_BUDGET_RATIO of the
+        request rate, plus RETRY_BUDGET_MIN_PER_SECOND so that low traffic can still retry.
+        """
+        return {
+            "ratio": float(os.environ.get("RETRY_BUDGET_RATIO", "0.2")),
+            "min_per_second": float(os.environ.get("RETRY_BUDGET_MIN_PER_SECOND", "5")),
+        }
+
+    def get_hedge_enabled(self) -> bool:
+        """Whether slow non-streaming chat/completions/embeddings calls get a backup request (off by default)"""
+        return os.environ.get("HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+
+    def get_hedge_options(self) -> Dict[str, Any]:
+        """
+        Get the hedging settings. The backup is sent once the primary has taken longer than
+        the instance's HEDGE_QUANTILE latency, clamped to [HEDGE_MIN_DELAY, HEDGE_MAX_DELAY];
+        HEDGE_BUDGET_RATIO caps backups as a fraction of hedge-eligible requests.
+        """
+        return {
+            "quantile": float(os.environ.get("HEDGE_QUANTILE", "0.95")),
+            "min_delay": float(os.environ.get("HEDGE_MIN_DELAY", "0.05")),
+            "max_delay": float(os.environ.get("HEDGE_MAX_DELAY", "10")),
+            "budget_ratio": float(os.environ.get("HEDGE_BUDGET_RATIO", "0.1")),
+        }
+
+    def get_upstream_connect_timeout(self) -> float:
+        """Get the upstream connect timeout (seconds), capped by the request's remaining deadline"""
+        return float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", "10"))
+
+    def get_upstream_pool_options(self) -> Dict[str, Any]:
+        """
+        Get the default per-instance connection pool settings; an instance's `pool` field overrides them.
+        UPSTREAM_PREWARM_CONNECTIONS connections are opened to every instance at startup.
+        """
+        return {
+            "max_connections": int(os.environ.get("UPSTREAM_MAX_CONNECTIONS", "100")),
+            "max_keepalive_connections": int(os.environ.get("UPSTREAM_MAX_KEEPALIVE_CONNECTIONS", "20")),
+            "keepalive_expiry": float(os.environ.get("UPSTREAM_KEEPALIVE_EXPIRY", "60")),
+            "prewarm_connections": int(os.environ.get("UPSTREAM_PREWARM_CONNECTIONS", "1")),
+        }
+
+    def get_upstream_keepalive_interval(self) -> float:
+        """
+        Get how often (seconds) idle instance pools are pinged to keep their connections open.
+        UPSTREAM_KEEPALIVE_INTERVAL=0 disables the pings; keep it below UPSTREAM_KEEPALIVE_EXPIRY.
+        """
+        return float(os.environ.get("UPSTREAM_KEEPALIVE_INTERVAL", "30"))
+
+    def get_load_balancing_strategy(self) -> str:
+        """
+        Get the instance selection strategy from environment variable.
+        One of: random, round_robin, weighted, least_in_flight, p2c_ewma, peak_ewma
+        """
+        return os.environ.get("LOAD_BALANCING_STRATEGY", "p2c_ewma")
+
+    def get_rate_limit_max_wait(self) -> float:
+        """Get how long (seconds) a request may be held waiting for TPM/RPM headroom before a local 429"""
+        return float(os.environ.get("RATE_LIMIT_MAX_WAIT", "2"))
+
+    def get_adaptive_concurrency_enabled(self) -> bool:
+        """Whether each instance gets an adaptive (AIMD) in-flight limit (off by default)"""
+        return os.environ.get("ADAPTIVE_CONCURRENCY_ENABLED", "false").lower() in ("1", "true", "yes")
+
+    def get_adaptive_concurrency_options(self) -> Dict[str, Any]:
+        """
+        Get the adaptive concurrency limit settings. The limit starts at CONCURRENCY_INITIAL_LIMIT,
+        stays within [CONCURRENCY_MIN_LIMIT, CONCURRENCY_MAX_LIMIT], is halved on a 429 and cut by 10%
+        when the recent stream time-to-first-event exceeds CONCURRENCY_LATENCY_TOLERANCE times its long-term average.
+        """
+        return {
+            "initial_limit": float(os.environ.get("CONCURRENCY_INITIAL_LIMIT", "20")),
+            "min_limit": float(os.environ.get("CONCURRENCY_MIN_LIMIT", "1")),
+            "max_limit": float(os.environ.get("CONCURRENCY_MAX_LIMIT", "500")),
+            "tolerance": float(os.environ.get("CONCURRENCY_LATENCY_TOLERANCE", "2")),
+        }
+
+    def get_concurrency_queue_timeout(self) -> float:
+        """Get how long (seconds) a request may wait for a slot when every instance is at its concurrency limit"""
+        return float(os.environ.get("CONCURRENCY_QUEUE_TIMEOUT", "1"))
+
+    def get_prefix_affinity_enabled(self) -> bool:
+        """Whether chat requests sharing a long prompt prefix are pinned to one instance (off by default)"""
+        return os.environ.get("PREFIX_AFFINITY_ENABLED", "false").lower() in ("1", "true", "yes")
+
+    def get_prefix_affinity_options(self) -> Dict[str, Any]:
+        """
+        Get the prefix affinity ring settings. No instance takes affinity traffic beyond
+        PREFIX_AFFINITY_LOAD_FACTOR times the average in-flight load; the excess moves to the next instance on the ring.
+        """
+        return {
+            "load_factor": float(os.environ.get("PREFIX_AFFINITY_LOAD_FACTOR", "1.25")),
+            "vnodes": int(os.environ.get("PREFIX_AFFINITY_VNODES", "64")),
+        }
+
+    def get_prefix_affinity_chars(self) -> int:
+        """Get how many leading prompt characters form the affinity key; shorter prompts are routed normally"""
+        return int(os.environ.get("PREFIX_AFFINITY_CHARS", "4096"))
+
+    def get_admission_options(self) -> Dict[str, Any]:
+        """
+        Get admission control settings from environment variables.
+        ADMISSION_MAX_CONCURRENCY=0 (default) disables admission control.
+        ADMISSION_KEY_PRIORITIES is a JSON object mapping API keys to a priority class
+        (interactive, default or batch).
+        """
+        key_priorities = {}
+        raw = os.environ.get("ADMISSION_KEY_PRIORITIES")
+        if raw:
+            try:
+                key_priorities = json.loads(raw)
+            except json.JSONDecodeError:
+                print("Error: ADMISSION_KEY_PRIORITIES environment variable contains invalid JSON")
+        return {
+            "max_concurrency": int(os.environ.get("ADMISSION_MAX_CONCURRENCY", "0")),
+            "max_queue": int(os.environ.get("ADMISSION_MAX_QUEUE", "1000")),
+            "queue_timeout": float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "10")),
+            "priority_header": os.environ.get("ADMISSION_PRIORITY_HEADER", "x-priority"),
+            "key_priorities": key_priorities,
+        }
+
+    def get_response_cache_enabled(self) -> bool:
+        """Whether the response cache for deterministic requests is enabled (off by default)"""
+        return os.environ.get("RESPONSE_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+
+    def get_response_cache_options(self) -> Dict[str, Any]:
+        """Get response cache limits; RESPONSE_CACHE_PATH enables the SQLite disk tier"""
+        return {
+            "max_entries": int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "10000")),
+            "max_bytes": int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(256 * 1024 * 1024))),
+            "ttl": float(os.environ.get("RESPONSE_CACHE_TTL", "3600")),
+            "path": os.environ.get("RESPONSE_CACHE_PATH") or None,
+        }
+
+    def get_embeddings_batch_enabled(self) -> bool:
+        """Whether concurrent single-input embeddings requests are coalesced (off by default)"""
+        return os.environ.get("EMBEDDINGS_BATCH_ENABLED", "false").lower() in ("1", "true", "yes")
+
+    def get_embeddings_batch_options(self) -> Dict[str, Any]:
+        """Get the embeddings coalescing window and per-batch limits"""
+        return {
+            "window": float(os.environ.get("EMBEDDINGS_BATCH_WINDOW_MS", "10")) / 1000.0,
+            "max_inputs": int(os.environ.get("EMBEDDINGS_BATCH_MAX_INPUTS", "256")),
+            "max_tokens": int(os.environ.get("EMBEDDINGS_BATCH_MAX_TOKENS", "50000")),
+        }
+
+    def get_singleflight_mode(self) -> str:
+        """
+        Get the in-flight request deduplication mode (SINGLEFLIGHT_MODE).
+        "off" (default), "deterministic" (only requests the response cache would accept)
+        or "all" (every identical POST request).
+        """
+        mode = os.environ.get("SINGLEFLIGHT_MODE", "off").strip().lower()
+        if mode not in ("off", "deterministic", "all"):
+            print(f"Warning: Unknown SINGLEFLIGHT_MODE '{mode}', deduplication disabled")
+            return "off"
+        return mode
+
+    def get_singleflight_streams_enabled(self) -> bool:
+        """Whether identical streaming requests share one upstream stream (off by default)"""
+        return os.environ.get("SINGLEFLIGHT_STREAMS", "false").lower() in ("1", "true", "yes")
+
+    def get_access_log_options(self) -> Dict[str, Any]:
+        """
+        Get the structured log pipeline settings.
+        LOG_FILE unset writes JSON lines to stdout; LOG_ROTATE_INTERVAL=0 disables time-based rotation.
+        LOG_SUCCESS_SAMPLE_RATE keeps that fraction of info records (warnings and errors are always kept).
+        """
+        return {
+            "path": os.environ.get("LOG_FILE") or None,
+            "max_bytes": int(os.environ.get("LOG_MAX_BYTES", str(100 * 1024 * 1024))),
+            "backup_count": int(os.environ.get("LOG_BACKUP_COUNT", "5")),
+            "rotate_interval": float(os.environ.get("LOG_ROTATE_INTERVAL", "0")),
+            "sample_rate": float(os.environ.get("LOG_SUCCESS_SAMPLE_RATE", "1.0")),
+            "buffer_size": int(os.environ.get("LOG_BUFFER_SIZE", "10000")),
+            "flush_interval": float(os.environ.get("LOG_FLUSH_INTERVAL", "1.0")),
+        }
+
+    def get_config_watch_interval(self) -> float:
+        """
+        Get how often (seconds) the instance config file is checked for changes.
+        CONFIG_WATCH_INTERVAL=0 disables watching; instances from OPENAI_INSTANCES are never watched.
+        """
+        return float(os.environ.get("CONFIG_WATCH_INTERVAL", "5"))
+
+    def get_drain_timeout(self) -> float:
+        """Get how long (seconds) removed instances may finish in-flight requests before their state is dropped"""
+        return float(os.environ.get("INSTANCE_DRAIN_TIMEOUT", "600"))
+
+    def get_admin_api_key(self) -> str:
+        """Get the key for /admin endpoints (ADMIN_API_KEY, falling back to API_KEY); empty disables them"""
+        return os.environ.get("ADMIN_API_KEY") or os.environ.get("API_KEY", "")
+
+    def get_tenant_keys(self) -> List[Dict[str, Any]]:
+        """
+        Get per-tenant API keys from TENANT_KEYS (JSON) or the file at TENANT_KEYS_PATH.
+        Both hold {"keys": [{"name", "key" or "key_sha256", "rpm", "tpm"}]}; a missing or
+        zero rpm/tpm means that dimension is unlimited.
+        """
+        raw = os.environ.get("TENANT_KEYS")
+        path = os.environ.get("TENANT_KEYS_PATH")
+        try:
+            if raw:
+                data = json.loads(raw)
+            elif path:
+                with open(path, 'r') as f:
+                    data = json.load(f)
+            else:
+                return []
+        except (json.JSONDecodeError, IOError) as e:
+            print(f"Error: Could not load tenant keys: {e}")
+            return []
+        keys = data.get("keys") if isinstance(data, dict) else None
+        if not isinstance(keys, list):
+            print('Error: Tenant keys must be an object with a "keys" list')
+            return []
+        return keys
+
+    def get_workers(self) -> int:
+        """
+        Get the number of uvicorn worker processes (WORKERS, default 1).
+        With more than one, workers share circuit breaker, in-flight and rate-limit state.
+        """
+        return max(int(os.environ.get("WORKERS", "1")), 1)
+
+    def get_circuit_breaker_options(self) -> Dict[str, Any]:
+        """Get per-instance circuit breaker settings from environment variables"""
+        return {
+            "failure_threshold": int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", "5")),
+            "cooldown": float(os.environ.get("CIRCUIT_COOLDOWN", "5")),
+            "max_cooldown": float(os.environ.get("CIRCUIT_MAX_COOLDOWN", "60")),
+            "half_open_max_calls": int(os.environ.get("CIRCUIT_HALF_OPEN_REQUESTS", "1")),
+        }
+
 
 # Create a global settings instance
 settings = Settings()
\ No newline at end of file
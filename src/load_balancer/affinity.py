@@ -0,0 +1,92 @@
+import bisect
+import hashlib
+import math
+from typing import Any, Dict, Iterator, List, Optional
+
+from src.utils import fast_json
+from src.utils.request_body import json_container_prefix, top_level_members
+
+
+# Top-level request fields that make up the cached prompt prefix, in prompt order
+_PROMPT_FIELDS = (b"tools", b"messages")
+
+
+def _hash64(data: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
+
+
+def prefix_key(body: Any, deployment: Optional[str], prefix_chars: int = 4096) -> Optional[int]:
+    """
+    Hash the first `prefix_chars` bytes of a chat request's prompt (tools, then messages).
+
+    The raw bytes of the top-level `tools` and `messages` values are hashed as sent. They are
+    found with a forward scan that never decodes the body and stops once `prefix_chars` bytes
+    are collected, so other per-request fields (user, temperature, ...) do not change the key.
+    Prompts shorter than `prefix_chars` return None: Azure only caches prompts of at least 1024
+    tokens, so pinning shorter ones to an instance would cost balance for nothing.
+    """
+    if isinstance(body, dict):
+        body = fast_json.dumps(body)
+    if not isinstance(body, (bytes, bytearray)) or b'"messages"' not in body:
+        return None
+    body = bytes(body)
+    parts: Dict[bytes, bytes] = {}
+    budget = prefix_chars
+    for name, start in top_level_members(body):
+        if name not in _PROMPT_FIELDS:
+            continue
+        value = json_container_prefix(body, start, budget)
+        if value is None:
+            return None
+        parts[name] = value
+        budget -= len(value)
+        if budget <= 0 or len(parts) == len(_PROMPT_FIELDS):
+            break
+    if b"messages" not in parts and budget > 0:
+        return None
+    prefix = b"\x00".join(parts[name] for name in _PROMPT_FIELDS if name in parts)[:prefix_chars]
+    if len(prefix) < prefix_chars:
+        return None
+    return _hash64((deployment or "").encode() + b"\x00" + prefix)
+
+
+class HashRing:
+    """
+    Consistent hash ring over instance names, with `vnodes` points per unit of weight.
+
+    Adding or removing an instance only moves the keys that hashed next to its points,
+    so the prompt caches of the other instances stay warm across config reloads.
+    """
+
+    def __init__(self, instances: List[Dict[str, Any]], vnodes: int = 64):
+        points = []
+        for instance in instances:
+            try:
+                weight = max(float(instance.get("weight", 1)), 0.0)
+            except (TypeError, ValueError):
+                weight = 1.0
+            for i in range(max(int(round(vnodes * weight)), 1)):
+                points.append((_hash64(f"{instance['name']}#{i}".encode()), instance["name"]))
+        points.sort()
+        self._hashes = [point[0] for point in points]
+        self._names = [point[1] for point in points]
+        self.size = len(instances)
+
+    def walk(self, key: int) -> Iterator[str]:
+        """Distinct instance names in ring order, starting at the owner of `key`."""
+        if not self._names:
+            return
+        start = bisect.bisect_left(self._hashes, key)
+        seen = set()
+        for i in range(len(self._names)):
+            name = self._names[(start + i) % len(self._names)]
+            if name not in seen:
+                seen.add(name)
+                yield name
+                if len(seen) == self.size:
+                    return
+
+
+def bounded_capacity(total_in_flight: int, instances: int, load_factor: float) -> int:
+    """Consistent hashing with bounded loads: no instance takes more than load_factor times the average."""
+    return max(math.ceil(load_factor * (total_in_flight + 1) / max(instances, 1)), 1)
@@ -1,28 +1,518 @@
-from fastapi import HTTPException
-import requests
-import json
+import asyncio
+import math
 import random
-from typing import List, Dict
+import time
+from typing import Any, Collection, Dict, List, Mapping, Optional
 
-class LoadBalancer:
-    def __init__(self, instances: List[str]):
-        self.instances = instances
+from src.load_balancer.affinity import HashRing, bounded_capacity
+from src.load_balancer.circuit_breaker import CircuitBreaker, parse_retry_after
+from src.load_balancer.concurrency import AdaptiveLimit
+from src.load_balancer.rate_limit import RateLimitBudget
+from src.load_balancer.shared_state import SharedState
+
+
+class CapacityExhausted(Exception):
+    """No healthy instance has rate-limit (or concurrency) headroom for the request within the hold time."""
+
+    def __init__(self, retry_after: float, reason: str = "rate-limit capacity"):
+        super().__init__(f"No instance has {reason}, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+# Latency kinds: full non-streaming response time and time to the first stream event
+RESPONSE = "response"
+TTFT = "ttft"
+
+
+class InstanceStats:
+    """
+    Live routing statistics for one instance.
+
+    Latencies are relative: each sample is divided by the balancer-wide baseline of its
+    kind (see LoadBalancer.relative_latency), so streaming TTFT and full response times
+    can share one EWMA. An instance without samples (new, reset, or only answering 5xx)
+    counts as typical (1.0) rather than free, so its in-flight count still matters.
+    """
+
+    __slots__ = ("in_flight", "ewma", "peak_ewma", "peak_updated", "requests")
+
+    def __init__(self):
+        self.in_flight = 0
+        self.ewma = 1.0
+        self.peak_ewma = 0.0
+        self.peak_updated = 0.0
+        self.requests = 0
+
+    def observe(self, latency: float, alpha: float, tau: float, now: float):
+        self.requests += 1
+        self.ewma = latency if self.requests == 1 else self.ewma + alpha * (latency - self.ewma)
+        # Peak EWMA: jump to any latency above the current estimate, decay towards lower ones
+        current = self.decayed_peak(tau, now)
+        if latency > current:
+            self.peak_ewma = latency
+        else:
+            weight = math.exp(-(now - self.peak_updated) / tau)
+            self.peak_ewma = current * weight + latency * (1.0 - weight)
+        self.peak_updated = now
+
+    def decayed_peak(self, tau: float, now: float) -> float:
+        """Peak EWMA decays towards zero while idle so that a slow instance is eventually retried."""
+        if not self.requests:
+            return 1.0
+        return self.peak_ewma * math.exp(-(now - self.peak_updated) / tau)
+
+
+def instance_weight(instance: Mapping[str, Any]) -> float:
+    try:
+        return max(float(instance.get("weight", 1)), 0.0) or 1e-9
+    except (TypeError, ValueError):
+        return 1.0
+
+
+class Strategy:
+    """Picks one instance out of the eligible candidates."""
+
+    name = ""
+
+    def choose(self, candidates: List[Dict[str, Any]], balancer: "LoadBalancer") -> Dict[str, Any]:
+        raise NotImplementedError
+
+
+class RandomStrategy(Strategy):
+    name = "random"
+
+    def choose(self, candidates, balancer):
+        return random.choice(candidates)
+
+
+class RoundRobinStrategy(Strategy):
+    name = "round_robin"
+
+    def __init__(self):
         self.current_instance_index = 0
 
-    def get_next_instance(self) -> str:
-        instance = self.instances[self.current_instance_index]
-        self.current_instance_index = (self.current_instance_index + 1) % len(self.instances)
+    def choose(self, candidates, balancer):
+        instance = candidates[self.current_instance_index % len(candidates)]
+        self.current_instance_index += 1
         return instance
 
-    def forward_request(self, endpoint: str, payload: Dict) -> Dict:
-        for _ in range(len(self.instances)):
-            instance = self.get_next_instance()
-            try:
-                response = requests.post(f"{instance}/{endpoint}", json=payload)
-                if response.status_code == 200:
-                    return response.json()
-                else:
-                    continue  # Try the next instance if the response is not 200
-            except requests.RequestException:
-                continue  # Try the next instance on exception
-        raise HTTPException(status_code=503, detail="All instances are unavailable")
\ No newline at end of file
+
+class WeightedStrategy(Strategy):
+    """Smooth weighted round-robin (as in nginx): spreads picks evenly in proportion to weight."""
+
+    name = "weighted"
+
+    def __init__(self):
+        self.current_weights: Dict[str, float] = {}
+
+    def choose(self, candidates, balancer):
+        total = 0.0
+        best = None
+        best_weight = -math.inf
+        for instance in candidates:
+            weight = instance_weight(instance)
+            total += weight
+            current = self.current_weights.get(instance["name"], 0.0) + weight
+            self.current_weights[instance["name"]] = current
+            if current > best_weight:
+                best, best_weight = instance, current
+        self.current_weights[best["name"]] -= total
+        return best
+
+
+class LeastInFlightStrategy(Strategy):
+    """Fewest outstanding requests relative to weight; ties are broken randomly."""
+
+    name = "least_in_flight"
+
+    def choose(self, candidates, balancer):
+        best: List[Dict[str, Any]] = []
+        best_load = math.inf
+        for instance in candidates:
+            load = balancer.in_flight(instance) / instance_weight(instance)
+            if load < best_load:
+                best, best_load = [instance], load
+            elif load == best_load:
+                best.append(instance)
+        return random.choice(best)
+
+
+class P2CEWMAStrategy(Strategy):
+    """Power of two choices: sample two candidates, keep the one with the lower EWMA-latency cost."""
+
+    name = "p2c_ewma"
+
+    def cost(self, instance, balancer) -> float:
+        stats = balancer.stats_for(instance)
+        return stats.ewma * (balancer.in_flight(instance) + 1) / instance_weight(instance)
+
+    def choose(self, candidates, balancer):
+        if len(candidates) == 1:
+            return candidates[0]
+        first, second = random.sample(candidates, 2)
+        return first if self.cost(first, balancer) <= self.cost(second, balancer) else second
+
+
+class PeakEWMAStrategy(P2CEWMAStrategy):
+    """Power of two choices over peak EWMA latency, which reacts to latency spikes immediately."""
+
+    name = "peak_ewma"
+
+    def cost(self, instance, balancer) -> float:
+        stats = balancer.stats_for(instance)
+        latency = stats.decayed_peak(balancer.peak_tau, balancer.clock())
+        return latency * (balancer.in_flight(instance) + 1) / instance_weight(instance)
+
+
+STRATEGIES = {
+    strategy.name: strategy
+    for strategy in (RandomStrategy, RoundRobinStrategy, WeightedStrategy,
+                     LeastInFlightStrategy, P2CEWMAStrategy, PeakEWMAStrategy)
+}
+
+
+class Lease:
+    """
+    One request's hold on an instance.
+
+    Tracks whether the outcome has been reported and whether the in-flight slot
+    has been returned, so `release()` is always safe to call from a finally block.
+    """
+
+    __slots__ = ("balancer", "instance", "started", "outcome_recorded", "released")
+
+    def __init__(self, balancer: "LoadBalancer", instance: Dict[str, Any]):
+        self.balancer = balancer
+        self.instance = instance
+        self.started = balancer.clock()
+        self.outcome_recorded = False
+        self.released = False
+
+    def record_response(self, status_code: int, headers: Optional[Mapping[str, str]] = None, kind: str = RESPONSE):
+        """Feed an upstream status code into the breaker and, for successes, the latency stats."""
+        self.outcome_recorded = True
+        self.balancer.record_response(self.instance, status_code, headers, self.balancer.clock() - self.started,
+                                      kind)
+
+    def record_error(self):
+        """Connection errors, timeouts and broken streams count as instance failures."""
+        self.outcome_recorded = True
+        self.balancer.breaker_for(self.instance).record_failure()
+        self.balancer.publish(self.instance)
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        self.balancer.stats_for(self.instance).in_flight -= 1
+        if not self.outcome_recorded:
+            # Cancelled before any outcome: give back the half-open trial slot
+            self.balancer.breaker_for(self.instance).release()
+        self.balancer.publish(self.instance)
+        self.balancer.wake_slot_waiters()
+
+
+class LoadBalancer:
+    """
+    Routing engine shared by all requests of an OpenAIService.
+
+    Eligible instances are those not yet tried by the request whose circuit breaker
+    is not open and whose TPM/RPM budget can absorb the request's estimated cost;
+    the configured strategy picks one of them. When healthy instances exist but
+    none has headroom, the request is held for up to `max_capacity_wait` seconds
+    rather than sent to a certain 429.
+
+    With `concurrency` options set, each instance also has an adaptive in-flight
+    limit (see AdaptiveLimit). Instances at their limit are skipped; when every
+    ready instance is at its limit, the request waits up to `concurrency_wait`
+    seconds for a slot to free up.
+
+    With `affinity` options set, requests that carry an affinity key (a hash of their
+    prompt prefix) go to the key's owner among the requested `instances` on a consistent
+    hash ring, so requests that share a long prompt hit the same instance's prompt cache.
+    An owner that is not ready (unhealthy, tried, out of headroom) or already carries
+    more than `load_factor` times the average in-flight load of those instances is
+    passed over for the next one on the ring; if none qualifies, the strategy picks as usual.
+
+    With `shared` set (multi-worker mode), every change to an instance's breaker,
+    in-flight count or budget is published to the worker's slot of the shared
+    segment, and routing also honours what the other workers have published:
+    an instance opened by any worker is skipped by all of them, in-flight counts
+    are summed, and the freshest rate-limit headers seen by any worker are used.
+    """
+
+    def __init__(self, instances: List[Dict[str, Any]], strategy: str = "p2c_ewma",
+                 breaker_options: Optional[Dict[str, Any]] = None, max_capacity_wait: float = 2.0,
+                 ewma_alpha: float = 0.3, peak_tau: float = 10.0, baseline_alpha: float = 0.05,
+                 clock=time.monotonic,
+                 shared: Optional[SharedState] = None, concurrency: Optional[Dict[str, Any]] = None,
+                 concurrency_wait: float = 1.0, affinity: Optional[Dict[str, Any]] = None):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown load balancing strategy: {strategy} (expected one of {', '.join(STRATEGIES)})")
+        self.instances = instances
+        self.strategy = STRATEGIES[strategy]()
+        self.breaker_options = breaker_options or {}
+        self.max_capacity_wait = max_capacity_wait
+        self.ewma_alpha = ewma_alpha
+        self.peak_tau = peak_tau
+        self.baseline_alpha = baseline_alpha
+        # Balancer-wide EWMA of each latency kind, the unit of the per-instance statistics
+        self.latency_baselines: Dict[str, float] = {}
+        self.clock = clock
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.stats: Dict[str, InstanceStats] = {}
+        self.budgets: Dict[str, RateLimitBudget] = {}
+        self.shared = shared
+        self.shared_index = {instance["name"]: i for i, instance in enumerate(instances)}
+        self.concurrency = concurrency
+        self.concurrency_wait = concurrency_wait
+        self.limits: Dict[str, AdaptiveLimit] = {}
+        self._slot_waiters: List[asyncio.Future] = []
+        self.affinity = affinity
+        self.ring = HashRing(instances, affinity.get("vnodes", 64)) if affinity is not None else None
+        # How affinity-keyed requests were placed: on the key's owner, spilled further along the ring, or by the strategy
+        self.affinity_routes = {"owner": 0, "spill": 0, "fallback": 0}
+
+    def breaker_for(self, instance: Dict[str, Any]) -> CircuitBreaker:
+        breaker = self.breakers.get(instance["name"])
+        if breaker is None:
+            breaker = self.breakers[instance["name"]] = CircuitBreaker(**self.breaker_options)
+        return breaker
+
+    def stats_for(self, instance: Dict[str, Any]) -> InstanceStats:
+        stats = self.stats.get(instance["name"])
+        if stats is None:
+            stats = self.stats[instance["name"]] = InstanceStats()
+        return stats
+
+    def budget_for(self, instance: Dict[str, Any]) -> RateLimitBudget:
+        budget = self.budgets.get(instance["name"])
+        if budget is None:
+            budget = self.budgets[instance["name"]] = RateLimitBudget(clock=self.clock)
+        return budget
+
+    def limit_for(self, instance: Dict[str, Any]) -> Optional[AdaptiveLimit]:
+        """The instance's adaptive in-flight limit, or None when adaptive concurrency is off."""
+        if self.concurrency is None:
+            return None
+        limit = self.limits.get(instance["name"])
+        if limit is None:
+            limit = self.limits[instance["name"]] = AdaptiveLimit(**self.concurrency)
+        return limit
+
+    def _has_slot(self, instance: Dict[str, Any]) -> bool:
+        limit = self.limit_for(instance)
+        return limit is None or limit.has_room(self.stats_for(instance).in_flight)
+
+    async def _wait_for_slot(self, timeout: float):
+        future = asyncio.get_running_loop().create_future()
+        self._slot_waiters.append(future)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            if future in self._slot_waiters:
+                self._slot_waiters.remove(future)
+
+    def wake_slot_waiters(self):
+        """A lease was released: let requests queued on concurrency limits look again."""
+        waiters, self._slot_waiters = self._slot_waiters, []
+        for future in waiters:
+            if not future.done():
+                future.set_result(None)
+
+    def candidates(self, exclude: Collection[str] = (),
+                   instances: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+        return [
+            instance for instance in (self.instances if instances is None else instances)
+            if instance["name"] not in exclude and self.breaker_for(instance).is_available()
+            and not self._opened_by_peer(instance)
+        ]
+
+    def set_instances(self, instances: List[Dict[str, Any]]):
+        """
+        Swap the routing table. State is keyed by instance name, so instances that stay
+        keep their breaker, latency statistics and budget; leases already handed out for
+        removed instances still release normally.
+        """
+        self.instances = instances
+        if self.affinity is not None:
+            self.ring = HashRing(instances, self.affinity.get("vnodes", 64))
+
+    def reset(self, instance: Dict[str, Any]):
+        """Start an instance's health and budget over (e.g. after its URL changed), keeping its in-flight count."""
+        name = instance["name"]
+        self.breakers.pop(name, None)
+        self.budgets.pop(name, None)
+        self.limits.pop(name, None)
+        stats = self.stats.get(name)
+        if stats is not None:
+            self.stats[name] = InstanceStats()
+            self.stats[name].in_flight = stats.in_flight
+
+    def forget(self, name: str):
+        """Drop the state of a removed instance once it has drained."""
+        self.breakers.pop(name, None)
+        self.stats.pop(name, None)
+        self.budgets.pop(name, None)
+        self.limits.pop(name, None)
+
+    def in_flight(self, instance: Dict[str, Any]) -> int:
+        """Outstanding requests on the instance, across all workers in multi-worker mode."""
+        in_flight = self.stats_for(instance).in_flight
+        index = self._shared_slot(instance)
+        if index is not None:
+            in_flight += self.shared.peer_in_flight(index)
+        return in_flight
+
+    def _shared_slot(self, instance: Dict[str, Any]) -> Optional[int]:
+        # Instances added by a config reload have no record in the segment and stay per-worker
+        return None if self.shared is None else self.shared_index.get(instance["name"])
+
+    def _opened_by_peer(self, instance: Dict[str, Any]) -> bool:
+        index = self._shared_slot(instance)
+        if index is None:
+            return False
+        # Published open-until times come from the breakers' clock, not the balancer's
+        return self.shared.open_until(index) > self.breaker_for(instance).clock()
+
+    def _sync_budget(self, instance: Dict[str, Any]) -> RateLimitBudget:
+        """Adopt rate-limit state another worker observed more recently than this one."""
+        budget = self.budget_for(instance)
+        index = self._shared_slot(instance)
+        if index is not None:
+            tokens, requests = self.shared.freshest_buckets(index)
+            budget.tokens.merge(tokens)
+            budget.requests.merge(requests)
+        return budget
+
+    def publish(self, instance: Dict[str, Any]):
+        """Write this worker's view of the instance to the shared segment (no-op in single-worker mode)."""
+        index = self._shared_slot(instance)
+        if index is None:
+            return
+        breaker = self.breaker_for(instance)
+        budget = self.budget_for(instance)
+        self.shared.publish(
+            index,
+            breaker.open_until if breaker.state == "open" else 0.0,
+            self.stats_for(instance).in_flight,
+            (budget.tokens.remaining, budget.tokens.limit, budget.tokens.updated),
+            (budget.requests.remaining, budget.requests.limit, budget.requests.updated),
+        )
+
+    async def acquire(self, exclude: Collection[str] = (), tokens: int = 0,
+                      instances: Optional[List[Dict[str, Any]]] = None,
+                      max_wait: Optional[float] = None, affinity_key: Optional[int] = None) -> Optional[Lease]:
+        """
+        Pick an instance for a request estimated to cost `tokens`, optionally restricted
+        to `instances` (e.g. those hosting the requested deployment) and routed by
+        `affinity_key` when affinity is enabled.
+
+        Returns None when no healthy instance is left; raises CapacityExhausted when
+        healthy instances exist but none will have headroom within the hold time
+        (`max_wait`, defaulting to `max_capacity_wait`), or all of them stay at their
+        concurrency limit for `concurrency_wait`.
+        """
+        deadline = None
+        slot_deadline = None
+        while True:
+            candidates = self.candidates(exclude, instances)
+            if not candidates:
+                return None
+            ready = [instance for instance in candidates if self._sync_budget(instance).can_admit(tokens)]
+            if ready and self.concurrency is not None:
+                with_slot = [instance for instance in ready if self._has_slot(instance)]
+                if not with_slot:
+                    now = self.clock()
+                    if slot_deadline is None:
+                        slot_deadline = now + (self.concurrency_wait if max_wait is None
+                                               else min(self.concurrency_wait, max_wait))
+                    if now >= slot_deadline:
+                        raise CapacityExhausted(self.concurrency_wait, "a free concurrency slot")
+                    await self._wait_for_slot(slot_deadline - now)
+                    continue
+                ready = with_slot
+            if ready:
+                break
+            wait = min(self.budget_for(instance).wait_time(tokens) for instance in candidates)
+            now = self.clock()
+            if deadline is None:
+                deadline = now + (self.max_capacity_wait if max_wait is None else max_wait)
+            if now + wait > deadline:
+                raise CapacityExhausted(wait)
+            await asyncio.sleep(wait)
+        instance = None
+        if affinity_key is not None and self.ring is not None:
+            instance = self._affinity_choice(ready, self.instances if instances is None else instances, affinity_key)
+        if instance is None:
+            instance = self.strategy.choose(ready, self)
+        self.breaker_for(instance).on_dispatch()
+        self.budget_for(instance).reserve(tokens)
+        self.stats_for(instance).in_flight += 1
+        self.publish(instance)
+        return Lease(self, instance)
+
+    def _affinity_choice(self, ready: List[Dict[str, Any]], eligible: List[Dict[str, Any]],
+                         key: int) -> Optional[Dict[str, Any]]:
+        # The load bound and the owner are relative to the instances eligible for this request
+        # (e.g. those hosting its deployment), not the whole table
+        by_name = {instance["name"]: instance for instance in ready}
+        eligible_names = {instance["name"] for instance in eligible}
+        total = sum(self.in_flight(instance) for instance in eligible)
+        capacity = bounded_capacity(total, len(eligible), self.affinity.get("load_factor", 1.25))
+        position = 0
+        for name in self.ring.walk(key):
+            if name not in eligible_names:
+                continue
+            instance = by_name.get(name)
+            if instance is not None and self.in_flight(instance) < capacity:
+                self.affinity_routes["owner" if position == 0 else "spill"] += 1
+                return instance
+            position += 1
+        self.affinity_routes["fallback"] += 1
+        return None
+
+    def relative_latency(self, latency: float, kind: str) -> float:
+        """`latency` in units of the balancer-wide average of its kind (1.0 = typical)."""
+        baseline = self.latency_baselines.get(kind)
+        baseline = latency if baseline is None else baseline + self.baseline_alpha * (latency - baseline)
+        self.latency_baselines[kind] = baseline
+        return latency / baseline if baseline > 0 else 1.0
+
+    def record_response(self, instance: Dict[str, Any], status_code: int,
+                        headers: Optional[Mapping[str, str]], latency: float, kind: str = RESPONSE):
+        """
+        Rate-limit headers refresh the instance's budget. 429 opens the breaker for
+        the Retry-After period; 5xx counts as a failure; anything else means the
+        instance is healthy and its latency (of `kind`, RESPONSE or TTFT) is recorded.
+        """
+        breaker = self.breaker_for(instance)
+        budget = self.budget_for(instance)
+        limit = self.limit_for(instance)
+        budget.update_from_headers(headers)
+        if status_code == 429:
+            budget.exhaust()
+            breaker.record_failure(parse_retry_after(headers), throttled=True)
+            if limit is not None:
+                limit.on_throttled()
+        elif status_code >= 500:
+            breaker.record_failure(parse_retry_after(headers))
+        else:
+            breaker.record_success()
+            stats = self.stats_for(instance)
+            stats.observe(self.relative_latency(latency, kind), self.ewma_alpha, self.peak_tau, self.clock())
+            if limit is not None:
+                # Only stream TTFT feeds the latency signal: full response times vary with output length
+                limit.on_success(latency if kind == TTFT else None, stats.in_flight)
+        self.publish(instance)
+
+    def min_cooldown(self) -> float:
+        """Shortest remaining cooldown across all instances."""
+        return min((self.breaker_for(instance).remaining_cooldown() for instance in self.instances), default=0.0)
+
+    def next_recovery(self, instances: List[Dict[str, Any]]) -> float:
+        """Time until the first of `instances` whose breaker is open rejoins rotation (0 if none is open)."""
+        cooldowns = [self.breaker_for(instance).remaining_cooldown() for instance in instances]
+        return min((cooldown for cooldown in cooldowns if cooldown > 0), default=0.0)
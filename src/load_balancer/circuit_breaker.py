@@ -0,0 +1,122 @@
+import time
+from email.utils import parsedate_to_datetime
+from typing import Callable, Mapping, Optional
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def parse_retry_after(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+    """
+    Extract a cooldown in seconds from Azure throttling headers.
+
+    `retry-after-ms` (and its `x-ms-` variant) take precedence over `Retry-After`,
+    which may be either a number of seconds or an HTTP date.
+    """
+    if not headers:
+        return None
+    for name in ("retry-after-ms", "x-ms-retry-after-ms"):
+        value = headers.get(name)
+        if value:
+            try:
+                return max(float(value) / 1000.0, 0.0)
+            except ValueError:
+                pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """
+    Per-instance health state machine.
+
+    closed    -> traffic flows; consecutive failures are counted
+    open      -> instance is skipped until the cooldown expires
+    half_open -> a limited number of trial requests probe the instance;
+                 a success closes the circuit, a failure re-opens it
+
+    A 429 opens the circuit immediately for the duration given by Retry-After.
+    Other failures open it after `failure_threshold` consecutive errors, with an
+    exponentially growing cooldown when the instance keeps failing its probes.
+    """
+
+    def __init__(self, failure_threshold: int = 5, cooldown: float = 5.0, max_cooldown: float = 60.0,
+                 half_open_max_calls: int = 1, clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.half_open_max_calls = half_open_max_calls
+        self.clock = clock
+        self._state = CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0.0
+        self.trial_calls = 0
+
+    @property
+    def state(self) -> str:
+        if self._state == OPEN and self.clock() >= self.open_until:
+            self._state = HALF_OPEN
+            self.trial_calls = 0
+        return self._state
+
+    def is_available(self) -> bool:
+        """Whether the instance may be selected right now (does not consume a trial slot)."""
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN:
+            return self.trial_calls < self.half_open_max_calls
+        return False
+
+    def on_dispatch(self):
+        """Record that a request was sent to the instance; consumes a trial slot when half-open."""
+        if self.state == HALF_OPEN:
+            self.trial_calls += 1
+
+    def release(self):
+        """Give back a trial slot for a request that ended without an outcome (e.g. cancelled)."""
+        if self._state == HALF_OPEN:
+            self.trial_calls = max(self.trial_calls - 1, 0)
+
+    def remaining_cooldown(self) -> float:
+        if self.state != OPEN:
+            return 0.0
+        return max(self.open_until - self.clock(), 0.0)
+
+    def record_success(self):
+        if self.state == OPEN:
+            # A request sent before the circuit opened finished late; it must not cut the cooldown short
+            return
+        self._state = CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.trial_calls = 0
+
+    def record_failure(self, retry_after: Optional[float] = None, throttled: bool = False):
+        state = self.state
+        if state == HALF_OPEN:
+            self.trial_calls = max(self.trial_calls - 1, 0)
+        self.failures += 1
+        if throttled or state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self._open(retry_after)
+
+    def _open(self, retry_after: Optional[float]):
+        if retry_after is not None:
+            cooldown = retry_after
+        else:
+            cooldown = min(self.cooldown * (2 ** self.trips), self.max_cooldown)
+        self.trips += 1
+        self._state = OPEN
+        self.open_until = self.clock() + cooldown
+        self.trial_calls = 0
@@ -0,0 +1,76 @@
+import time
+from typing import Optional
+
+
+class AdaptiveLimit:
+    """
+    Per-instance in-flight limit tuned by AIMD from the instance's own responses.
+
+    The limit grows additively (about +1 per `limit` successful responses) while
+    latency stays flat and the instance is actually being driven near the limit.
+    It shrinks multiplicatively on a 429 (`throttle_ratio`) or when latency inflates
+    (`latency_ratio`): a short EWMA of latency rising above `tolerance` times a long
+    EWMA, once `warmup` samples have been seen. Only one kind of latency may be fed
+    in (the balancer uses time to the first stream event, which tracks queueing at the
+    instance); responses of other kinds pass None and only count towards growth, since
+    mixing full response times of different output lengths inflates the short EWMA
+    without any overload.
+    A burst of 429s from requests dispatched together counts as one decrease: after a
+    cut, further decreases wait `decrease_interval` seconds.
+    """
+
+    __slots__ = ("limit", "min_limit", "max_limit", "throttle_ratio", "latency_ratio", "tolerance",
+                 "short_alpha", "long_alpha", "decrease_interval", "warmup", "clock", "short_latency",
+                 "long_latency", "samples", "last_decrease")
+
+    def __init__(self, initial_limit: float = 20, min_limit: float = 1, max_limit: float = 500,
+                 throttle_ratio: float = 0.5, latency_ratio: float = 0.9, tolerance: float = 2.0,
+                 short_alpha: float = 0.2, long_alpha: float = 0.02, decrease_interval: float = 1.0,
+                 warmup: int = 20, clock=time.monotonic):
+        self.min_limit = max(min_limit, 1)
+        self.max_limit = max(max_limit, self.min_limit)
+        self.limit = float(min(max(initial_limit, self.min_limit), self.max_limit))
+        self.throttle_ratio = throttle_ratio
+        self.latency_ratio = latency_ratio
+        self.tolerance = tolerance
+        self.short_alpha = short_alpha
+        self.long_alpha = long_alpha
+        self.decrease_interval = decrease_interval
+        self.warmup = warmup
+        self.clock = clock
+        self.short_latency: Optional[float] = None
+        self.long_latency: Optional[float] = None
+        self.samples = 0
+        self.last_decrease = float("-inf")
+
+    def has_room(self, in_flight: int) -> bool:
+        return in_flight < int(self.limit)
+
+    def on_success(self, latency: Optional[float], in_flight: int):
+        """
+        A non-throttled response; `in_flight` includes the request that just completed.
+        `latency` is None for responses whose latency is not comparable (see above).
+        """
+        if latency is not None:
+            self.samples += 1
+            if self.short_latency is None:
+                self.short_latency = self.long_latency = latency
+                return
+            self.short_latency += self.short_alpha * (latency - self.short_latency)
+            self.long_latency += self.long_alpha * (latency - self.long_latency)
+            if self.samples > self.warmup and self.short_latency > self.long_latency * self.tolerance:
+                self._decrease(self.latency_ratio)
+                return
+        if in_flight * 2 >= self.limit:
+            # Only probe upwards when the current limit is actually in use
+            self.limit = min(self.limit + 1.0 / self.limit, self.max_limit)
+
+    def on_throttled(self):
+        self._decrease(self.throttle_ratio)
+
+    def _decrease(self, ratio: float):
+        now = self.clock()
+        if now - self.last_decrease < self.decrease_interval:
+            return
+        self.last_decrease = now
+        self.limit = max(self.limit * ratio, self.min_limit)
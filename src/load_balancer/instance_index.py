@@ -0,0 +1,100 @@
+from typing import Any, Dict, List, NamedTuple, Optional
+
+# Client headers that must not be forwarded to Azure
+EXCLUDED_HEADERS = frozenset(("host", "content-length", "connection", "accept-encoding"))
+
+_DEPLOYMENTS_PREFIX = "openai/deployments/"
+
+
+class RequestPath(NamedTuple):
+    """A client path normalized once per request."""
+
+    # Path below the host, always starting with "openai/", query string included
+    normalized: str
+    # Deployment name from /openai/deployments/<name>/..., None for other endpoints
+    deployment: Optional[str]
+    # Everything after the deployment segment (e.g. "/chat/completions?api-version=...")
+    suffix: str
+
+
+def parse_path(path: str) -> RequestPath:
+    """
+    Normalize a client path to "openai/..." and extract the deployment name.
+
+    A leading slash is dropped and paths without the "openai/" prefix get it added,
+    matching what Azure OpenAI expects.
+    """
+    normalized = path[1:] if path.startswith("/") else path
+    if not normalized.startswith("openai/"):
+        normalized = f"openai/{normalized}"
+    if not normalized.startswith(_DEPLOYMENTS_PREFIX):
+        return RequestPath(normalized, None, "")
+    rest = normalized[len(_DEPLOYMENTS_PREFIX):]
+    end = len(rest)
+    for separator in ("/", "?"):
+        index = rest.find(separator)
+        if index != -1 and index < end:
+            end = index
+    return RequestPath(normalized, rest[:end] or None, rest[end:])
+
+
+class InstanceRoute:
+    """Precomputed URL prefixes and auth header for one instance."""
+
+    __slots__ = ("instance", "base_url", "headers", "deployments", "aliases", "deployment_urls")
+
+    def __init__(self, instance: Dict[str, Any]):
+        self.instance = instance
+        self.base_url = instance["url"].rstrip("/") + "/"
+        self.headers = {"api-key": instance["api_key"]}
+        deployments = instance.get("deployments")
+        self.deployments = frozenset(deployments) if deployments else None
+        self.aliases: Dict[str, str] = dict(instance.get("aliases") or {})
+        self.deployment_urls: Dict[str, str] = {}
+        for name in list(self.deployments or ()) + list(self.aliases):
+            self.deployment_urls[name] = f"{self.base_url}{_DEPLOYMENTS_PREFIX}{self.aliases.get(name, name)}"
+
+    def url_for(self, path: RequestPath) -> str:
+        if path.deployment is None:
+            return self.base_url + path.normalized
+        prefix = self.deployment_urls.get(path.deployment)
+        if prefix is None:
+            # Wildcard instance: the deployment name is used as is
+            return self.base_url + path.normalized
+        return prefix + path.suffix
+
+
+class InstanceIndex:
+    """
+    Deployment -> eligible instances, built once at startup.
+
+    Instances that list `deployments` (or `aliases`) only receive traffic for those
+    names; instances without a list are assumed to host every deployment.
+    """
+
+    def __init__(self, instances: List[Dict[str, Any]]):
+        self.instances = instances
+        self.routes: Dict[str, InstanceRoute] = {}
+        self.wildcard: List[Dict[str, Any]] = []
+        self.by_deployment: Dict[str, List[Dict[str, Any]]] = {}
+        for instance in instances:
+            route = self.routes[instance["name"]] = InstanceRoute(instance)
+            if route.deployment_urls:
+                for name in route.deployment_urls:
+                    self.by_deployment.setdefault(name, []).append(instance)
+            else:
+                self.wildcard.append(instance)
+        for eligible in self.by_deployment.values():
+            eligible.extend(self.wildcard)
+
+    def eligible(self, deployment: Optional[str]) -> List[Dict[str, Any]]:
+        if deployment is None:
+            return self.instances
+        return self.by_deployment.get(deployment, self.wildcard)
+
+    def route(self, instance: Dict[str, Any]) -> InstanceRoute:
+        route = self.routes.get(instance["name"])
+        if route is None or route.instance is not instance:
+            # Leased before a config reload replaced or removed the instance
+            route = InstanceRoute(instance)
+        return route
@@ -0,0 +1,117 @@
+import time
+from typing import Callable, Mapping, Optional, Tuple
+
+
+def _header_number(headers: Mapping[str, str], name: str) -> Optional[float]:
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+class _Bucket:
+    """
+    One rate-limit dimension (tokens or requests per minute).
+
+    `remaining` is taken from the latest Azure header and refills linearly at
+    limit/60 per second until the next header arrives. When Azure does not send
+    the limit itself, the largest `remaining` ever observed stands in for it.
+    Local reservations are subtracted at dispatch so that concurrent requests do
+    not all spend the same stale headroom.
+    """
+
+    __slots__ = ("remaining", "limit", "updated")
+
+    def __init__(self):
+        self.remaining: Optional[float] = None
+        self.limit: Optional[float] = None
+        self.updated = 0.0
+
+    def update(self, remaining: Optional[float], limit: Optional[float], now: float):
+        if limit is not None:
+            self.limit = limit
+        if remaining is None:
+            return
+        if self.limit is None or remaining > self.limit:
+            self.limit = remaining
+        self.remaining = remaining
+        self.updated = now
+
+    def merge(self, state: Optional[Tuple[Optional[float], Optional[float], float]]):
+        """Adopt (remaining, limit, updated) from another worker when it is newer than ours."""
+        if state is None or state[2] <= self.updated:
+            return
+        self.remaining, limit, self.updated = state
+        if limit is not None:
+            self.limit = limit
+
+    def available(self, now: float) -> Optional[float]:
+        if self.remaining is None:
+            return None
+        refill = (self.limit or 0.0) / 60.0 * (now - self.updated)
+        return min(self.remaining + refill, self.limit or self.remaining)
+
+    def reserve(self, amount: float, now: float):
+        available = self.available(now)
+        if available is None:
+            return
+        self.remaining = available - amount
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        available = self.available(now)
+        if available is None or available >= amount:
+            return 0.0
+        rate = (self.limit or 0.0) / 60.0
+        if rate <= 0:
+            return 60.0
+        # A request larger than the whole limit can only be admitted once the bucket is full
+        return (min(amount, self.limit) - available) / rate
+
+
+class RateLimitBudget:
+    """Per-instance TPM/RPM headroom built from Azure's x-ratelimit-* response headers."""
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self.clock = clock
+        self.tokens = _Bucket()
+        self.requests = _Bucket()
+
+    def update_from_headers(self, headers: Optional[Mapping[str, str]]):
+        if not headers:
+            return
+        now = self.clock()
+        self.tokens.update(
+            _header_number(headers, "x-ratelimit-remaining-tokens"),
+            _header_number(headers, "x-ratelimit-limit-tokens"),
+            now
+        )
+        self.requests.update(
+            _header_number(headers, "x-ratelimit-remaining-requests"),
+            _header_number(headers, "x-ratelimit-limit-requests"),
+            now
+        )
+
+    def wait_time(self, tokens: float) -> float:
+        """Seconds until a request costing `tokens` fits; 0 when it fits now or the budget is unknown."""
+        now = self.clock()
+        return max(self.tokens.wait_time(tokens, now), self.requests.wait_time(1, now))
+
+    def can_admit(self, tokens: float) -> bool:
+        return self.wait_time(tokens) == 0.0
+
+    def reserve(self, tokens: float):
+        now = self.clock()
+        self.tokens.reserve(tokens, now)
+        self.requests.reserve(1, now)
+
+    def exhaust(self):
+        """A 429 means the headroom is gone regardless of what the last headers said."""
+        now = self.clock()
+        for bucket in (self.tokens, self.requests):
+            if bucket.remaining is not None:
+                bucket.remaining = 0.0
+                bucket.updated = now
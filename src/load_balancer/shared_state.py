@@ -0,0 +1,194 @@
+import fcntl
+import mmap
+import os
+import struct
+import tempfile
+import time
+import zlib
+from typing import Iterable, List, Optional, Tuple
+
+# Environment variable through which the launcher hands the segment path to its workers
+SHARED_STATE_ENV = "LB_SHARED_STATE"
+
+_MAGIC = b"AOAILB01"
+# magic, worker slots, instances, fingerprint of the instance names
+_HEADER = struct.Struct("<8sQQQ")
+_PID = struct.Struct("<Q")
+# seq, open_until, in_flight, then (remaining, limit, updated) for tokens and requests
+_SLOT = struct.Struct("<Qdqdddddd")
+_SEQ = struct.Struct("<Q")
+_OPEN_UNTIL = struct.Struct("<d")
+_IN_FLIGHT = struct.Struct("<q")
+_BUCKETS = struct.Struct("<dddddd")
+_BUCKETS_OFFSET = 8 + 8 + 8
+_NAN = float("nan")
+# How often (seconds) a worker re-checks which peer processes are still alive
+PEER_CHECK_INTERVAL = 1.0
+
+
+def _fingerprint(names: Iterable[str]) -> int:
+    return zlib.crc32("\0".join(names).encode())
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+BucketState = Tuple[Optional[float], Optional[float], float]
+
+
+class SharedState:
+    """
+    Routing state shared by the worker processes of one deployment.
+
+    The segment is an mmap-backed file with a fixed layout: a header, one pid per
+    worker slot, then for every (worker, instance) pair a record holding the
+    breaker's open-until time, the worker's in-flight count and its view of the
+    instance's token/request budget. Each worker writes only its own slot, so no
+    cross-process locks are needed on the hot path; records are written under a
+    sequence counter (seqlock) and readers retry when they catch a write in progress.
+    Times use the monotonic clock, which is system-wide on Linux.
+
+    A worker killed without `close()` leaves its pid and records behind until the slot
+    is claimed again; peers whose process is gone are left out of every sum. Liveness
+    is re-checked at most every `peer_check_interval` seconds, off the per-request path.
+    """
+
+    def __init__(self, path: str, buffer: mmap.mmap, workers: int, instances: int, slot: int):
+        self.path = path
+        self.buffer = buffer
+        self.workers = workers
+        self.instances = instances
+        self.slot = slot
+        self._pids_offset = _HEADER.size
+        self._records_offset = self._pids_offset + _PID.size * workers
+        self.peer_check_interval = PEER_CHECK_INTERVAL
+        self._live_peers: List[int] = []
+        self._peers_checked = float("-inf")
+
+    @staticmethod
+    def create(workers: int, names: List[str], path: Optional[str] = None) -> str:
+        """Create and zero a segment for `workers` processes routing to `names`; returns its path."""
+        if path is None:
+            directory = "/dev/shm" if os.path.isdir("/dev/shm") else None
+            fd, path = tempfile.mkstemp(prefix="aoai-lb-", suffix=".state", dir=directory)
+            os.close(fd)
+        size = _HEADER.size + _PID.size * workers + _SLOT.size * workers * len(names)
+        with open(path, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, workers, len(names), _fingerprint(names)))
+            f.write(b"\0" * (size - _HEADER.size))
+        return path
+
+    @classmethod
+    def attach(cls, path: str, names: List[str]) -> "SharedState":
+        """
+        Map an existing segment and claim a free worker slot (one whose process is gone).
+
+        Raises ValueError when the segment was created for a different instance list.
+        """
+        with open(path, "r+b") as f:
+            buffer = mmap.mmap(f.fileno(), 0)
+            magic, workers, instances, fingerprint = _HEADER.unpack_from(buffer, 0)
+            if magic != _MAGIC or instances != len(names) or fingerprint != _fingerprint(names):
+                buffer.close()
+                raise ValueError(f"Shared state {path} was created for a different instance list")
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                state = cls(path, buffer, workers, instances, -1)
+                state.slot = state._claim_slot()
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        return state
+
+    def _claim_slot(self) -> int:
+        for slot in range(self.workers):
+            pid = self._pid(slot)
+            if pid == 0 or not _pid_alive(pid):
+                start = self._record_offset(slot, 0)
+                self.buffer[start:start + _SLOT.size * self.instances] = b"\0" * (_SLOT.size * self.instances)
+                _PID.pack_into(self.buffer, self._pids_offset + _PID.size * slot, os.getpid())
+                return slot
+        raise RuntimeError(f"No free worker slot in shared state {self.path} ({self.workers} slots)")
+
+    def _pid(self, slot: int) -> int:
+        return _PID.unpack_from(self.buffer, self._pids_offset + _PID.size * slot)[0]
+
+    def _record_offset(self, slot: int, index: int) -> int:
+        return self._records_offset + _SLOT.size * (slot * self.instances + index)
+
+    def _peers(self) -> List[int]:
+        now = time.monotonic()
+        if now - self._peers_checked >= self.peer_check_interval:
+            self._peers_checked = now
+            self._live_peers = [
+                slot for slot in range(self.workers)
+                if slot != self.slot and self._pid(slot) and _pid_alive(self._pid(slot))
+            ]
+        return self._live_peers
+
+    def publish(self, index: int, open_until: float, in_flight: int,
+                tokens: BucketState, requests: BucketState):
+        """Write this worker's view of instance `index` into its own slot."""
+        offset = self._record_offset(self.slot, index)
+        seq = _SEQ.unpack_from(self.buffer, offset)[0]
+        _SEQ.pack_into(self.buffer, offset, seq + 1)
+        _SLOT.pack_into(
+            self.buffer, offset, seq + 1, open_until, in_flight,
+            _NAN if tokens[0] is None else tokens[0], _NAN if tokens[1] is None else tokens[1], tokens[2],
+            _NAN if requests[0] is None else requests[0], _NAN if requests[1] is None else requests[1], requests[2],
+        )
+        _SEQ.pack_into(self.buffer, offset, seq + 2)
+
+    def open_until(self, index: int) -> float:
+        """Latest open-until time any other worker has published for the instance."""
+        latest = 0.0
+        for slot in self._peers():
+            value = _OPEN_UNTIL.unpack_from(self.buffer, self._record_offset(slot, index) + 8)[0]
+            if value > latest:
+                latest = value
+        return latest
+
+    def peer_in_flight(self, index: int) -> int:
+        """Requests other workers currently have outstanding on the instance."""
+        total = 0
+        for slot in self._peers():
+            total += _IN_FLIGHT.unpack_from(self.buffer, self._record_offset(slot, index) + 16)[0]
+        return max(total, 0)
+
+    def freshest_buckets(self, index: int) -> Tuple[Optional[BucketState], Optional[BucketState]]:
+        """The most recently updated token and request budgets published by other workers."""
+        best_tokens: Optional[BucketState] = None
+        best_requests: Optional[BucketState] = None
+        for slot in self._peers():
+            offset = self._record_offset(slot, index)
+            for _ in range(3):
+                before = _SEQ.unpack_from(self.buffer, offset)[0]
+                if before & 1:
+                    continue
+                values = _BUCKETS.unpack_from(self.buffer, offset + _BUCKETS_OFFSET)
+                if _SEQ.unpack_from(self.buffer, offset)[0] == before:
+                    break
+            else:
+                continue
+            tokens = (None if values[0] != values[0] else values[0], None if values[1] != values[1] else values[1], values[2])
+            requests = (None if values[3] != values[3] else values[3], None if values[4] != values[4] else values[4], values[5])
+            # updated == 0 means the peer has never seen rate-limit headers for the instance
+            if tokens[0] is not None and tokens[2] and (best_tokens is None or tokens[2] > best_tokens[2]):
+                best_tokens = tokens
+            if requests[0] is not None and requests[2] and (best_requests is None or requests[2] > best_requests[2]):
+                best_requests = requests
+        return best_tokens, best_requests
+
+    def close(self):
+        """Release the worker slot so a replacement worker can claim it."""
+        if self.slot >= 0 and not self.buffer.closed:
+            start = self._record_offset(self.slot, 0)
+            self.buffer[start:start + _SLOT.size * self.instances] = b"\0" * (_SLOT.size * self.instances)
+            _PID.pack_into(self.buffer, self._pids_offset + _PID.size * self.slot, 0)
+            self.buffer.close()
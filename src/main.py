@@ -1,82 +1,148 @@
-from fastapi import FastAPI, Request, HTTPException, Response, Depends, Header
+from fastapi import FastAPI, Request, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from src.middleware.auth_middleware import ApiKeyMiddleware
 from src.middleware.logging_middleware import LoggingMiddleware
 from src.config.settings import settings
+from src.services.admission import AdmissionController, AdmissionRejected, release_after_stream
+from src.services.config_watcher import ConfigWatcher
 from src.services.openai_service import OpenAIService
+from src.services.tenants import TenantRegistry
+from src.services.upstream_response import UpstreamResponse
+from src.utils import server_timing
+from src.utils.access_log import access_log
+from src.utils.logging_utils import setup_logging
+from src.utils.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, render_metrics
+from src.utils.request_body import ReplayableBody, sniff_stream
 import json
 import time
 import os
-from typing import Optional
+import weakref
 
-app = FastAPI()
+# 日志通过后台线程批量写出，不阻塞事件循环
+setup_logging()
 
-app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
-app.add_middleware(LoggingMiddleware)
+app = FastAPI()
 
 # 从环境变量获取API密钥
 API_KEY = os.environ.get("API_KEY", "")
 security = HTTPBearer()
 
-# 添加一个依赖函数来验证API密钥
-async def verify_api_key(authorization: Optional[str] = Header(None)):
-    if not API_KEY:
-        # 如果没有设置API密钥，则不执行验证
-        return False
-    
-    if not authorization:
-        raise HTTPException(
-            status_code=401, 
-            detail={"error": {"message": "认证失败: 缺少Authorization头", "code": "unauthorized"}}
-        )
-    
-    # 检查Authorization头的格式
-    parts = authorization.split()
-    if len(parts) != 2 or parts[0].lower() != "bearer":
-        raise HTTPException(
-            status_code=401, 
-            detail={"error": {"message": "认证失败: Authorization头格式不正确，应为'Bearer YOUR_API_KEY'", "code": "unauthorized"}}
-        )
-    
-    token = parts[1]
-    if token != API_KEY:
-        raise HTTPException(
-            status_code=401, 
-            detail={"error": {"message": "认证失败: API密钥无效", "code": "unauthorized"}}
-        )
-    
-    return True
+# 不需要认证的路径
+PUBLIC_PATHS = ("/health", "/openai/health", "/metrics", "/docs", "/docs/oauth2-redirect", "/redoc", "/openapi.json")
+
+# /admin 下的所有路径只接受管理密钥（ADMIN_API_KEY，未设置时与 API_KEY 相同），由认证中间件验证
+ADMIN_PREFIX = "/admin"
+
+# 租户密钥（各自有 RPM/TPM 配额），与 API_KEY 同时有效
+app.state.tenants = TenantRegistry.from_config(settings.get_tenant_keys())
+
+# 中间件均为纯 ASGI 实现，后添加的在外层：日志 -> CORS -> 认证
+app.add_middleware(ApiKeyMiddleware, api_key=API_KEY, exempt_paths=PUBLIC_PATHS,
+                   tenants=app.state.tenants, admin_prefix=ADMIN_PREFIX, admin_key=settings.get_admin_api_key)
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+app.add_middleware(LoggingMiddleware)
+
+# 准入控制不依赖事件循环，导入时即可创建
+app.state.admission = AdmissionController(**settings.get_admission_options())
 
 # 添加事件处理器
 @app.on_event("startup")
 async def startup_event():
     # 初始化服务
     app.state.openai_service = OpenAIService(settings.instances)
+    # 后台预热所有实例的连接并定期保活空闲连接池；预热完成前 /health 报告未就绪
+    app.state.openai_service.start()
+    # 实例来自配置文件时监视文件变化，热更新实例表
+    app.state.config_watcher = None
+    interval = settings.get_config_watch_interval()
+    if settings.config_path is not None and interval > 0:
+        app.state.config_watcher = ConfigWatcher(
+            settings.config_path, app.state.openai_service.update_instances, interval
+        )
+        app.state.config_watcher.start()
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    if getattr(app.state, "config_watcher", None) is not None:
+        await app.state.config_watcher.stop()
     # 关闭客户端连接
     await app.state.openai_service.close()
+    # 写出缓冲区中剩余的日志
+    access_log.close()
 
 # 添加在主路由前
 @app.get("/health")
 async def health_check():
-    """健康检查端点"""
+    """健康检查端点（就绪探针）：到各实例的连接预热完成前返回 503"""
+    service = getattr(app.state, "openai_service", None)
+    if service is not None and not service.ready:
+        return JSONResponse(status_code=503, content={"status": "warming_up", "timestamp": time.time()})
     return {"status": "ok", "timestamp": time.time()}
 
 @app.get("/openai/health")
 async def openai_health_check():
     """OpenAI路径健康检查端点"""
-    if not settings.instances:
+    service = getattr(app.state, "openai_service", None)
+    instances = service.instances if service is not None else settings.instances
+    if not instances:
         return Response(
             content=json.dumps({"status": "warning", "message": "No OpenAI instances configured"}),
             status_code=200,
             media_type="application/json"
         )
-    return {"status": "ok", "instances_count": len(settings.instances)}
+    return {"status": "ok", "instances_count": len(instances)}
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus 指标端点"""
+    collectors = app.state.admission.collectors() + access_log.collectors() + app.state.tenants.collectors()
+    service = getattr(app.state, "openai_service", None)
+    if service is not None:
+        collectors += service.metrics.collectors()
+    return Response(content=render_metrics(collectors), media_type=METRICS_CONTENT_TYPE)
+
+# 管理接口的认证由 ApiKeyMiddleware 完成（见 ADMIN_PREFIX）
+@app.get("/admin/instances")
+async def list_instances():
+    """列出当前实例及其熔断状态和在途请求数（不包含密钥）"""
+    service = app.state.openai_service
+    return {"instances": [
+        {
+            "name": instance["name"],
+            "url": instance["url"],
+            "deployments": instance.get("deployments"),
+            "weight": instance.get("weight", 1),
+            "circuit_state": service.balancer.breaker_for(instance).state,
+            "in_flight": service.balancer.stats_for(instance).in_flight,
+        }
+        for instance in service.instances
+    ]}
+
+@app.put("/admin/instances")
+async def replace_instances(request: Request):
+    """用请求体 {"instances": [...]} 替换实例表"""
+    try:
+        instances = settings.parse_instances(await request.json())
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"detail": {"error": {"message": str(e), "code": "invalid_config"}}})
+    return await app.state.openai_service.update_instances(instances)
+
+@app.post("/admin/instances/reload")
+async def reload_instances():
+    """重新读取实例配置文件"""
+    if settings.config_path is None:
+        return JSONResponse(status_code=409, content={"detail": {"error": {
+            "message": "实例不是从配置文件加载的", "code": "no_config_file"}}})
+    try:
+        instances = settings.load_instances_file(settings.config_path)
+    except (OSError, ValueError) as e:
+        return JSONResponse(status_code=400, content={"detail": {"error": {"message": str(e), "code": "invalid_config"}}})
+    return await app.state.openai_service.update_instances(instances)
 
 @app.api_route("/{full_path:path}", methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "HEAD", "PATCH"])
-async def forward_any_request(full_path: str, request: Request, authenticated: bool = Depends(verify_api_key)):
+async def forward_any_request(full_path: str, request: Request):
     """
     完全透传API请求到 Azure OpenAI 后端
     
@@ -85,8 +151,21 @@ async def forward_any_request(full_path: str, request: Request, authenticated: b
     将被转发到后端的：
     https://{instance_url}/openai/deployments/gpt4o/chat/completions?api-version=2025-01-01-preview
     
-    需要通过 Authorization: Bearer YOUR_API_KEY 头进行认证
+    需要通过 Authorization: Bearer YOUR_API_KEY 头进行认证（由 ApiKeyMiddleware 验证）
     """
+    # 管理路径上未定义的方法和子路径不转发到上游（否则会带着实例的 api-key 发出去）
+    if request.url.path == ADMIN_PREFIX or request.url.path.startswith(ADMIN_PREFIX + "/"):
+        return JSONResponse(status_code=405, content={"detail": {"error": {
+            "message": f"管理接口不支持 {request.method} {request.url.path}", "code": "method_not_allowed"}}})
+    # 准入控制：在读取请求体之前排队，过载时快速拒绝，避免缓存大量请求体
+    try:
+        ticket = await app.state.admission.acquire(app.state.admission.priority_for(request.headers))
+    except AdmissionRejected as e:
+        return JSONResponse(**e.to_response_args())
+    server_timing.record("queue", ticket.queued_seconds)
+    
+    # 流式响应接管准入名额后，由响应结束时归还
+    ticket_handed_off = False
     try:
         # 获取查询参数
         query_string = request.url.query
@@ -97,60 +176,81 @@ async def forward_any_request(full_path: str, request: Request, authenticated: b
             complete_path = f"{full_path}?{query_string}"
 
         # 获取请求体 (如果有)
-        request_body = {}
+        # 请求体按原始字节透传，不做 JSON 解析和重新编码
+        request_body = b""
         if request.method in ["POST", "PUT", "PATCH"]:
-            try:
-                request_body = await request.json()
-            except:
-                # 如果不是JSON格式，尝试获取原始内容
+            content_type = request.headers.get("content-type", "")
+            if not content_type or "json" in content_type:
                 request_body = await request.body()
+            else:
+                # 文件上传等非 JSON 请求体边读边转发到上游
+                content_length = request.headers.get("content-length")
+                request_body = ReplayableBody(
+                    request.stream(),
+                    content_length=int(content_length) if content_length and content_length.isdigit() else None
+                )
                 
         # 获取请求头
         headers = dict(request.headers)
         
-        # 检查是否为流式请求
+        # 检查是否为流式请求（只扫描原始字节中的 "stream" 字段）
         is_streaming = False
-        if request.method == "POST" and isinstance(request_body, dict) and request_body.get("stream") == True:
+        if request.method == "POST" and isinstance(request_body, bytes) and sniff_stream(request_body):
             is_streaming = True
         
         # 根据请求类型选择转发方法
         if is_streaming:
-            return await app.state.openai_service.forward_streaming_request(
+            response = await app.state.openai_service.forward_streaming_request(
                 method=request.method,
                 path=complete_path,
                 body=request_body,
                 headers=headers
             )
+            if isinstance(response, StreamingResponse):
+                # 流式响应结束后才归还准入名额
+                response.body_iterator = release_after_stream(response.body_iterator, ticket)
+                weakref.finalize(response, ticket.release)
+                ticket_handed_off = True
+            return response
         else:
             response = await app.state.openai_service.forward_full_request(
                 method=request.method,
                 path=complete_path,
                 body=request_body,
-                headers=headers
+                headers=headers,
+                raw=True
             )
             
-        # 检查是否有错误响应
-        if isinstance(response, dict) and "error" in response:
-            # 从错误响应中提取状态码
-            status_code = response.get("_azure_openai_status_code", 500)
-            # 删除我们添加的元数据字段，保持原始响应格式
-            if "_azure_openai_status_code" in response:
-                del response["_azure_openai_status_code"]
-            if "_azure_openai_instance" in response:
-                del response["_azure_openai_instance"]
-                
-            # 返回原始状态码和错误响应
+        # 按上游的原始字节、状态码和响应头（限流额度、请求 ID 等）返回，不重新编码 JSON
+        if isinstance(response, UpstreamResponse):
             return Response(
-                content=json.dumps(response),
-                status_code=status_code,
-                media_type="application/json"
+                content=response.content,
+                status_code=response.status_code,
+                headers=response.headers
             )
         
         return response
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if not ticket_handed_off:
+            ticket.release()
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    workers = settings.get_workers()
+    if workers > 1:
+        # 多 worker：先创建共享状态段，worker 进程启动时通过环境变量找到它
+        from src.load_balancer.shared_state import SHARED_STATE_ENV, SharedState
+        names = [instance["name"] for instance in settings.instances]
+        state_path = SharedState.create(workers, names)
+        os.environ[SHARED_STATE_ENV] = state_path
+        try:
+            uvicorn.run("src.main:app", host="0.0.0.0", port=8000, workers=workers)
+        finally:
+            os.remove(state_path)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
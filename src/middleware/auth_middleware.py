@@ -0,0 +1,156 @@
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from src.services.metrics import UsageReader
+from src.services.tenants import Tenant, TenantRegistry
+from src.utils.tokens import estimate_request_tokens
+from typing import Callable, Collection, Optional, Tuple
+import hmac
+import math
+
+class ApiKeyMiddleware:
+    """
+    纯 ASGI 的 API 密钥认证中间件
+
+    要求 Authorization: Bearer YOUR_API_KEY，失败时返回 401，响应格式与原先的
+    FastAPI 依赖（HTTPException）一致。api_key 和 tenants 都为空时不做验证；exempt_paths 中的
+    路径（健康检查、指标等）不需要认证。
+
+    以 admin_prefix 开头的管理路径只接受 admin_key() 返回的管理密钥（每次请求时读取），
+    不接受 api_key 和租户密钥；admin_key() 为空时管理路径一律返回 403。
+
+    tenants 中的租户密钥各自有 RPM/TPM 配额：超出配额的请求在进入上游之前以 429 拒绝。
+    JSON 请求体读完后按估算预扣 token，响应体中出现 usage 时按实际用量多退少补（见 Tenant）。
+    共享的 api_key 不受租户配额限制。
+    """
+
+    def __init__(self, app: ASGIApp, api_key: str = "", exempt_paths: Collection[str] = (),
+                 tenants: Optional[TenantRegistry] = None, admin_prefix: Optional[str] = None,
+                 admin_key: Callable[[], str] = lambda: ""):
+        self.app = app
+        self.api_key = api_key.encode() if api_key else b""
+        self.exempt_paths = frozenset(exempt_paths)
+        self.tenants = tenants if tenants else None
+        self.admin_prefix = admin_prefix.rstrip("/") if admin_prefix else None
+        self.admin_key = admin_key
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http" and self.is_admin_path(scope["path"]):
+            await self._admin(scope, receive, send)
+            return
+        if scope["type"] != "http" or not (self.api_key or self.tenants) or scope["path"] in self.exempt_paths:
+            await self.app(scope, receive, send)
+            return
+
+        error, tenant = self._check(scope)
+        if error is not None:
+            response = JSONResponse(
+                status_code=401,
+                content={"detail": {"error": {"message": error, "code": "unauthorized"}}}
+            )
+            await response(scope, receive, send)
+            return
+        if tenant is None:
+            await self.app(scope, receive, send)
+            return
+
+        wait = tenant.admit()
+        if wait > 0:
+            response = JSONResponse(
+                status_code=429,
+                content={"error": {"message": f"超出配额: 租户 {tenant.name} 的 RPM/TPM 额度已用完",
+                                   "code": "tenant_quota_exceeded"}},
+                headers={"Retry-After": str(max(math.ceil(wait), 1))}
+            )
+            await response(scope, receive, send)
+            return
+        # 访问日志记录租户名
+        scope["tenant"] = tenant.name
+
+        path = scope["path"]
+        capture = _has_json_body(scope)
+        body_parts = []
+        reserved = 0
+        failed = False
+        usage = UsageReader()
+
+        async def receive_with_estimate() -> Message:
+            nonlocal capture, reserved
+            message = await receive()
+            if capture and message["type"] == "http.request":
+                body_parts.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    capture = False
+                    reserved = tenant.reserve(estimate_request_tokens(b"".join(body_parts), path))
+                    body_parts.clear()
+            return message
+
+        async def send_with_usage(message: Message):
+            nonlocal reserved, failed
+            if message["type"] == "http.response.start":
+                failed = message["status"] >= 400
+            elif message["type"] == "http.response.body":
+                # 非流式响应的 usage 在响应体中，流式响应在最后的分块中（可能跨越两个分块）
+                found = usage.feed(message.get("body", b""))
+                if found is not None:
+                    tenant.charge(found[0], found[1], reserved=reserved)
+                    reserved = 0
+                elif not message.get("more_body", False):
+                    tenant.settle(reserved, failed)
+                    reserved = 0
+            await send(message)
+
+        await self.app(scope, receive_with_estimate, send_with_usage)
+
+    def is_admin_path(self, path: str) -> bool:
+        prefix = self.admin_prefix
+        return prefix is not None and (path == prefix or path.startswith(prefix + "/"))
+
+    async def _admin(self, scope: Scope, receive: Receive, send: Send):
+        """管理路径只用管理密钥认证，不会因为 api_key 为空或路径豁免而放行"""
+        admin_key = self.admin_key()
+        if not admin_key:
+            response = JSONResponse(status_code=403, content={"detail": {"error": {
+                "message": "管理接口未启用: 请设置 ADMIN_API_KEY 或 API_KEY", "code": "admin_disabled"}}})
+            await response(scope, receive, send)
+            return
+        authorization = b""
+        for name, value in scope["headers"]:
+            if name == b"authorization":
+                authorization = value
+                break
+        parts = authorization.split()
+        if len(parts) != 2 or parts[0].lower() != b"bearer" or not hmac.compare_digest(parts[1], admin_key.encode()):
+            response = JSONResponse(status_code=401, content={"detail": {"error": {
+                "message": "认证失败: 管理密钥无效", "code": "unauthorized"}}})
+            await response(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+    def _check(self, scope: Scope) -> Tuple[Optional[str], Optional[Tenant]]:
+        authorization = None
+        for name, value in scope["headers"]:
+            if name == b"authorization":
+                authorization = value
+                break
+        if not authorization:
+            return "认证失败: 缺少Authorization头", None
+
+        # 检查Authorization头的格式
+        parts = authorization.split()
+        if len(parts) != 2 or parts[0].lower() != b"bearer":
+            return "认证失败: Authorization头格式不正确，应为'Bearer YOUR_API_KEY'", None
+
+        if self.api_key and hmac.compare_digest(parts[1], self.api_key):
+            return None, None
+        tenant = self.tenants.lookup(parts[1]) if self.tenants is not None else None
+        if tenant is None:
+            return "认证失败: API密钥无效", None
+        return None, tenant
+
+
+def _has_json_body(scope: Scope) -> bool:
+    """与代理路由相同：没有 content-type 或为 JSON 的请求体才读入内存，文件上传等不参与估算"""
+    for name, value in scope["headers"]:
+        if name == b"content-type":
+            return b"json" in value
+    return True
@@ -1,25 +1,67 @@
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.requests import Request
-from starlette.responses import Response
-import logging
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from src.utils import server_timing
+from src.utils.access_log import AccessLog, access_log
+from src.utils.server_timing import ServerTiming
+from typing import Optional
 import time
 
-class LoggingMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app):
-        super().__init__(app)
-        logging.basicConfig(level=logging.INFO)
-        self.logger = logging.getLogger("LoggingMiddleware")
+class LoggingMiddleware:
+    """
+    纯 ASGI 的请求日志中间件
 
-    async def dispatch(self, request: Request, call_next):
-        start_time = time.time()
-        self.logger.info(f"Request: {request.method} {request.url}")
+    只观察 http.response.start / http.response.body 消息，不缓冲也不另起任务转发响应体，
+    因此流式响应的耗时和字节数是整个流发送完毕时的真实值。
+    同时在响应头中加入 Server-Timing（排队、上游建连、上游首字节等阶段）。
+    每个请求结束时写一条结构化访问日志，写出由 AccessLog 的后台线程完成。
+    """
 
+    def __init__(self, app: ASGIApp, log: Optional[AccessLog] = None):
+        self.app = app
+        self.log = log or access_log
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start_time = time.perf_counter()
+        timing = ServerTiming()
+        token = server_timing.bind(timing)
+        status_code = None
+        bytes_sent = 0
+
+        async def send_wrapper(message: Message):
+            nonlocal status_code, bytes_sent
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                timing.set("app", time.perf_counter() - start_time)
+                headers = list(message.get("headers", ()))
+                headers.append((b"server-timing", timing.header_value().encode("latin-1")))
+                message = {**message, "headers": headers}
+            elif message["type"] == "http.response.body":
+                bytes_sent += len(message.get("body", b""))
+            await send(message)
+
+        error = None
         try:
-            response: Response = await call_next(request)
-            duration = time.time() - start_time
-            self.logger.info(f"Response: {response.status_code} in {duration:.2f} seconds")
-            return response
+            await self.app(scope, receive, send_wrapper)
         except Exception as e:
-            duration = time.time() - start_time
-            self.logger.error(f"Error: {str(e)} in {duration:.2f} seconds")
-            raise e
\ No newline at end of file
+            error = e
+            raise
+        finally:
+            server_timing.unbind(token)
+            query_string = scope.get("query_string", b"")
+            fields = {
+                "method": scope["method"],
+                "path": scope["path"] + ("?" + query_string.decode("latin-1") if query_string else ""),
+                "status": status_code,
+                "duration_ms": round((time.perf_counter() - start_time) * 1000, 2),
+                "bytes_sent": bytes_sent,
+                "timings_ms": {name: round(seconds * 1000, 2) for name, seconds in timing.durations.items()},
+            }
+            if "tenant" in scope:
+                fields["tenant"] = scope["tenant"]
+            if error is not None:
+                self.log.log("request", level="error", error=str(error), **fields)
+            else:
+                self.log.log("request", level="info" if status_code and status_code < 400 else "warning", **fields)
@@ -0,0 +1,166 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from typing import Any, AsyncIterator, Dict, List, Mapping, Optional, Tuple
+
+from src.utils.metrics import QUEUE_BUCKETS, CallbackMetric, Counter, Histogram
+
+# 优先级数值越小越先处理
+PRIORITY_CLASSES = {"interactive": 0, "default": 1, "batch": 2}
+
+
+class AdmissionRejected(Exception):
+    """请求在进入上游之前被准入控制拒绝"""
+
+    def __init__(self, status_code: int, message: str, retry_after: float):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+        self.retry_after = retry_after
+
+    def to_response_args(self) -> Dict[str, object]:
+        return {
+            "content": {"error": {"message": self.message, "code": "server_overloaded"}},
+            "status_code": self.status_code,
+            "headers": {"Retry-After": str(max(math.ceil(self.retry_after), 1))},
+        }
+
+
+class AdmissionTicket:
+    """一个已获准的请求占用的并发名额，release 可重复调用"""
+
+    __slots__ = ("controller", "priority", "queued_seconds", "released")
+
+    def __init__(self, controller: "AdmissionController", priority: int, queued_seconds: float):
+        self.controller = controller
+        self.priority = priority
+        self.queued_seconds = queued_seconds
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller._release()
+
+
+class AdmissionController:
+    """
+    位于 OpenAIService 之前的准入控制
+
+    - 最多同时处理 max_concurrency 个请求，其余请求进入有界等待队列
+    - 队列按优先级出队（interactive 先于 default 先于 batch），同优先级先进先出
+    - 队列已满时立即以 429 拒绝；如果新请求优先级更高，则挤掉队列中优先级最低的请求
+    - 在队列中等待超过 queue_timeout 的请求以 503 拒绝
+
+    max_concurrency 为 0 时不做任何限制。
+    """
+
+    def __init__(self, max_concurrency: int = 0, max_queue: int = 0, queue_timeout: float = 10.0,
+                 priority_header: str = "x-priority", key_priorities: Optional[Dict[str, str]] = None):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.priority_header = priority_header.lower()
+        self.key_priorities = {
+            key: PRIORITY_CLASSES.get(name, PRIORITY_CLASSES["default"])
+            for key, name in (key_priorities or {}).items()
+        }
+        self.active = 0
+        self.queued = 0
+        self._queue: List[Tuple[int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self.queue_wait = Histogram("lb_admission_queue_wait_seconds", "Time admitted requests waited in the queue",
+                                    ("priority",), QUEUE_BUCKETS)
+        self.rejected = Counter("lb_admission_rejected_total", "Requests rejected by admission control", ("status",))
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_concurrency > 0
+
+    def priority_for(self, headers: Mapping[str, str]) -> int:
+        """按 API 密钥的配置优先，其次按优先级请求头确定优先级"""
+        if self.key_priorities:
+            parts = (headers.get("authorization") or "").split()
+            if len(parts) == 2 and parts[1] in self.key_priorities:
+                return self.key_priorities[parts[1]]
+        # 请求头只接受优先级类名；数字或其他取值按 default 处理，客户端不能排到 interactive 前面
+        value = (headers.get(self.priority_header) or "").strip().lower()
+        return PRIORITY_CLASSES.get(value, PRIORITY_CLASSES["default"])
+
+    async def acquire(self, priority: int = PRIORITY_CLASSES["default"]) -> AdmissionTicket:
+        if not self.enabled or (self.active < self.max_concurrency and not self.queued):
+            self.active += 1
+            return AdmissionTicket(self, priority, 0.0)
+
+        if self.queued >= self.max_queue:
+            self._evict_lower_than(priority)
+
+        started = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._sequence), future))
+        self.queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled() and not future.exception():
+                # 超时的同时刚好拿到名额，不能丢掉这个名额
+                return self._admitted(priority, started)
+            future.cancel()
+            self.rejected.inc((503,))
+            raise AdmissionRejected(503, "Request timed out waiting in the admission queue", self.queue_timeout)
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and not future.exception():
+                self._release()
+            future.cancel()
+            raise
+        finally:
+            self.queued -= 1
+        return self._admitted(priority, started)
+
+    def _admitted(self, priority: int, started: float) -> AdmissionTicket:
+        queued_seconds = time.monotonic() - started
+        self.queue_wait.observe((priority,), queued_seconds)
+        return AdmissionTicket(self, priority, queued_seconds)
+
+    def _evict_lower_than(self, priority: int):
+        """队列已满：挤掉优先级最低且晚于新请求优先级的等待者，否则拒绝新请求"""
+        victim = None
+        for entry in self._queue:
+            if entry[2].done():
+                continue
+            if victim is None or (entry[0], entry[1]) > (victim[0], victim[1]):
+                victim = entry
+        self.rejected.inc((429,))
+        if victim is None or victim[0] <= priority:
+            raise AdmissionRejected(429, "Admission queue is full", self.queue_timeout)
+        victim[2].set_exception(AdmissionRejected(429, "Shed by higher priority traffic", self.queue_timeout))
+
+    def collectors(self) -> List[Any]:
+        return [
+            self.queue_wait,
+            self.rejected,
+            CallbackMetric("lb_admission_active_requests", "Requests holding an admission slot", (),
+                           lambda: [((), self.active)]),
+            CallbackMetric("lb_admission_queued_requests", "Requests waiting in the admission queue", (),
+                           lambda: [((), self.queued)]),
+        ]
+
+    def _release(self):
+        # 名额直接转交给队列中优先级最高的等待者
+        while self._queue:
+            _, _, future = heapq.heappop(self._queue)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+
+async def release_after_stream(iterator: AsyncIterator[bytes], ticket: AdmissionTicket) -> AsyncIterator[bytes]:
+    """流式响应发送完毕（或客户端断开）后归还准入名额"""
+    try:
+        async for chunk in iterator:
+            yield chunk
+    finally:
+        ticket.release()
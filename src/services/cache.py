@@ -0,0 +1,141 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+from src.services.upstream_response import UpstreamResponse
+from src.utils.request_body import sniff_json_scalar
+
+# 请求头 x-lb-cache: bypass 不读也不写缓存；refresh 跳过读取但写入新结果
+CACHE_CONTROL_HEADER = "x-lb-cache"
+
+
+def is_cacheable(method: str, path: str, body: Any) -> bool:
+    """只缓存结果确定的请求：embeddings，以及 temperature 为 0 的非流式请求"""
+    if method != "POST" or not isinstance(body, (bytes, bytearray)) or not body:
+        return False
+    if "/embeddings" in path:
+        return True
+    temperature = sniff_json_scalar(body, "temperature")
+    if temperature is None:
+        return False
+    try:
+        return float(temperature) == 0.0
+    except ValueError:
+        return False
+
+
+def cache_key(path: str, body: bytes) -> Optional[str]:
+    """deployment 路径 + 规范化请求体（键排序、紧凑格式）的哈希，字段顺序和空白不影响命中"""
+    try:
+        canonical = json.dumps(json.loads(body), sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    except ValueError:
+        return None
+    digest = hashlib.sha256(path.encode())
+    digest.update(b"\0")
+    digest.update(canonical.encode())
+    return digest.hexdigest()
+
+
+def _encode(value: Any) -> bytes:
+    if isinstance(value, UpstreamResponse):
+        return value.to_bytes()
+    return json.dumps(value, ensure_ascii=False).encode()
+
+
+def _decode(data: bytes) -> Any:
+    if UpstreamResponse.is_serialized(data):
+        return UpstreamResponse.from_bytes(data)
+    return json.loads(data)
+
+
+class ResponseCache:
+    """
+    响应缓存：内存中按条数和字节数限制的 LRU（带 TTL），可选 SQLite 磁盘层
+
+    值通常是 UpstreamResponse（按原始字节保存），也可以是任意可 JSON 编码的对象。
+    磁盘层在重启后依然有效；内存未命中时查询磁盘，命中后提升回内存。
+    磁盘读写在线程池中执行，不阻塞事件循环。
+    """
+
+    def __init__(self, max_entries: int = 10000, max_bytes: int = 256 * 1024 * 1024,
+                 ttl: float = 3600.0, path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries: "OrderedDict[str, Tuple[float, Any, int]]" = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_writes = 0
+        self.db: Optional[sqlite3.Connection] = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS response_cache (key TEXT PRIMARY KEY, value BLOB, expires REAL)")
+            self.db_lock = asyncio.Lock()
+
+    async def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self._remove(key)
+        if self.db is not None:
+            row = await self._db_call("SELECT value, expires FROM response_cache WHERE key = ?", (key,))
+            if row and row[1] > now:
+                value = _decode(row[0])
+                self._store(key, value, len(row[0]), row[1])
+                self.hits += 1
+                self.disk_hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value: Any):
+        expires = time.time() + self.ttl
+        if self.db is None and isinstance(value, UpstreamResponse):
+            # 只有内存层时不需要序列化，按响应体大小计算
+            self._store(key, value, len(value.content), expires)
+            return
+        encoded = _encode(value)
+        self._store(key, value, len(encoded), expires)
+        if self.db is not None:
+            await self._db_call(
+                "INSERT OR REPLACE INTO response_cache (key, value, expires) VALUES (?, ?, ?)",
+                (key, encoded, expires)
+            )
+            self.disk_writes += 1
+            if self.disk_writes % 1000 == 0:
+                # 定期清理磁盘上过期的条目
+                await self._db_call("DELETE FROM response_cache WHERE expires <= ?", (time.time(),))
+
+    def _store(self, key: str, value: Any, size: int, expires: float):
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (expires, value, size)
+        self.total_bytes += size
+        while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key: str):
+        _, _, size = self.entries.pop(key)
+        self.total_bytes -= size
+
+    async def _db_call(self, sql: str, params: tuple):
+        async with self.db_lock:
+            return await asyncio.to_thread(lambda: self.db.execute(sql, params).fetchone())
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
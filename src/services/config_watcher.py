@@ -0,0 +1,69 @@
+import asyncio
+import os
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from src.config.settings import settings
+from src.utils.access_log import access_log
+
+
+class ConfigWatcher:
+    """
+    定期检查实例配置文件，变化时交给 on_change 热更新
+
+    通过比较文件的修改时间和大小发现变化，不依赖文件系统通知，
+    挂载的 ConfigMap（符号链接替换）和普通文件都适用。
+    解析、校验或应用失败时保留当前实例表并记录错误，下次文件变化时再试。
+    """
+
+    def __init__(self, path: Path, on_change: Callable[[List[Dict[str, Any]]], Awaitable[Any]],
+                 interval: float = 5.0):
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        self._signature = self._stat()
+        self._task: Optional[asyncio.Task] = None
+
+    def _stat(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.check()
+
+    async def check(self) -> bool:
+        """文件有变化时重新加载；返回是否应用了新的实例表"""
+        signature = self._stat()
+        if signature is None or signature == self._signature:
+            return False
+        self._signature = signature
+        try:
+            instances = settings.load_instances_file(self.path)
+        except (OSError, ValueError) as e:
+            access_log.log("config_reload_failed", level="error", path=str(self.path), error=str(e))
+            return False
+        try:
+            await self.on_change(instances)
+        except Exception as e:
+            # 更新实例表或预热连接池失败不能结束后台任务，否则之后的修改都不会再生效
+            access_log.log("config_reload_failed", level="error", path=str(self.path), error=repr(e))
+            return False
+        return True
@@ -0,0 +1,137 @@
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+Origin = Tuple[str, str, Optional[int]]
+
+# 请求扩展中带有此键时，请求通过其中的（尚未安装的）连接池发送，用于预热
+STAGED_POOL_EXTENSION = "lb.staged_pool"
+
+
+def origin_of(url: Any) -> Origin:
+    url = httpx.URL(url) if not isinstance(url, httpx.URL) else url
+    return url.scheme, url.host, url.port
+
+
+def _default_factory(options: Dict[str, Any]) -> httpx.AsyncBaseTransport:
+    return httpx.AsyncHTTPTransport(
+        http2=True,  # 启用 HTTP/2 以提高性能
+        limits=httpx.Limits(
+            max_connections=options["max_connections"],
+            max_keepalive_connections=options["max_keepalive_connections"],
+            keepalive_expiry=options["keepalive_expiry"],
+        ),
+    )
+
+
+class _Pool:
+    __slots__ = ("transport", "options", "last_used")
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, options: Dict[str, Any], now: float):
+        self.transport = transport
+        self.options = options
+        self.last_used = now
+
+
+class InstancePools(httpx.AsyncBaseTransport):
+    """
+    每个实例（按 scheme、host 和端口区分）一个独立连接池的 httpx 传输层
+
+    共用一个连接池时，实例较多会争抢有限的 keepalive 连接，连接被反复关闭和重建。
+    这里每个实例按自己的 pool 配置（未配置的字段使用 defaults）创建连接池，
+    并记录最后一次使用时间，供保活探测判断哪些连接池处于空闲状态。
+    不属于任何实例的请求使用按 defaults 创建的共享连接池。
+
+    热更新时 prepare 在旁边创建新连接池，预热请求通过 STAGED_POOL_EXTENSION 指定它，
+    预热完成后再由 install 同步换入，期间的其他请求不受影响。
+    """
+
+    def __init__(self, defaults: Dict[str, Any],
+                 factory: Callable[[Dict[str, Any]], httpx.AsyncBaseTransport] = _default_factory,
+                 clock=time.monotonic):
+        self.defaults = dict(defaults)
+        self.factory = factory
+        self.clock = clock
+        self.pools: Dict[Origin, _Pool] = {}
+        self._fallback: Optional[httpx.AsyncBaseTransport] = None
+
+    def options_for(self, instance: Dict[str, Any]) -> Dict[str, Any]:
+        return {**self.defaults, **(instance.get("pool") or {})}
+
+    def configure(self, instances: List[Dict[str, Any]]) -> List[httpx.AsyncBaseTransport]:
+        """
+        为新实例创建连接池；配置变化的连接池被替换
+
+        已存在且配置未变的连接池保持不变。被替换的旧连接池作为返回值交给调用方，
+        在其上的在途请求结束后关闭。多个实例使用同一地址时以最后一个的配置为准。
+        """
+        return self.install(self.prepare(instances))
+
+    def prepare(self, instances: List[Dict[str, Any]]) -> Dict[Origin, Any]:
+        """
+        为新地址和配置变化的地址创建连接池，但还不安装
+
+        返回值交给 transport_of 取出各地址的新连接池进行预热，预热完成后再用 install 安装，
+        在此之前的请求仍然使用旧连接池。
+        """
+        staged = {}
+        for instance in instances:
+            origin = origin_of(instance["url"])
+            options = self.options_for(instance)
+            pool = self.pools.get(origin)
+            if pool is not None and pool.options == options:
+                staged.pop(origin, None)
+                continue
+            previous = staged.get(origin)
+            if previous is not None and previous.options == options:
+                continue
+            staged[origin] = _Pool(self.factory(options), options, self.clock())
+        return staged
+
+    @staticmethod
+    def transport_of(staged: Dict[Origin, Any], url: str) -> Optional[httpx.AsyncBaseTransport]:
+        pool = staged.get(origin_of(url))
+        return pool.transport if pool is not None else None
+
+    def install(self, staged: Dict[Origin, Any]) -> List[httpx.AsyncBaseTransport]:
+        """安装 prepare 创建的连接池（同步完成），返回被替换的旧连接池"""
+        retired = []
+        for origin, pool in staged.items():
+            current = self.pools.get(origin)
+            if current is not None:
+                retired.append(current.transport)
+            pool.last_used = self.clock()
+            self.pools[origin] = pool
+        return retired
+
+    def prune(self, instances: List[Dict[str, Any]]) -> List[httpx.AsyncBaseTransport]:
+        """移除不再属于任何实例的连接池，返回它们供调用方关闭"""
+        keep = {origin_of(instance["url"]) for instance in instances}
+        removed = [origin for origin in self.pools if origin not in keep]
+        return [self.pools.pop(origin).transport for origin in removed]
+
+    def idle_seconds(self, url: str) -> float:
+        pool = self.pools.get(origin_of(url))
+        return self.clock() - pool.last_used if pool is not None else 0.0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        staged = request.extensions.get(STAGED_POOL_EXTENSION)
+        if staged is not None:
+            return await staged.handle_async_request(request)
+        pool = self.pools.get((request.url.scheme, request.url.host, request.url.port))
+        if pool is None:
+            if self._fallback is None:
+                self._fallback = self.factory(self.defaults)
+            return await self._fallback.handle_async_request(request)
+        pool.last_used = self.clock()
+        return await pool.transport.handle_async_request(request)
+
+    async def aclose(self):
+        transports = [pool.transport for pool in self.pools.values()]
+        if self._fallback is not None:
+            transports.append(self._fallback)
+        self.pools.clear()
+        self._fallback = None
+        for transport in transports:
+            await transport.aclose()
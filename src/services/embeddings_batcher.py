@@ -0,0 +1,196 @@
+import asyncio
+import json
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from src.load_balancer.instance_index import EXCLUDED_HEADERS
+from src.services.upstream_response import UpstreamResponse
+
+# forward(method, path, body, headers) -> 上游响应（UpstreamResponse）
+Forward = Callable[[str, str, Any, Dict[str, str]], Awaitable[Any]]
+
+# 只用于认证和追踪、不影响上游结果的请求头；其余请求头不同的请求不合并
+_UNKEYED_HEADERS = EXCLUDED_HEADERS | frozenset((
+    "authorization", "content-type", "accept", "user-agent", "x-request-id", "x-ms-client-request-id",
+    "traceparent", "tracestate", "x-priority",
+))
+
+# 这些 4xx 与输入无关（超时、限流），不拆分批次
+_SHARED_CLIENT_ERRORS = (408, 429)
+
+
+class _Caller:
+    __slots__ = ("body", "headers", "inputs", "tokens", "future")
+
+    def __init__(self, body: bytes, headers: Dict[str, str], inputs: List[str], tokens: int,
+                 future: asyncio.Future):
+        self.body = body
+        self.headers = headers
+        self.inputs = inputs
+        self.tokens = tokens
+        self.future = future
+
+    @property
+    def count(self) -> int:
+        return len(self.inputs)
+
+
+class _Batch:
+    __slots__ = ("path", "params", "headers", "count", "tokens", "callers", "timer")
+
+    def __init__(self, path: str, params: Dict[str, Any], headers: Dict[str, str]):
+        self.path = path
+        self.params = params
+        self.headers = headers
+        self.count = 0
+        self.tokens = 0
+        self.callers: List[_Caller] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+def split_usage(total: int, weights: List[int]) -> List[int]:
+    """按权重拆分 token 数（最大余数法），保证各部分之和等于总数"""
+    if not any(weights):
+        weights = [1] * len(weights)
+    weight_sum = sum(weights)
+    shares = [total * w / weight_sum for w in weights]
+    parts = [int(share) for share in shares]
+    remainders = sorted(range(len(weights)), key=lambda i: shares[i] - parts[i], reverse=True)
+    for i in remainders[:total - sum(parts)]:
+        parts[i] += 1
+    return parts
+
+
+class EmbeddingsBatcher:
+    """
+    合并并发的 embeddings 请求
+
+    同一路径、相同参数（除 input 外）和相同请求头（认证、追踪等头除外）的请求在 window 秒内
+    被收集起来，合并成一次数组输入的上游调用，再把 data[] 和 usage 拆回给各个调用方。
+    达到 max_inputs 条输入或 max_tokens 估算 token 时立即发送。
+    只合并字符串输入；token 数组等其他输入按原样单独转发。
+
+    合并后的调用返回 4xx（某个调用方的输入无效，例如超长）时，批次被对半拆分后分别重发，
+    直到只剩一个调用方时用它自己的原始请求，因此错误只返回给输入有问题的调用方。
+    """
+
+    def __init__(self, forward: Forward, window: float = 0.01, max_inputs: int = 256, max_tokens: int = 50000):
+        self.forward = forward
+        self.window = window
+        self.max_inputs = max_inputs
+        self.max_tokens = max_tokens
+        self.pending: Dict[Tuple[str, str], _Batch] = {}
+        self.tasks = set()
+        self.batches_sent = 0
+        self.requests_batched = 0
+
+    @staticmethod
+    def accepts(method: str, path: str, body: Any) -> bool:
+        return method == "POST" and "/embeddings" in path and isinstance(body, (bytes, bytearray)) and bool(body)
+
+    async def submit(self, path: str, body: bytes, headers: Dict[str, str]) -> Any:
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            payload = None
+        inputs = payload.get("input") if isinstance(payload, dict) else None
+        if isinstance(inputs, str):
+            items = [inputs]
+        elif isinstance(inputs, list) and inputs and all(isinstance(item, str) for item in inputs):
+            items = inputs
+        else:
+            return await self.forward("POST", path, body, headers)
+        if len(items) >= self.max_inputs:
+            return await self.forward("POST", path, body, headers)
+
+        params = {k: v for k, v in payload.items() if k != "input"}
+        keyed_headers = sorted((k.lower(), v) for k, v in (headers or {}).items()
+                               if k.lower() not in _UNKEYED_HEADERS)
+        key = (path, json.dumps([params, keyed_headers], sort_keys=True))
+        tokens = sum(len(item) for item in items) // 4 + 1
+
+        batch = self.pending.get(key)
+        if batch is not None and (batch.count + len(items) > self.max_inputs
+                                  or batch.tokens + tokens > self.max_tokens):
+            self._flush(key)
+            batch = None
+        loop = asyncio.get_running_loop()
+        if batch is None:
+            batch = self.pending[key] = _Batch(path, params, headers)
+            batch.timer = loop.call_later(self.window, self._flush, key)
+
+        future = loop.create_future()
+        batch.count += len(items)
+        batch.tokens += tokens
+        batch.callers.append(_Caller(body, headers, items, tokens, future))
+        if batch.count >= self.max_inputs or batch.tokens >= self.max_tokens:
+            self._flush(key)
+        return await future
+
+    def _flush(self, key: Tuple[str, str]):
+        batch = self.pending.pop(key, None)
+        if batch is None:
+            return
+        if batch.timer is not None:
+            batch.timer.cancel()
+        task = asyncio.ensure_future(self._send(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _send(self, batch: _Batch, callers: Optional[List[_Caller]] = None):
+        callers = batch.callers if callers is None else callers
+        try:
+            if len(callers) == 1:
+                # 只有一个请求时原样转发，不重新编码请求体
+                result = await self.forward("POST", batch.path, callers[0].body, callers[0].headers)
+                if not callers[0].future.done():
+                    callers[0].future.set_result(result)
+                return
+            self.batches_sent += 1
+            inputs = [item for caller in callers for item in caller.inputs]
+            body = json.dumps({**batch.params, "input": inputs}).encode()
+            result = await self.forward("POST", batch.path, body, batch.headers)
+            if 400 <= result.status_code < 500 and result.status_code not in _SHARED_CLIENT_ERRORS:
+                # 找出输入有问题的调用方：对半拆分后分别重发
+                middle = len(callers) // 2
+                await asyncio.gather(self._send(batch, callers[:middle]), self._send(batch, callers[middle:]))
+                return
+            responses = self._split(result, callers)
+            if not result.is_error:
+                self.requests_batched += len(callers)
+            for caller, response in zip(callers, responses):
+                if not caller.future.done():
+                    caller.future.set_result(response)
+        except Exception as e:
+            for caller in callers:
+                if not caller.future.done():
+                    caller.future.set_exception(e)
+
+    @staticmethod
+    def _split(result: UpstreamResponse, callers: List[_Caller]) -> List[UpstreamResponse]:
+        if result.is_error:
+            # 错误响应不会被修改，所有调用方共享同一个对象
+            return [result] * len(callers)
+        try:
+            parsed = result.json()
+        except ValueError:
+            parsed = None
+        data = parsed.get("data") if isinstance(parsed, dict) else None
+        if not isinstance(data, list) or len(data) != sum(caller.count for caller in callers):
+            raise HTTPException(status_code=502, detail="Unexpected response to batched embeddings request")
+        data = sorted(data, key=lambda item: item.get("index", 0))
+        usage = parsed.get("usage") or {}
+        prompt_parts = split_usage(int(usage.get("prompt_tokens", 0)), [c.tokens for c in callers])
+        total_parts = split_usage(int(usage.get("total_tokens", 0)), [c.tokens for c in callers])
+        responses = []
+        offset = 0
+        for caller, prompt_tokens, total_tokens in zip(callers, prompt_parts, total_parts):
+            items = [{**item, "index": i} for i, item in enumerate(data[offset:offset + caller.count])]
+            offset += caller.count
+            response = {k: v for k, v in parsed.items() if k not in ("data", "usage")}
+            response["data"] = items
+            response["usage"] = {"prompt_tokens": prompt_tokens, "total_tokens": total_tokens}
+            responses.append(UpstreamResponse.from_json(response, result.status_code, headers=result.headers,
+                                                         instance=result.instance))
+        return responses
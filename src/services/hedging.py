@@ -0,0 +1,83 @@
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from src.services.retry import RetryBudget
+from src.utils.metrics import CallbackMetric, Counter
+
+# 只对这些接口的非流式请求做对冲：重复发送不会产生副作用，且延迟敏感
+HEDGE_SUFFIXES = ("/chat/completions", "/completions", "/embeddings")
+
+
+class LatencyWindow:
+    """最近 size 个延迟样本，按需计算分位数（每 refresh 个新样本重新排序一次）"""
+
+    __slots__ = ("samples", "quantile", "refresh", "_value", "_stale")
+
+    def __init__(self, quantile: float, size: int = 256, refresh: int = 16):
+        self.samples: Deque[float] = deque(maxlen=size)
+        self.quantile = quantile
+        self.refresh = refresh
+        self._value: Optional[float] = None
+        self._stale = 0
+
+    def observe(self, latency: float):
+        self.samples.append(latency)
+        self._stale += 1
+        if self._value is not None and self._stale >= self.refresh:
+            self._value = None
+
+    def value(self) -> Optional[float]:
+        if self._value is None and self.samples:
+            ordered = sorted(self.samples)
+            self._value = ordered[min(int(len(ordered) * self.quantile), len(ordered) - 1)]
+            self._stale = 0
+        return self._value
+
+
+class Hedger:
+    """
+    对冲请求的延迟和预算
+
+    主请求超过该实例（和 deployment）最近延迟的 quantile 分位数仍未返回时，
+    向另一个健康实例发送备份请求，先返回的结果胜出，另一个被取消。
+    样本不足 min_samples 时使用 max_delay；延迟限制在 [min_delay, max_delay] 之间。
+    对冲预算与重试预算相同，是一个令牌桶：备份请求最多约为请求量的 budget_ratio 倍。
+    """
+
+    def __init__(self, quantile: float = 0.95, min_delay: float = 0.05, max_delay: float = 10.0,
+                 min_samples: int = 20, budget_ratio: float = 0.1):
+        self.quantile = quantile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.min_samples = min_samples
+        self.budget = RetryBudget(ratio=budget_ratio, min_per_second=0.0)
+        self.windows: Dict[Tuple[str, str], LatencyWindow] = {}
+        labels = ("instance", "deployment")
+        self.hedges = Counter("lb_hedge_requests_total", "Backup requests by outcome (won = backup answered first)",
+                              labels + ("result",))
+
+    @staticmethod
+    def accepts(method: str, suffix: str, body: Any) -> bool:
+        """只对冲请求体已在内存中的非流式推理请求（流式上传的请求体不能同时发送两次）"""
+        return (method == "POST" and isinstance(body, (bytes, bytearray, dict, list))
+                and suffix.split("?", 1)[0].endswith(HEDGE_SUFFIXES))
+
+    def observe(self, labels: Tuple[str, str], latency: float):
+        window = self.windows.get(labels)
+        if window is None:
+            window = self.windows[labels] = LatencyWindow(self.quantile)
+        window.observe(latency)
+
+    def delay_for(self, labels: Tuple[str, str]) -> float:
+        window = self.windows.get(labels)
+        if window is None or len(window.samples) < self.min_samples:
+            return self.max_delay
+        return min(max(window.value(), self.min_delay), self.max_delay)
+
+    def collectors(self) -> List[Any]:
+        budget = self.budget
+        return [
+            self.hedges,
+            CallbackMetric("lb_hedge_budget_exhausted_total", "Backup requests skipped because the hedge budget was empty",
+                           (), lambda: [((), budget.exhausted)], kind="counter"),
+        ]
@@ -0,0 +1,224 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.utils.metrics import (
+    GAP_BUCKETS, LATENCY_BUCKETS, TTFT_BUCKETS, CallbackMetric, Counter, Histogram,
+)
+from src.utils import fast_json
+
+_USAGE_KEY = b'"usage"'
+_SEPARATORS = b" \t\r\n:"
+_STATE_VALUES = {"closed": 0, "half_open": 1, "open": 2}
+
+
+def _usage_int(value: Any) -> int:
+    return value if type(value) is int else 0
+
+
+def usage_span(data: bytes) -> Tuple[int, int]:
+    """
+    查找 "usage": {...} 对象，返回对象在 data 中的 (起点, 终点)
+
+    没有 usage 对象（包括流式分块中的 "usage": null）时返回 (-1, -1)；
+    对象在 data 末尾被截断时返回 ("usage" 键的位置, -1)，可以拼接下一个分块后重新查找。
+    """
+    pos = data.find(_USAGE_KEY)
+    while pos != -1:
+        start = pos + len(_USAGE_KEY)
+        brace = data.find(b"{", start)
+        if brace == -1 or data[start:brace].strip(_SEPARATORS):
+            # 键后面不是对象（null 或字符串中的 "usage"），或者对象还没有到达
+            if not data[start:].strip(_SEPARATORS):
+                return pos, -1
+            pos = data.find(_USAGE_KEY, start)
+            continue
+        # usage 中只有数字和嵌套对象（*_tokens_details），花括号配对时的 } 就是结尾
+        end = data.find(b"}", brace)
+        while end != -1 and data.count(b"{", brace, end) > data.count(b"}", brace, end + 1):
+            end = data.find(b"}", end + 1)
+        if end == -1:
+            return pos, -1
+        return brace, end + 1
+    return -1, -1
+
+
+def parse_usage(usage: bytes) -> Tuple[int, int, int]:
+    """解析 usage 对象的字节，返回 (prompt_tokens, completion_tokens, prompt_tokens_details.cached_tokens)"""
+    try:
+        value = fast_json.loads(usage)
+    except ValueError:
+        return 0, 0, 0
+    if type(value) is not dict:
+        return 0, 0, 0
+    details = value.get("prompt_tokens_details")
+    cached = details.get("cached_tokens", 0) if type(details) is dict else 0
+    return _usage_int(value.get("prompt_tokens", 0)), _usage_int(value.get("completion_tokens", 0)), _usage_int(cached)
+
+
+def read_usage(data: bytes) -> Tuple[int, int, int]:
+    """
+    从响应字节中读取 (prompt_tokens, completion_tokens, cached_tokens)，没有完整的 usage 时为 (0, 0, 0)
+
+    只用几次 find 定位 usage 对象，再解析这一小段，不解析整个响应。
+    """
+    start, end = usage_span(data)
+    if end == -1:
+        return 0, 0, 0
+    return parse_usage(data[start:end])
+
+
+# 等待被截断的 usage 对象时最多缓存的字节数
+_MAX_PENDING_USAGE = 65536
+
+
+class UsageReader:
+    """
+    从逐块到达的响应体中读取一次 usage
+
+    usage 对象可能跨越两个分块：看到 "usage" 键但对象没有结束时，缓存从键开始的部分，
+    拼接下一个分块后重新查找。找到后不再查找，同一个响应不会重复扣除。
+    """
+
+    __slots__ = ("pending", "done")
+
+    def __init__(self):
+        self.pending = b""
+        self.done = False
+
+    def feed(self, chunk: bytes) -> Optional[Tuple[int, int, int]]:
+        """返回 (prompt_tokens, completion_tokens, cached_tokens)；usage 还没有出现时返回 None"""
+        if self.done or not chunk:
+            return None
+        if self.pending:
+            data = self.pending + chunk
+        elif _USAGE_KEY in chunk:
+            data = chunk
+        else:
+            # 绝大多数分块不含 usage：只检查末尾是否可能是被切断的键
+            tail = chunk[1 - len(_USAGE_KEY):]
+            if b'"' in tail:
+                self.pending = tail
+            return None
+        start, end = usage_span(data)
+        if end != -1:
+            self.done = True
+            self.pending = b""
+            return parse_usage(data[start:end])
+        if start == -1:
+            # "usage" 键本身也可能被切断：末尾不到一个键长的字节里有引号时才保留
+            tail = data[1 - len(_USAGE_KEY):]
+            self.pending = tail if b'"' in tail else b""
+        elif len(data) - start > _MAX_PENDING_USAGE:
+            self.done = True
+            self.pending = b""
+        else:
+            self.pending = data[start:]
+        return None
+
+
+class ServiceMetrics:
+    """
+    OpenAIService 的指标，按实例和 deployment 统计
+
+    热路径上的记录都是对 Counter/Histogram 的一次调用；
+    在途请求数、熔断状态和缓存等状态在导出时从各自的对象中读取。
+    """
+
+    def __init__(self, service: Any):
+        self.service = service
+        labels = ("instance", "deployment")
+        self.requests = Counter("lb_upstream_requests_total", "Upstream attempts by status code (error = no response)",
+                                labels + ("status",))
+        self.failovers = Counter("lb_failovers_total", "Attempts sent to another instance after a failure", labels)
+        self.latency = Histogram("lb_upstream_latency_seconds", "Upstream response time of non-streaming requests",
+                                 labels, LATENCY_BUCKETS)
+        self.ttft = Histogram("lb_stream_ttft_seconds", "Time to the first SSE event of streaming requests",
+                              labels, TTFT_BUCKETS)
+        self.chunk_gap = Histogram("lb_stream_chunk_gap_seconds", "Gap between consecutive upstream stream chunks",
+                                   labels, GAP_BUCKETS)
+        self.tokens = Counter("lb_tokens_total", "Tokens reported in upstream usage", labels + ("type",))
+        # 每组标签的 token 类型标签元组只拼接一次，记录时不再创建新元组
+        self._token_keys: Dict[tuple, Tuple[tuple, ...]] = {}
+
+    def observe_response(self, labels: tuple, status_code: Any, latency: Optional[float] = None):
+        self.requests.inc(labels + (status_code,))
+        if latency is not None:
+            self.latency.observe(labels, latency)
+
+    def observe_usage(self, labels: tuple, content: bytes):
+        """从非流式响应的原始字节中读取 usage 字段统计 token，不解析整个响应"""
+        self.observe_tokens(labels, read_usage(content))
+
+    def observe_tokens(self, labels: tuple, usage: Tuple[int, int, int]):
+        """记录 (prompt_tokens, completion_tokens, cached_tokens)；流式响应由 UsageReader 跨分块读取"""
+        prompt_tokens, completion_tokens, cached_tokens = usage
+        if not (prompt_tokens or completion_tokens):
+            return
+        keys = self._token_keys.get(labels)
+        if keys is None:
+            keys = self._token_keys[labels] = tuple(labels + (kind,) for kind in ("prompt", "cached", "completion"))
+        inc = self.tokens.inc
+        if prompt_tokens:
+            inc(keys[0], prompt_tokens)
+            if cached_tokens:
+                inc(keys[1], cached_tokens)
+        if completion_tokens:
+            inc(keys[2], completion_tokens)
+
+    def collectors(self) -> List[Any]:
+        service = self.service
+        metrics = [self.requests, self.failovers, self.latency, self.ttft, self.chunk_gap, self.tokens]
+        metrics.append(CallbackMetric(
+            "lb_in_flight_requests", "Requests currently holding an instance", ("instance",),
+            lambda: [((i["name"],), service.balancer.stats_for(i).in_flight) for i in service.instances]
+        ))
+        metrics.append(CallbackMetric(
+            "lb_circuit_state", "Circuit breaker state (0 closed, 1 half-open, 2 open)", ("instance",),
+            lambda: [((i["name"],), _STATE_VALUES.get(service.balancer.breaker_for(i).state, 0))
+                     for i in service.instances]
+        ))
+        metrics.append(CallbackMetric(
+            "lb_prompt_cache_hit_ratio", "Share of prompt tokens served from the Azure prompt cache",
+            ("instance", "deployment"), self._prompt_cache_hit_ratios
+        ))
+        if service.balancer.ring is not None:
+            routes = service.balancer.affinity_routes
+            metrics.append(CallbackMetric(
+                "lb_affinity_routes_total", "Prefix-affinity requests by placement (owner, spill, fallback)",
+                ("result",), lambda: [((result,), count) for result, count in routes.items()], kind="counter"
+            ))
+        if service.balancer.concurrency is not None:
+            metrics.append(CallbackMetric(
+                "lb_concurrency_limit", "Adaptive in-flight limit of each instance", ("instance",),
+                lambda: [((i["name"],), int(service.balancer.limit_for(i).limit)) for i in service.instances]
+            ))
+        metrics.extend(service.retry_budget.collectors())
+        if service.hedger is not None:
+            metrics.extend(service.hedger.collectors())
+        if service.cache is not None:
+            cache = service.cache
+            metrics.append(CallbackMetric(
+                "lb_cache_requests_total", "Response cache lookups", ("result",),
+                lambda: [(("hit",), cache.hits), (("miss",), cache.misses)], kind="counter"
+            ))
+        if service.singleflight is not None:
+            flight = service.singleflight
+            metrics.append(CallbackMetric(
+                "lb_singleflight_requests_total", "Deduplicated requests by role", ("role",),
+                lambda: [(("leader",), flight.leaders), (("shared",), flight.shared)], kind="counter"
+            ))
+        if service.embeddings_batcher is not None:
+            batcher = service.embeddings_batcher
+            metrics.append(CallbackMetric(
+                "lb_embeddings_batched_requests_total", "Embeddings requests merged into batched calls", (),
+                lambda: [((), batcher.requests_batched)], kind="counter"
+            ))
+        return metrics
+
+    def _prompt_cache_hit_ratios(self) -> List[Tuple[tuple, float]]:
+        values = self.tokens.values
+        return [(labels[:2], values.get(labels[:2] + ("cached",), 0) / prompt)
+                for labels, prompt in list(values.items()) if labels[2] == "prompt" and prompt]
+
+    @staticmethod
+    def labels_for(instance: Dict[str, Any], deployment: Optional[str]) -> tuple:
+        return (instance["name"], deployment or "")
@@ -1,24 +1,243 @@
-from fastapi import HTTPException
+from fastapi import HTTPException, Response
 from fastapi.responses import StreamingResponse
+import asyncio
+import functools
 import httpx
 import json
-import random
-import re
+import math
+import os
+import time
 from src.config.settings import settings
+from src.load_balancer.affinity import prefix_key
+from src.load_balancer.balancer import TTFT, CapacityExhausted, Lease, LoadBalancer
+from src.load_balancer.instance_index import EXCLUDED_HEADERS, InstanceIndex, parse_path
+from src.load_balancer.shared_state import SHARED_STATE_ENV, SharedState
+from src.services.cache import CACHE_CONTROL_HEADER, ResponseCache, cache_key, is_cacheable
+from src.services.connection_pool import STAGED_POOL_EXTENSION, InstancePools
+from src.services.embeddings_batcher import EmbeddingsBatcher
+from src.services.hedging import Hedger
+from src.services.metrics import ServiceMetrics, UsageReader
+from src.services.retry import RetryBudget, RetryPolicy, RetryState, is_retryable_status
+from src.services.singleflight import SingleFlight
+from src.services.upstream_response import UpstreamResponse
+from src.utils import server_timing
+from src.utils.access_log import access_log
+from src.utils.request_body import ReplayableBody
+from src.utils.tokens import estimate_request_tokens
 from typing import Dict, Any, Optional, List, Union
 
+# 单次尝试的结果类型：成功、可以换实例重试、不应重试的错误
+_OK, _RETRY, _FAIL = "ok", "retry", "fail"
+# SSE 事件以空行结束，行尾可以是 LF、CRLF 或 CR
+_EVENT_TERMINATORS = (b"\n\n", b"\r\n\r\n", b"\r\r")
+
 class OpenAIService:
     def __init__(self, instances=None):
         self.instances = instances if instances is not None else settings.instances
         self.all_instances = list(self.instances) if instances is not None else list(settings.instances)
-        # 创建一个持久的 httpx.AsyncClient 实例
+        # 重试策略：总截止时间、尝试次数和退避；全局重试预算限制故障期间的重试量
+        self.retry_policy = RetryPolicy(**settings.get_retry_options())
+        self.retry_budget = RetryBudget(**settings.get_retry_budget_options())
+        self.connect_timeout = settings.get_upstream_connect_timeout()
+        # 可选的对冲请求：主请求超过延迟分位数时向另一个实例发送备份请求
+        self.hedger = Hedger(**settings.get_hedge_options()) if settings.get_hedge_enabled() else None
+        # 每个实例一个连接池（连接数等参数可在实例配置的 pool 中单独设置）
+        self.pools = InstancePools(settings.get_upstream_pool_options())
+        self.pools.configure(self.instances)
+        # 创建一个持久的 httpx.AsyncClient 实例，每次请求按剩余的截止时间设置超时
         self.client = httpx.AsyncClient(
-            timeout=600.0,
-            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
-            http2=True  # 启用 HTTP/2 以提高性能
+            transport=self.pools,
+            timeout=httpx.Timeout(self.retry_policy.timeout, connect=self.connect_timeout)
+        )
+        # 启动时的连接预热任务（完成前 /health 报告未就绪），以及空闲连接池的保活探测
+        self.warming: Optional[asyncio.Task] = None
+        self.keepalive_interval = settings.get_upstream_keepalive_interval()
+        self._keepalive_task: Optional[asyncio.Task] = None
+        # 流式请求等待第一个事件的最长时间，超时后切换到其他实例
+        self.stream_ttft_timeout = settings.get_stream_ttft_timeout()
+        # 可选的响应缓存，只缓存 embeddings 和 temperature=0 的确定性请求
+        self.cache = ResponseCache(**settings.get_response_cache_options()) if settings.get_response_cache_enabled() else None
+        # 可选的 embeddings 请求合并
+        self.embeddings_batcher = (
+            EmbeddingsBatcher(self._forward_upstream, **settings.get_embeddings_batch_options())
+            if settings.get_embeddings_batch_enabled() else None
+        )
+        # 可选的进行中请求去重：off、deterministic（只合并确定性请求）或 all
+        self.singleflight_mode = settings.get_singleflight_mode()
+        self.singleflight = (
+            SingleFlight(fan_out_streams=settings.get_singleflight_streams_enabled())
+            if self.singleflight_mode != "off" else None
         )
+        # 启动时建立 deployment 到实例的索引，并预先计算每个实例的 URL 前缀和认证头
+        self.index = InstanceIndex(self.instances)
+        # 多 worker 部署时，各 worker 通过共享内存交换熔断、在途请求数和限流额度
+        self.shared_state = self._attach_shared_state()
+        # 负载均衡器负责实例选择、熔断、延迟统计和限流额度
+        self.balancer = LoadBalancer(
+            self.instances,
+            strategy=settings.get_load_balancing_strategy(),
+            breaker_options=settings.get_circuit_breaker_options(),
+            max_capacity_wait=settings.get_rate_limit_max_wait(),
+            shared=self.shared_state,
+            concurrency=(settings.get_adaptive_concurrency_options()
+                         if settings.get_adaptive_concurrency_enabled() else None),
+            concurrency_wait=settings.get_concurrency_queue_timeout(),
+            affinity=settings.get_prefix_affinity_options() if settings.get_prefix_affinity_enabled() else None
+        )
+        # 前缀亲和路由只对提示长度达到 affinity_chars 个字符的 chat/completions 请求生效
+        self.affinity_chars = settings.get_prefix_affinity_chars()
+        # 按实例和 deployment 统计的指标，由 /metrics 导出
+        self.metrics = ServiceMetrics(self)
+        # 热更新实例表时串行执行，并跟踪等待被移除实例排空的任务
+        self._reload_lock = asyncio.Lock()
+        self._drain_tasks = set()
+        self.drain_timeout = settings.get_drain_timeout()
+
+    def _attach_shared_state(self) -> Optional[SharedState]:
+        """附加到启动器创建的共享状态；未设置或实例列表不一致时退回到进程内状态"""
+        path = os.environ.get(SHARED_STATE_ENV)
+        if not path:
+            return None
+        try:
+            return SharedState.attach(path, [instance["name"] for instance in self.instances])
+        except (OSError, ValueError, RuntimeError) as e:
+            print(f"Warning: Shared routing state unavailable, using per-worker state: {e}")
+            return None
+
+    async def update_instances(self, instances: List[Dict[str, Any]]) -> Dict[str, List[str]]:
+        """
+        原子地替换实例表（配置文件变化或管理接口调用时）
+
+        新增、URL 变化和连接池配置（pool）变化的实例先在旁边创建并预热新连接池，预热期间
+        请求照常使用旧表和旧连接池；之后新连接池与路由索引、负载均衡器一起同步替换，
+        中间没有 await，所以每个请求看到的要么是旧表和旧连接池，要么是新表和预热过的新连接池。
+        未变化和只换了密钥的实例保留连接池、熔断状态和延迟统计；被替换的旧连接池在排空时间后关闭。
+        被移除的实例不再接收新请求，在途请求结束（或超过排空时间）后丢弃其状态。
 
-    async def forward_full_request(self, method: str, path: str, body: Any = None, headers: Dict[str, str] = None, tried_instances=None) -> Dict[str, Any]:
+        Returns:
+            {"added": [...], "updated": [...], "removed": [...]}，值为实例名称
+        """
+        async with self._reload_lock:
+            current = {instance["name"]: instance for instance in self.instances}
+            names = {instance["name"] for instance in instances}
+            added = [instance for instance in instances if instance["name"] not in current]
+            updated = [instance for instance in instances
+                       if instance["name"] in current and current[instance["name"]] != instance]
+            moved = [instance for instance in updated
+                     if instance["url"].rstrip("/") != current[instance["name"]]["url"].rstrip("/")]
+            removed = [name for name in current if name not in names]
+            repooled = [instance for instance in updated
+                        if instance not in moved and instance.get("pool") != current[instance["name"]].get("pool")]
+
+            staged = self.pools.prepare(instances)
+            await asyncio.gather(*(self._prewarm(instance, self.pools.transport_of(staged, instance["url"]))
+                                   for instance in added + moved + repooled))
+
+            for transport in self.pools.install(staged):
+                self._close_later(transport)
+            self.index = InstanceIndex(instances)
+            self.instances = instances
+            self.all_instances = list(instances)
+            self.balancer.set_instances(instances)
+            for instance in moved:
+                self.balancer.reset(instance)
+            for transport in self.pools.prune(instances):
+                self._close_later(transport)
+            for name in removed:
+                task = asyncio.create_task(self._drain(name))
+                self._drain_tasks.add(task)
+                task.add_done_callback(self._drain_tasks.discard)
+
+            summary = {
+                "added": [instance["name"] for instance in added],
+                "updated": [instance["name"] for instance in updated],
+                "removed": removed,
+            }
+            access_log.log("instances_reloaded", instances=len(instances), **summary)
+            return summary
+
+    def start(self):
+        """在事件循环中启动连接预热和保活探测（应用启动时调用）"""
+        if self.warming is None:
+            self.warming = asyncio.create_task(self.warm_up())
+        if self._keepalive_task is None and self.keepalive_interval > 0:
+            self._keepalive_task = asyncio.create_task(self._keepalive_loop())
+
+    @property
+    def ready(self) -> bool:
+        """启动预热完成（或没有进行预热）时为 True"""
+        return self.warming is None or self.warming.done()
+
+    async def warm_up(self):
+        """预热所有实例的连接池（DNS 解析、TCP、TLS 和 HTTP/2 协商），冷启动的请求不再承担建连开销"""
+        started = time.monotonic()
+        await asyncio.gather(*(self._prewarm(instance) for instance in self.instances))
+        access_log.log("instances_prewarmed", instances=len(self.instances),
+                       duration_ms=round((time.monotonic() - started) * 1000, 2))
+
+    async def _prewarm(self, instance: Dict[str, Any], transport: Optional[httpx.AsyncBaseTransport] = None):
+        """
+        建立到实例的 prewarm_connections 个连接，响应状态无关紧要
+
+        并发发送请求，连接池才会建立多个连接（HTTP/2 下多数请求会复用同一个连接）。
+        指定 transport（尚未安装的新连接池）时，预热请求通过它发送。
+        """
+        count = max(int(self.pools.options_for(instance).get("prewarm_connections", 1)), 1)
+        url = instance["url"].rstrip("/") + "/"
+        extensions = {STAGED_POOL_EXTENSION: transport} if transport is not None else None
+        results = await asyncio.gather(
+            *(self.client.send(self.client.build_request("GET", url, timeout=5.0, extensions=extensions))
+              for _ in range(count)),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, httpx.HTTPError):
+                access_log.log("instance_prewarm_failed", level="warning", instance=instance["name"], error=str(result))
+                break
+
+    async def _keepalive_loop(self):
+        while True:
+            await asyncio.sleep(self.keepalive_interval)
+            await self.keepalive()
+
+    async def keepalive(self):
+        """向空闲超过保活间隔的连接池发送一次请求，避免连接因空闲被关闭"""
+        idle = [instance for instance in self.instances
+                if self.pools.idle_seconds(instance["url"]) >= self.keepalive_interval]
+        await asyncio.gather(*(self._ping(instance) for instance in idle))
+
+    async def _ping(self, instance: Dict[str, Any]):
+        try:
+            await self.client.get(instance["url"].rstrip("/") + "/", timeout=5.0)
+        except httpx.HTTPError as e:
+            access_log.log("instance_keepalive_failed", level="warning", instance=instance["name"], error=str(e))
+
+    def _close_later(self, transport: httpx.AsyncBaseTransport):
+        """被替换的连接池在排空时间后关闭，其上的在途请求和流式响应不受影响"""
+        async def close():
+            await asyncio.sleep(self.drain_timeout)
+            await transport.aclose()
+        task = asyncio.create_task(close())
+        self._drain_tasks.add(task)
+        task.add_done_callback(self._drain_tasks.discard)
+
+    async def _drain(self, name: str):
+        """等待被移除实例的在途请求结束后丢弃其状态；期间重新加入的实例保留状态"""
+        deadline = time.monotonic() + self.drain_timeout
+        while time.monotonic() < deadline:
+            if any(instance["name"] == name for instance in self.instances):
+                return
+            stats = self.balancer.stats.get(name)
+            if stats is None or stats.in_flight <= 0:
+                break
+            await asyncio.sleep(0.1)
+        else:
+            access_log.log("instance_drain_timeout", level="warning", instance=name)
+        if not any(instance["name"] == name for instance in self.instances):
+            self.balancer.forget(name)
+
+    async def forward_full_request(self, method: str, path: str, body: Any = None, headers: Dict[str, str] = None,
+                                   tried_instances=None, raw: bool = False) -> Union[Dict[str, Any], UpstreamResponse]:
         """
         将完整请求（包括方法、路径、请求体和头信息）转发到 Azure OpenAI API
         
@@ -28,149 +247,251 @@ class OpenAIService:
             body: 请求体 (对于POST, PUT等请求)
             headers: 请求头
             tried_instances: 已尝试过的实例名称列表
+            raw: 为 True 时返回 UpstreamResponse（原始字节、状态码和上游响应头），不解析 JSON
             
         Returns:
-            Azure OpenAI API的响应
+            Azure OpenAI API的响应；raw 为 False 时为解析后的字典，错误响应带有
+            _azure_openai_instance 和 _azure_openai_status_code 元数据
         """
+        result = await self._forward_pipeline(method, path, body, headers, tried_instances)
+        return result if raw else result.to_legacy()
+
+    async def _forward_pipeline(self, method: str, path: str, body: Any, headers: Optional[Dict[str, str]],
+                                tried_instances: Optional[List[str]]) -> UpstreamResponse:
         if not self.instances:
             raise HTTPException(status_code=500, detail="No OpenAI instances configured")
         
-        # 初始化已尝试实例列表
-        if tried_instances is None:
-            tried_instances = []
-            # 初始化存储最后错误的变量
-            self.last_error_response = None
+        # 首次调用时经过缓存、去重和合并等处理，重试（tried_instances 不为空）时直接转发
+        if tried_instances is None and (self.cache is not None or self.embeddings_batcher is not None
+                                        or self.singleflight is not None):
+            key, refresh = None, False
+            if self.cache is not None:
+                key, refresh = self._response_cache_key(method, path, body, headers)
+            if key is not None and not refresh:
+                cached = await self.cache.get(key)
+                if cached is not None:
+                    return cached
+
+            async def fetch():
+                result = await self._dispatch(method, path, body, headers)
+                if key is not None and not result.is_error:
+                    await self.cache.set(key, result)
+                return result
+
+            flight_key = self._singleflight_key(method, path, body, headers)
+            if flight_key is not None:
+                # 相同的并发请求只向上游发送一次
+                return await self.singleflight.do(flight_key, fetch)
+            return await fetch()
         
-        # 获取未尝试过的实例
-        available_instances = [instance for instance in self.instances if instance['name'] not in tried_instances]
+        return await self._forward_upstream(method, path, body, headers, tried_instances)
+
+    async def _dispatch(self, method: str, path: str, body: Any, headers: Optional[Dict[str, str]]):
+        """把请求交给 embeddings 合并器，或直接转发到上游"""
+        if self.embeddings_batcher is not None and self.embeddings_batcher.accepts(method, path, body):
+            return await self.embeddings_batcher.submit(path, body, headers)
+        return await self._forward_upstream(method, path, body, headers)
+
+    async def _forward_upstream(self, method: str, path: str, body: Any, headers: Optional[Dict[str, str]],
+                                tried_instances: Optional[List[str]] = None):
+        """
+        跳过缓存和合并，直接在实例之间转发
+
+        失败后按重试策略换一个实例：只重试可重试的错误（见 RETRYABLE_STATUS 和连接错误），
+        重试前按带抖动的指数退避等待，受总截止时间、最多尝试次数和全局重试预算限制。
+        每次尝试的超时取截止时间的剩余部分。错误状态保存在本请求自己的 RetryState 中。
+        启用对冲时，每次尝试都可能并发一个备份请求（见 _hedged_attempt），备份也计入尝试次数。
+        """
+        # 只在部署了目标 deployment 的实例之间路由
+        request_path = parse_path(path)
+        eligible_instances = self.index.eligible(request_path.deployment)
+        if not eligible_instances:
+            raise self._deployment_not_found(request_path.deployment)
+        base_headers = self._prepare_headers(headers)
+        tokens = estimate_request_tokens(body, path)
+        affinity_key = self._affinity_key(request_path, body)
+        state = RetryState(self.retry_policy, self.retry_budget, tried_instances)
+        self.retry_budget.deposit()
+        hedge = self.hedger is not None and self.hedger.accepts(method, request_path.suffix, body)
+        if hedge:
+            self.hedger.budget.deposit()
         
-        # 如果所有实例都已尝试过，返回最后一个错误
-        if not available_instances:
-            # 直接返回保存的最后一个错误响应
-            if hasattr(self, 'last_error_response') and self.last_error_response:
-                return self.last_error_response
-            else:
-                raise HTTPException(status_code=502, detail="All OpenAI instances failed")
+        while True:
+            # 由负载均衡器从未尝试过、熔断器未打开且限流额度充足的实例中选择
+            try:
+                lease = await self.balancer.acquire(exclude=state.tried, tokens=tokens, instances=eligible_instances,
+                                                    affinity_key=affinity_key)
+            except CapacityExhausted as e:
+                if state.last_error is not None:
+                    return state.last_error
+                raise self._capacity_exhausted(e)
+            if lease is None:
+                break
             
-        instance = random.choice(available_instances)
-        tried_instances.append(instance['name'])
-        
-        try:
-            # 获取基础URL
-            base_url = instance['url'].rstrip('/')
+            if state.attempts:
+                self.metrics.failovers.inc(self.metrics.labels_for(lease.instance, request_path.deployment))
+            state.start_attempt(lease.instance["name"])
             
-            # 规范化路径 - 确保没有重复部分
-            # 1. 检查是否有重复的 'openai/' 前缀
-            normalized_path = path
-            if normalized_path.startswith('/'):
-                normalized_path = normalized_path[1:]
-                
-            # 2. 检查是否有多个 'openai/' 出现
-            # 只保留第一个 'openai/' 及其后面的内容
-            if normalized_path.startswith('openai/'):
-                openai_parts = normalized_path.split('openai/', 1)
-                if len(openai_parts) > 1:
-                    normalized_path = f"openai/{openai_parts[1]}"
+            attempt = functools.partial(self._attempt, method, request_path, base_headers, body, state)
+            if hedge:
+                outcome, result = await self._hedged_attempt(attempt, lease, state, tokens, eligible_instances,
+                                                             request_path.deployment)
             else:
-                # 如果路径不是以 openai/ 开头，添加它
-                normalized_path = f"openai/{normalized_path}"
-                
-            # 构建最终URL
-            full_url = f"{base_url}/{normalized_path}"
-            
-            # 过滤掉一些不应转发的请求头
-            excluded_headers = [
-                'host', 
-                'content-length', 
-                'connection',
-                'accept-encoding'
-            ]
-            
-            # 准备请求头
-            request_headers = {
-                k: v for k, v in (headers or {}).items() 
-                if k.lower() not in excluded_headers
-            }
-            
-            # 添加 Azure OpenAI 验证头
-            request_headers["api-key"] = instance['api_key']
-            if "content-type" not in request_headers:
-                request_headers["content-type"] = "application/json"
-            
-            print(f"Sending {method} request to: {full_url}")
-            
-            # 发送请求时使用类级别的客户端
-            try:
-                response = await self.client.request(
-                    method=method,
-                    url=full_url,
-                    json=body if isinstance(body, (dict, list)) else None,
-                    content=body if not isinstance(body, (dict, list)) else None,
-                    headers=request_headers
-                )
-                response.raise_for_status()
-                
-                # 尝试解析为JSON，如果失败则返回原始文本
-                try:
-                    return response.json()
-                except:
-                    return {"text": response.text}
-                
-            except httpx.HTTPStatusError as e:
-                # 记录错误
-                self.handle_error(e, instance)
-                
-                # 保存原始错误响应
-                try:
-                    # 直接使用原始响应对象
-                    status_code = e.response.status_code
-                    content_type = e.response.headers.get('content-type', '')
-                    
-                    # 根据内容类型解析响应
-                    if 'application/json' in content_type:
-                        response_data = e.response.json()
-                        # 添加额外的元数据
-                        response_data["_azure_openai_instance"] = instance["name"]
-                        response_data["_azure_openai_status_code"] = status_code
-                        self.last_error_response = response_data
-                    else:
-                        # 如果不是JSON，构造一个包含原始文本的JSON
-                        self.last_error_response = {
-                            "error": {
-                                "message": e.response.text,
-                                "code": status_code,
-                                "_azure_openai_instance": instance["name"]
-                            }
-                        }
-                except Exception as parse_error:
-                    # 处理无法解析响应的情况
-                    self.last_error_response = {
-                        "error": {
-                            "message": str(e),
-                            "type": "http_error",
-                            "code": getattr(e.response, 'status_code', 500),
-                            "_azure_openai_instance": instance["name"]
-                        }
-                    }
-                
-                # 尝试下一个实例
-                return await self.forward_full_request(method, path, body, headers, tried_instances)
+                outcome, result = await attempt(lease)
+            if outcome != _RETRY:
+                return result
+            state.last_error = result
             
+            # 还有未尝试的可用实例时退避后换一个；否则只在实例按 Retry-After 很快恢复时等待
+            has_next = bool(self.balancer.candidates(exclude=state.tried, instances=eligible_instances))
+            if not await state.retry(None if has_next else self.balancer.next_recovery(eligible_instances)):
+                break
+        
+        # 所有尝试都失败：返回最后一个错误
+        if state.last_error is not None:
+            return state.last_error
+        if not state.attempts:
+            # 所有实例都处于冷却中，直接拒绝，不再白白发送一次必然失败的请求
+            raise self._instances_unavailable()
+        raise HTTPException(status_code=502, detail="All OpenAI instances failed")
+
+    async def _attempt(self, method: str, request_path, base_headers: Dict[str, str], body: Any,
+                       state: RetryState, lease: Lease):
+        """
+        向租用的实例发送一次非流式请求，结束后归还实例占用
+
+        Returns:
+            (结果类型, UpstreamResponse)：_OK 时为上游响应；_RETRY（可以换实例重试）和 _FAIL（不应重试）时
+            为返回给调用方的错误
+        """
+        instance = lease.instance
+        labels = self.metrics.labels_for(instance, request_path.deployment)
+        # 使用启动时预先计算好的 URL 前缀和认证头
+        route = self.index.route(instance)
+        full_url = route.url_for(request_path)
+        request_headers = {**base_headers, **route.headers}
+        access_log.log("upstream_request", method=method, url=full_url, instance=instance["name"])
+        
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(
+                method=method,
+                url=full_url,
+                headers=request_headers,
+                timeout=self._attempt_timeout(state.remaining()),
+                extensions=self._trace_extensions(),
+                **self._body_kwargs(body, request_headers)
+            )
+        except asyncio.CancelledError:
+            # 客户端断开或对冲中落败，没有结果可记录，归还半开状态下的试探名额
+            if self.hedger is not None:
+                # 已等待的时间是这次请求延迟的下限，避免慢请求被取消后分位数只剩快的样本
+                self.hedger.observe(labels, time.perf_counter() - started)
+            lease.release()
+            raise
         except Exception as e:
-            # 记录其他类型错误
             self.handle_error(e, instance)
+            self.metrics.observe_response(labels, "error")
+            lease.release()
+            state.last_exception = e
+            if not isinstance(e, httpx.TransportError):
+                # 不是上游的问题（例如请求体无法发送），换实例也没有用
+                return _FAIL, self._exception_result(e, instance)
+            # 连接错误、超时等计入实例的失败次数
+            lease.record_error()
+            return _RETRY, self._exception_result(e, instance)
+        
+        latency = time.perf_counter() - started
+        self.metrics.observe_response(labels, response.status_code, latency)
+        server_timing.record("upstream", latency)
+        lease.record_response(response.status_code, response.headers)
+        lease.release()
+        # 响应体按原始字节返回，不解析 JSON
+        result = UpstreamResponse.from_httpx(response, instance["name"])
+        if response.status_code < 400:
+            if self.hedger is not None:
+                self.hedger.observe(labels, latency)
+            # token 用量直接从原始字节中读取
+            self.metrics.observe_usage(labels, result.content)
+            return _OK, result
+        self.handle_error(httpx.HTTPStatusError(
+            f"status {response.status_code}", request=response.request, response=response
+        ), instance)
+        return (_RETRY if is_retryable_status(response.status_code) else _FAIL), result
+
+    async def _hedged_attempt(self, attempt, lease: Lease, state: RetryState, tokens: int,
+                              eligible_instances: List[Dict[str, Any]], deployment: Optional[str]):
+        """
+        发送主请求；超过对冲延迟仍未返回时，向另一个健康实例发送备份请求
+
+        先得到结果（成功或不应重试的错误）的一方胜出，另一方被取消；
+        一方以可重试的错误结束时继续等待另一方。没有其他可用实例或对冲预算不足时只等主请求。
+        """
+        labels = self.metrics.labels_for(lease.instance, deployment)
+        tasks = [asyncio.ensure_future(attempt(lease))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=max(min(self.hedger.delay_for(labels), state.remaining()), 0))
+            if done:
+                return tasks[0].result()
+            backup_lease = await self._hedge_lease(state, tokens, eligible_instances)
+            if backup_lease is None:
+                return await tasks[0]
+            state.start_attempt(backup_lease.instance["name"])
+            backup_labels = self.metrics.labels_for(backup_lease.instance, deployment)
+            tasks.append(asyncio.ensure_future(attempt(backup_lease)))
             
-            # 存储错误信息
-            self.last_error_response = {
-                "error": {
-                    "message": str(e),
-                    "type": "runtime_error",
-                    "_azure_openai_instance": instance["name"]
-                }
+            pending = set(tasks)
+            result = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    if result[0] != _RETRY:
+                        self.hedger.hedges.inc(backup_labels + ("won" if task is tasks[1] else "lost",))
+                        return result
+            self.hedger.hedges.inc(backup_labels + ("failed",))
+            return result
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            # 等待落败的请求归还实例占用
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _affinity_key(self, request_path, body: Any) -> Optional[int]:
+        """开启前缀亲和路由时，计算 chat/completions 请求提示前缀的哈希，使共享长前缀的请求命中同一实例的提示缓存"""
+        if self.balancer.ring is None or not request_path.suffix.split("?", 1)[0].endswith("/chat/completions"):
+            return None
+        return prefix_key(body, request_path.deployment, self.affinity_chars)
+
+    async def _hedge_lease(self, state: RetryState, tokens: int,
+                           eligible_instances: List[Dict[str, Any]]) -> Optional[Lease]:
+        """为备份请求选择一个未尝试过的实例；不等待限流额度"""
+        if not self.balancer.candidates(exclude=state.tried, instances=eligible_instances):
+            return None
+        if not self.hedger.budget.try_withdraw():
+            return None
+        try:
+            return await self.balancer.acquire(exclude=state.tried, tokens=tokens, instances=eligible_instances,
+                                               max_wait=0.0)
+        except CapacityExhausted:
+            return None
+
+    @staticmethod
+    def _exception_result(error: Exception, instance: Dict[str, Any]) -> UpstreamResponse:
+        """没有收到上游响应（连接错误、超时等）时返回给调用方的 502 错误"""
+        return UpstreamResponse.from_json({
+            "error": {
+                "message": str(error),
+                "type": "runtime_error",
+                "_azure_openai_instance": instance["name"]
             }
-            
-            # 尝试下一个实例
-            return await self.forward_full_request(method, path, body, headers, tried_instances)
+        }, status_code=502, instance=instance["name"])
+
+    def _attempt_timeout(self, remaining: float) -> httpx.Timeout:
+        """单次尝试的超时：总截止时间的剩余部分，建立连接的时间另有上限"""
+        remaining = max(remaining, 0.001)
+        return httpx.Timeout(remaining, connect=min(self.connect_timeout, remaining))
 
     # 保留原有的方法以兼容旧代码
     async def forward_request(self, payload: dict, endpoint_path: str = None, tried_instances=None) -> Dict[str, Any]:
@@ -179,106 +500,304 @@ class OpenAIService:
         return await self.forward_full_request("POST", endpoint_path, payload, headers, tried_instances)
 
     async def forward_streaming_request(self, method: str, path: str, body: Any = None, headers: Dict[str, str] = None, tried_instances=None):
-        """处理流式请求，如聊天完成的流式响应"""
+        """
+        处理流式请求，如聊天完成的流式响应
+        
+        先打开上游流并等待状态行和第一个 SSE 事件，确认成功后才向客户端提交响应。
+        在此之前的连接错误、可重试的错误状态或首字超时都会按重试策略透明地切换到下一个实例，
+        总截止时间只限制到第一个事件为止；开始转发后如果上游中断，则向客户端发送 SSE error 事件。
+        """
         if not self.instances:
             raise HTTPException(status_code=500, detail="No OpenAI instances configured")
         
-        # 初始化已尝试实例列表
-        if tried_instances is None:
-            tried_instances = []
-    
-        # 获取未尝试过的实例
-        available_instances = [instance for instance in self.instances if instance['name'] not in tried_instances]
+        # 相同的并发流式请求共享一个上游流
+        if tried_instances is None and self.singleflight is not None and self.singleflight.fan_out_streams:
+            flight_key = self._singleflight_key(method, path, body, headers)
+            if flight_key is not None:
+                return await self.singleflight.stream(
+                    flight_key,
+                    lambda: self.forward_streaming_request(method, path, body, headers, [])
+                )
         
-        if not available_instances:
-            raise HTTPException(status_code=502, detail="All OpenAI instances failed")
+        # 确保请求 stream=true
+        if isinstance(body, dict):
+            body["stream"] = True
         
-        instance = random.choice(available_instances)
-        tried_instances.append(instance['name'])
+        # 只在部署了目标 deployment 的实例之间路由
+        request_path = parse_path(path)
+        eligible_instances = self.index.eligible(request_path.deployment)
+        if not eligible_instances:
+            raise self._deployment_not_found(request_path.deployment)
+        base_headers = self._prepare_headers(headers)
         
-        try:
-            # 获取基础URL
-            base_url = instance['url'].rstrip('/')
-            
-            # 规范化路径 - 确保没有重复部分
-            # 1. 检查是否有重复的 'openai/' 前缀
-            normalized_path = path
-            if normalized_path.startswith('/'):
-                normalized_path = normalized_path[1:]
-                
-            # 2. 检查是否有多个 'openai/' 出现
-            # 只保留第一个 'openai/' 及其后面的内容
-            if normalized_path.startswith('openai/'):
-                openai_parts = normalized_path.split('openai/', 1)
-                if len(openai_parts) > 1:
-                    normalized_path = f"openai/{openai_parts[1]}"
-            else:
-                # 如果路径不是以 openai/ 开头，添加它
-                normalized_path = f"openai/{normalized_path}"
-                
-            # 构建最终URL
-            full_url = f"{base_url}/{normalized_path}"
+        tokens = estimate_request_tokens(body, path)
+        affinity_key = self._affinity_key(request_path, body)
+        state = RetryState(self.retry_policy, self.retry_budget, tried_instances)
+        self.retry_budget.deposit()
+        
+        while True:
+            # 由负载均衡器从未尝试过、熔断器未打开且限流额度充足的实例中选择
+            try:
+                lease = await self.balancer.acquire(exclude=state.tried, tokens=tokens, instances=eligible_instances,
+                                                    affinity_key=affinity_key)
+            except CapacityExhausted as e:
+                if state.last_error is not None:
+                    return state.last_error
+                raise self._capacity_exhausted(e)
+            if lease is None:
+                break
             
-            # 过滤掉一些不应转发的请求头
-            excluded_headers = [
-                'host', 
-                'content-length', 
-                'connection',
-                'accept-encoding'
-            ]
+            instance = lease.instance
+            labels = self.metrics.labels_for(instance, request_path.deployment)
+            if state.attempts:
+                self.metrics.failovers.inc(labels)
+            state.start_attempt(instance["name"])
             
-            # 准备请求头
-            request_headers = {
-                k: v for k, v in (headers or {}).items() 
-                if k.lower() not in excluded_headers
-            }
+            # 使用启动时预先计算好的 URL 前缀和认证头
+            route = self.index.route(instance)
+            full_url = route.url_for(request_path)
+            request_headers = {**base_headers, **route.headers}
             
-            # 添加 Azure OpenAI 验证头
-            request_headers["api-key"] = instance['api_key']
-            if "content-type" not in request_headers:
-                request_headers["content-type"] = "application/json"
+            # 要求上游不压缩，aiter_bytes 不需要解压，分块按原样转发
+            request_headers["accept-encoding"] = "identity"
             
-            # 确保请求 stream=true
-            if isinstance(body, dict):
-                body["stream"] = True
+            # 还有其他候选实例时限制首字时间，最后一个候选实例只受总截止时间限制
+            has_fallback = bool(self.balancer.candidates(exclude=state.tried, instances=eligible_instances))
+            deadline = min(self.stream_ttft_timeout, state.remaining()) if has_fallback else state.remaining()
             
-            async def stream_generator():
-                async with httpx.AsyncClient(timeout=600.0) as client:
-                    async with client.stream(
-                        method=method,
-                        url=full_url,
-                        json=body,
-                        headers=request_headers
-                    ) as response:
-                        if response.status_code != 200:
-                            # 非流式错误处理
-                            error_content = await response.read()
-                            try:
-                                error_json = json.loads(error_content)
-                                yield json.dumps(error_json)
-                            except:
-                                yield json.dumps({"error": {"message": error_content.decode('utf-8')}})
-                            return
-                        
-                        # 处理流式响应
-                        async for line in response.aiter_lines():
-                            if line.strip():
-                                # 过滤流式响应格式
-                                line = re.sub(r'^data: ', '', line)
-                                if line != "[DONE]":
-                                    yield line + "\n"
+            started = time.perf_counter()
+            try:
+                response, chunks, first_bytes = await asyncio.wait_for(
+                    self._open_stream(method, full_url, body, request_headers, state.remaining()),
+                    timeout=max(deadline, 0.001)
+                )
+            except asyncio.TimeoutError as e:
+                state.last_exception = e
+                self.handle_error(f"no first event within {deadline:.1f}s", instance)
+                self.metrics.observe_response(labels, "timeout")
+                lease.record_error()
+                lease.release()
+            except asyncio.CancelledError:
+                lease.release()
+                raise
+            except Exception as e:
+                state.last_exception = e
+                self.handle_error(e, instance)
+                self.metrics.observe_response(labels, "error")
+                lease.release()
+                if not isinstance(e, httpx.TransportError):
+                    raise HTTPException(status_code=502, detail=str(e))
+                lease.record_error()
+            else:
+                # 首字时间作为实例的延迟样本
+                lease.record_response(response.status_code, response.headers, kind=TTFT)
+                self.metrics.observe_response(labels, response.status_code)
+                if response.status_code == 200:
+                    ttft = time.perf_counter() - started
+                    self.metrics.ttft.observe(labels, ttft)
+                    server_timing.record("upstream-ttft", ttft)
+                    return StreamingResponse(
+                        self._relay_stream(response, chunks, first_bytes, lease, labels),
+                        media_type="text/event-stream"
+                    )
+                lease.release()
+                # 上游在返回任何事件之前就失败了，保存错误；可重试时尝试下一个实例
+                self.handle_error(f"status {response.status_code}", instance)
+                passthrough_headers = {
+                    k: v for k, v in response.headers.items()
+                    if k.lower() in ("retry-after", "retry-after-ms", "x-ms-retry-after-ms")
+                }
+                state.last_error = Response(
+                    content=first_bytes,
+                    status_code=response.status_code,
+                    headers=passthrough_headers,
+                    media_type=response.headers.get("content-type", "application/json")
+                )
+                if not is_retryable_status(response.status_code):
+                    return state.last_error
             
-            return StreamingResponse(
-                stream_generator(),
-                media_type="text/event-stream"
-            )
+            has_next = bool(self.balancer.candidates(exclude=state.tried, instances=eligible_instances))
+            if not await state.retry(None if has_next else self.balancer.next_recovery(eligible_instances)):
+                break
+        
+        # 所有尝试都失败：优先返回上游的原始错误和状态码
+        if state.last_error is not None:
+            return state.last_error
+        if state.last_exception is None:
+            # 一个实例都没有尝试，说明全部处于冷却中
+            raise self._instances_unavailable()
+        raise HTTPException(status_code=502, detail=str(state.last_exception) or "All OpenAI instances failed")
+
+    async def _open_stream(self, method: str, full_url: str, body: Any, request_headers: Dict[str, str],
+                           remaining: float):
+        """
+        打开上游流并读取到第一个完整的 SSE 事件为止
+        
+        Returns:
+            (response, 剩余分块的迭代器, 已读取的字节)；非 200 时已读取的字节为完整错误响应体
+        """
+        upstream_request = self.client.build_request(
+            method=method,
+            url=full_url,
+            headers=request_headers,
+            # 读超时作用于每个分块，不限制整个流的时长
+            timeout=httpx.Timeout(self.retry_policy.timeout, connect=min(self.connect_timeout, max(remaining, 0.001))),
+            extensions=self._trace_extensions(),
+            **self._body_kwargs(body, request_headers)
+        )
+        # 使用共享连接池，避免每次流式请求都重新建立 TLS/HTTP2 连接
+        response = await self.client.send(upstream_request, stream=True)
+        try:
+            if response.status_code != 200:
+                error_content = await response.aread()
+                await response.aclose()
+                return response, None, error_content
             
-        except Exception as e:
-            # 如果当前实例失败，尝试下一个
-            if len(tried_instances) < len(self.instances):
-                return await self.forward_streaming_request(method, path, body, headers, tried_instances)
-            else:
-                raise HTTPException(status_code=502, detail=str(e))
+            chunks = response.aiter_bytes()
+            first_bytes = b""
+            async for chunk in chunks:
+                first_bytes += chunk
+                if any(terminator in first_bytes for terminator in _EVENT_TERMINATORS):
+                    break
+            return response, chunks, first_bytes
+        except BaseException:
+            # 包括首字超时导致的取消，确保连接归还连接池
+            await response.aclose()
+            raise
+
+    async def _relay_stream(self, response: httpx.Response, chunks, first_bytes: bytes, lease: Lease, labels: tuple):
+        """把已预读的首个事件和剩余的上游分块按原样转发给客户端，结束后归还实例占用"""
+        instance = lease.instance
+        metrics = self.metrics
+        # include_usage 的最后一个事件可能跨越多个分块，由 UsageReader 拼接后读取一次
+        usage_reader = UsageReader()
+        last_chunk = first_bytes
+        try:
+            if first_bytes:
+                usage = usage_reader.feed(first_bytes)
+                if usage is not None:
+                    metrics.observe_tokens(labels, usage)
+                yield first_bytes
+            # 上游的 SSE 分块（含 "data: " 前缀和 [DONE]）按原样转发，不逐行解码
+            previous = time.perf_counter()
+            async for chunk in chunks:
+                now = time.perf_counter()
+                metrics.chunk_gap.observe(labels, now - previous)
+                previous = now
+                if not usage_reader.done:
+                    usage = usage_reader.feed(chunk)
+                    if usage is not None:
+                        metrics.observe_tokens(labels, usage)
+                last_chunk = chunk
+                yield chunk
+        except httpx.HTTPError as e:
+            # 已经开始向客户端发送数据，无法再切换实例，改为发送 SSE 错误事件
+            self.handle_error(e, instance)
+            lease.record_error()
+            error_event = {
+                "error": {
+                    "message": f"Upstream stream interrupted: {e}",
+                    "type": "upstream_error",
+                    "code": "stream_interrupted"
+                }
+            }
+            # 如果中断发生在事件中间，先结束这个不完整的事件
+            prefix = b"" if last_chunk.endswith(_EVENT_TERMINATORS) else b"\n\n"
+            yield prefix + b"event: error\ndata: " + json.dumps(error_event).encode() + b"\n\n"
+        finally:
+            lease.release()
+            await response.aclose()
+
+    def _instances_unavailable(self) -> HTTPException:
+        """所有实例都被熔断时返回 503，并告知客户端最早恢复的时间"""
+        cooldown = self.balancer.min_cooldown()
+        return HTTPException(
+            status_code=503,
+            detail={"error": {"message": "All OpenAI instances are cooling down", "code": "instances_unavailable"}},
+            headers={"Retry-After": str(max(math.ceil(cooldown), 1))}
+        )
+
+    @staticmethod
+    def _prepare_headers(headers: Optional[Dict[str, str]]) -> Dict[str, str]:
+        """过滤客户端请求头，每个请求只做一次，各次尝试再合并实例的认证头"""
+        request_headers = {
+            k: v for k, v in (headers or {}).items()
+            if k.lower() not in EXCLUDED_HEADERS
+        }
+        if "content-type" not in request_headers:
+            request_headers["content-type"] = "application/json"
+        return request_headers
+
+    @staticmethod
+    def _deployment_not_found(deployment: Optional[str]) -> HTTPException:
+        """没有任何实例托管该 deployment 时直接返回 404，不再逐个实例试错"""
+        return HTTPException(
+            status_code=404,
+            detail={"error": {"code": "DeploymentNotFound", "message": f"No instance hosts deployment '{deployment}'"}}
+        )
+
+    def _response_cache_key(self, method: str, path: str, body: Any, headers: Optional[Dict[str, str]]):
+        """
+        计算响应缓存的键
+        
+        Returns:
+            (缓存键, 是否强制刷新)；不可缓存或请求头要求绕过缓存时键为 None
+        """
+        control = ""
+        for k, v in (headers or {}).items():
+            if k.lower() == CACHE_CONTROL_HEADER:
+                control = v.strip().lower()
+                break
+        if control == "bypass" or not is_cacheable(method, path, body):
+            return None, False
+        return cache_key(parse_path(path).normalized, body), control == "refresh"
+
+    def _singleflight_key(self, method: str, path: str, body: Any, headers: Optional[Dict[str, str]]) -> Optional[str]:
+        """
+        计算合并进行中请求的键
+
+        deterministic 模式只合并结果确定的请求（与响应缓存相同的条件），
+        all 模式合并所有请求体相同的 POST 请求。x-lb-cache: bypass 同样跳过合并。
+        """
+        if self.singleflight is None or method != "POST" or not isinstance(body, (bytes, bytearray)) or not body:
+            return None
+        for k, v in (headers or {}).items():
+            if k.lower() == CACHE_CONTROL_HEADER and v.strip().lower() == "bypass":
+                return None
+        if self.singleflight_mode != "all" and not is_cacheable(method, path, body):
+            return None
+        return cache_key(parse_path(path).normalized, body)
+
+    def _capacity_exhausted(self, error: CapacityExhausted) -> HTTPException:
+        """所有实例的限流额度（或并发上限）都不足时在本地返回 429，而不是发到上游被拒绝"""
+        return HTTPException(
+            status_code=429,
+            detail={"error": {"message": str(error), "code": "capacity_exhausted"}},
+            headers={"Retry-After": str(max(math.ceil(error.retry_after), 1))}
+        )
+
+    @staticmethod
+    def _trace_extensions() -> Dict[str, Any]:
+        """请求绑定了 Server-Timing 时，通过 httpx 的 trace 扩展记录上游建连和首字节耗时"""
+        timing = server_timing.current()
+        return {"trace": timing.httpx_trace()} if timing is not None else {}
+
+    @staticmethod
+    def _body_kwargs(body: Any, request_headers: Dict[str, str]) -> Dict[str, Any]:
+        """
+        根据请求体类型选择 httpx 的传参方式
+
+        - 原始字节直接作为 content 发送，不做解析和重新编码
+        - ReplayableBody 流式发送，已知长度时保留 content-length 以避免分块编码
+        - dict/list 仅用于兼容旧的调用方式，按 JSON 编码
+        """
+        if isinstance(body, (dict, list)):
+            return {"json": body}
+        if isinstance(body, ReplayableBody):
+            if body.content_length is not None:
+                request_headers["content-length"] = str(body.content_length)
+            return {"content": body}
+        return {"content": body or None}
 
     def handle_error(self, error, instance):
         error_message = str(error)
@@ -293,17 +812,24 @@ class OpenAIService:
             except:
                 response_text = "无法读取响应内容"
                 
-        print(f"Error with instance {instance['name']}: {status_code} - {response_text or error_message}")
+        access_log.log(
+            "upstream_error", level="warning",
+            instance=instance["name"], status=status_code, error=(response_text or error_message)[:2000]
+        )
 
     def log_request(self, endpoint: str, payload: dict):
         # 实现日志记录逻辑
-        # 可以移除敏感信息后再记录
+        # 可以移除敏感信息后再记录（api_key 等字段由日志管道在写出前统一替换）
         sanitized_payload = payload.copy() if isinstance(payload, dict) else {"data": str(payload)[:100] + "..."}
-        if isinstance(sanitized_payload, dict) and "api_key" in sanitized_payload:
-            sanitized_payload["api_key"] = "***"
-            
-        print(f"Request to {endpoint} with payload: {json.dumps(sanitized_payload)}")
+        access_log.log("request_payload", endpoint=endpoint, payload=sanitized_payload)
 
     # 在类中添加关闭方法
     async def close(self):
-        await self.client.aclose()
\ No newline at end of file
+        for task in [self.warming, self._keepalive_task, *self._drain_tasks]:
+            if task is not None:
+                task.cancel()
+        await self.client.aclose()
+        if self.cache is not None:
+            self.cache.close()
+        if self.shared_state is not None:
+            self.shared_state.close()
\ No newline at end of file
@@ -0,0 +1,134 @@
+import asyncio
+import random
+import time
+from typing import Any, Collection, List, Optional
+
+from src.utils.metrics import CallbackMetric
+
+# 换一个实例重试可能成功的状态码：限流、超时、服务端错误，以及实例自身的
+# 配置问题（密钥无效、deployment 不存在）。其余 4xx（400、413、422 等）是请求本身的问题，
+# 换实例也会得到同样的结果，直接返回给客户端
+RETRYABLE_STATUS = frozenset((401, 403, 404, 408, 429, 500, 502, 503, 504))
+
+
+def is_retryable_status(status_code: int) -> bool:
+    return status_code in RETRYABLE_STATUS
+
+
+class RetryBudget:
+    """
+    全局重试预算（令牌桶）
+
+    每个新请求存入 ratio 个令牌，每次重试取出一个，所以持续故障时重试量最多约为
+    正常流量的 ratio 倍，不会把故障放大成重试风暴。另外每秒补充 min_per_second 个令牌，
+    保证低流量时也能重试。
+    """
+
+    def __init__(self, ratio: float = 0.2, min_per_second: float = 5.0, clock=time.monotonic):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.capacity = max(min_per_second * 10, 10.0)
+        self.clock = clock
+        self.balance = self.capacity
+        self.updated = clock()
+        self.retries = 0
+        self.exhausted = 0
+
+    def _refill(self):
+        now = self.clock()
+        self.balance = min(self.balance + (now - self.updated) * self.min_per_second, self.capacity)
+        self.updated = now
+
+    def deposit(self):
+        """每个新请求调用一次"""
+        self.balance = min(self.balance + self.ratio, self.capacity)
+
+    def try_withdraw(self) -> bool:
+        """重试前调用；预算不足时返回 False"""
+        self._refill()
+        if self.balance < 1.0:
+            self.exhausted += 1
+            return False
+        self.balance -= 1.0
+        self.retries += 1
+        return True
+
+    def collectors(self) -> List[Any]:
+        return [
+            CallbackMetric("lb_retries_total", "Retries allowed by the retry budget", (),
+                           lambda: [((), self.retries)], kind="counter"),
+            CallbackMetric("lb_retry_budget_exhausted_total", "Retries refused because the retry budget was empty", (),
+                           lambda: [((), self.exhausted)], kind="counter"),
+        ]
+
+
+class RetryPolicy:
+    """
+    重试策略：总截止时间、最多尝试次数和带抖动的指数退避
+
+    max_wait 是所有候选实例都因 Retry-After 处于冷却时，愿意等待它们恢复的最长时间。
+    """
+
+    def __init__(self, timeout: float = 600.0, max_attempts: int = 3, backoff_base: float = 0.05,
+                 backoff_max: float = 1.0, max_wait: float = 2.0):
+        self.timeout = timeout
+        self.max_attempts = max(max_attempts, 1)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_wait = max_wait
+
+    def backoff(self, retry: int) -> float:
+        """第 retry 次重试前的等待时间（full jitter）"""
+        return random.uniform(0.0, min(self.backoff_max, self.backoff_base * (2 ** (retry - 1))))
+
+
+class RetryState:
+    """
+    一个请求的重试状态
+
+    已尝试的实例、最后一个错误和截止时间都属于单个请求，不在并发请求之间共享。
+    """
+
+    def __init__(self, policy: RetryPolicy, budget: RetryBudget, tried: Optional[Collection[str]] = None,
+                 clock=time.monotonic):
+        self.policy = policy
+        self.budget = budget
+        self.clock = clock
+        self.deadline = clock() + policy.timeout
+        self.tried: List[str] = list(tried or ())
+        self.attempts = 0
+        # 最后一个可返回给客户端的错误（上游错误响应），以及没有响应时的异常
+        self.last_error: Any = None
+        self.last_exception: Optional[BaseException] = None
+
+    def remaining(self) -> float:
+        return self.deadline - self.clock()
+
+    def start_attempt(self, instance_name: str):
+        self.attempts += 1
+        self.tried.append(instance_name)
+
+    async def retry(self, cooldown: Optional[float] = None) -> bool:
+        """
+        决定失败后能否再试一次；可以时先等待，再返回 True
+
+        cooldown 为 None 表示还有未尝试的可用实例，按带抖动的指数退避等待；
+        否则候选实例都已尝试过，只有它们中最早按 Retry-After 恢复的时间（cooldown）
+        不超过 max_wait 时才等待，然后重新允许尝试所有实例。
+        尝试次数、剩余时间或全局重试预算不足时返回 False。
+        """
+        if self.attempts >= self.policy.max_attempts:
+            return False
+        if cooldown is None:
+            delay = self.policy.backoff(self.attempts)
+        elif 0 < cooldown <= self.policy.max_wait:
+            delay = cooldown
+        else:
+            return False
+        if self.remaining() <= delay or not self.budget.try_withdraw():
+            return False
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if cooldown is not None:
+            self.tried.clear()
+        return True
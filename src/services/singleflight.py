@@ -0,0 +1,139 @@
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from fastapi.responses import StreamingResponse
+
+
+def _consume_exception(task: asyncio.Future):
+    # 所有等待者都已离开时，避免 "exception was never retrieved" 警告
+    if not task.cancelled():
+        task.exception()
+
+
+class StreamBroadcast:
+    """
+    把一个上游 SSE 流分发给多个订阅者
+
+    后台任务读取上游分块并缓存在内存中，订阅者各自按自己的速度读取，
+    中途加入的订阅者从头补发已缓存的分块。所有订阅者都断开后停止读取上游。
+    """
+
+    def __init__(self, iterator: AsyncIterator[bytes], media_type: Optional[str], on_done: Callable[[], None]):
+        self.media_type = media_type
+        self.chunks: List[bytes] = []
+        self.done = False
+        self.subscribers = 0
+        self._waiters: List[asyncio.Future] = []
+        self._on_done = on_done
+        self.task = asyncio.ensure_future(self._pump(iterator))
+        self.task.add_done_callback(_consume_exception)
+
+    async def _pump(self, iterator: AsyncIterator[bytes]):
+        try:
+            async for chunk in iterator:
+                self.chunks.append(chunk)
+                self._wake()
+        finally:
+            self.done = True
+            self._on_done()
+            self._wake()
+            aclose = getattr(iterator, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    def _wake(self):
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def response(self) -> StreamingResponse:
+        # 在返回响应时就计入订阅者，避免先到的订阅者断开时误停上游
+        self.subscribers += 1
+        return StreamingResponse(self._subscribe(), media_type=self.media_type)
+
+    async def _subscribe(self) -> AsyncIterator[bytes]:
+        position = 0
+        try:
+            while True:
+                if position < len(self.chunks):
+                    # 落后的订阅者一次补发所有积压的分块
+                    end = len(self.chunks)
+                    yield self.chunks[position] if end - position == 1 else b"".join(self.chunks[position:end])
+                    position = end
+                elif self.done:
+                    return
+                else:
+                    waiter = asyncio.get_running_loop().create_future()
+                    self._waiters.append(waiter)
+                    await waiter
+        finally:
+            self.subscribers -= 1
+            if not self.subscribers and not self.done:
+                self.task.cancel()
+
+
+class SingleFlight:
+    """
+    合并正在进行中的相同请求
+
+    相同键（deployment 路径 + 规范化请求体哈希）的并发请求只向上游发送一次，
+    所有等待者拿到同一个结果或同一个异常。fan_out_streams 为 True 时，
+    相同的流式请求共享一个上游流，通过 StreamBroadcast 分发给每个客户端。
+    上游调用在独立任务中执行，发起者断开不会影响其他等待者。
+    """
+
+    def __init__(self, fan_out_streams: bool = False):
+        self.fan_out_streams = fan_out_streams
+        self.calls: Dict[str, asyncio.Future] = {}
+        self.streams: Dict[str, asyncio.Future] = {}
+        self.leaders = 0
+        self.shared = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        future = self.calls.get(key)
+        if future is None:
+            self.leaders += 1
+            future = self.calls[key] = asyncio.ensure_future(fn())
+            future.add_done_callback(lambda f: self._forget(self.calls, key, f))
+            future.add_done_callback(_consume_exception)
+        else:
+            self.shared += 1
+        # 结果（UpstreamResponse）不会被修改，所有等待者共享同一个对象
+        return await asyncio.shield(future)
+
+    async def stream(self, key: str, open_stream: Callable[[], Awaitable[Any]]) -> Any:
+        future = self.streams.get(key)
+        if future is None:
+            self.leaders += 1
+            future = self.streams[key] = asyncio.ensure_future(self._open(key, open_stream))
+            future.add_done_callback(_consume_exception)
+        else:
+            self.shared += 1
+        result = await asyncio.shield(future)
+        if isinstance(result, StreamBroadcast):
+            return result.response()
+        return result
+
+    async def _open(self, key: str, open_stream: Callable[[], Awaitable[Any]]) -> Any:
+        task = asyncio.current_task()
+        try:
+            response = await open_stream()
+        except BaseException:
+            self._forget(self.streams, key, task)
+            raise
+        if not isinstance(response, StreamingResponse):
+            # 上游错误不需要分发，后来的相同请求重新发起
+            self._forget(self.streams, key, task)
+            return response
+        # 流结束前到达的相同请求都加入这个广播
+        return StreamBroadcast(
+            response.body_iterator,
+            response.media_type,
+            on_done=lambda: self._forget(self.streams, key, task)
+        )
+
+    @staticmethod
+    def _forget(table: Dict[str, asyncio.Future], key: str, future: asyncio.Future):
+        if table.get(key) is future:
+            del table[key]
@@ -0,0 +1,163 @@
+import hashlib
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from src.utils.access_log import access_log
+from src.utils.metrics import CallbackMetric
+
+
+class _Allowance:
+    """
+    一个按分钟计的配额（令牌桶）：容量为 limit，每秒补充 limit/60
+
+    余额可以为负：token 用量在响应返回后才知道，超出的部分从之后的额度中扣除。
+    limit 为 0 表示不限制。
+    """
+
+    __slots__ = ("limit", "balance", "updated")
+
+    def __init__(self, limit: float, now: float):
+        self.limit = limit
+        self.balance = limit
+        self.updated = now
+
+    def _refill(self, now: float):
+        self.balance = min(self.balance + self.limit / 60.0 * (now - self.updated), self.limit)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """余额达到 amount 还需要的秒数；不限制或余额足够时为 0"""
+        if not self.limit:
+            return 0.0
+        self._refill(now)
+        if self.balance >= amount:
+            return 0.0
+        return (min(amount, self.limit) - self.balance) / (self.limit / 60.0)
+
+    def take(self, amount: float, now: float):
+        if self.limit:
+            self._refill(now)
+            self.balance -= amount
+
+
+class Tenant:
+    """
+    一个租户（API 密钥）的 RPM/TPM 配额和用量
+
+    admit 在请求进入上游之前检查并扣除一个请求。请求体读完后 reserve 先按估算
+    （输入 + 最大输出，与 Azure 的 TPM 计算方式相同）扣除 token，响应中出现 usage
+    （非流式响应的 usage 字段，流式响应开启 include_usage 时的最后分块）后 charge 按实际用量多退少补。
+    没有报告 usage 的流式响应按估算计费，因此不开启 include_usage 也不能绕过 TPM 配额。
+    token 余额用完（为负）后，新请求在余额恢复之前被拒绝。
+    """
+
+    def __init__(self, name: str, rpm: float = 0, tpm: float = 0, clock=time.monotonic):
+        self.name = name
+        self.clock = clock
+        now = clock()
+        self.requests_allowance = _Allowance(rpm, now)
+        self.tokens_allowance = _Allowance(tpm, now)
+        self.requests = 0
+        self.rejected = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        # 响应没有报告 usage、按估算扣除的 token
+        self.estimated_tokens = 0
+
+    def admit(self) -> float:
+        """允许时扣除一个请求并返回 0，否则返回需要等待的秒数"""
+        now = self.clock()
+        wait = max(self.requests_allowance.wait_time(1, now), self.tokens_allowance.wait_time(1, now))
+        if wait > 0:
+            self.rejected += 1
+            return wait
+        self.requests_allowance.take(1, now)
+        self.requests += 1
+        return 0.0
+
+    def reserve(self, tokens: int) -> int:
+        """按估算预先扣除 token，返回扣除的数量（之后传给 charge 或 settle）"""
+        if tokens > 0:
+            self.tokens_allowance.take(tokens, self.clock())
+        return max(tokens, 0)
+
+    def charge(self, prompt_tokens: int, completion_tokens: int, reserved: int = 0):
+        """按 usage 报告的实际用量扣除 token，reserved 为之前按估算已经扣除的部分"""
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.tokens_allowance.take(prompt_tokens + completion_tokens - reserved, self.clock())
+
+    def settle(self, reserved: int, failed: bool):
+        """响应结束时仍没有 usage：失败的请求退回预扣的 token，成功的请求按估算计费"""
+        if not reserved:
+            return
+        if failed:
+            self.tokens_allowance.take(-reserved, self.clock())
+        else:
+            self.estimated_tokens += reserved
+
+
+
+def key_digest(key: bytes) -> bytes:
+    return hashlib.sha256(key).digest()
+
+
+class TenantRegistry:
+    """
+    按密钥查找租户
+
+    只保存密钥的 SHA-256 摘要：查找时计算摘要后在字典中 O(1) 查找。
+    配置中可以直接写摘要（key_sha256），不必保存明文密钥。
+    """
+
+    def __init__(self, tenants: Iterable[Tuple[bytes, Tenant]] = ()):
+        self._by_digest: Dict[bytes, Tenant] = dict(tenants)
+
+    @classmethod
+    def from_config(cls, entries: List[Dict[str, Any]], clock=time.monotonic) -> "TenantRegistry":
+        """
+        从配置创建：每项包含 name、key 或 key_sha256（十六进制），以及可选的 rpm、tpm
+
+        无效的项记录警告后跳过。
+        """
+        tenants = []
+        for entry in entries:
+            if not isinstance(entry, dict):
+                access_log.log("tenant_key_invalid", level="warning", error="entry must be an object")
+                continue
+            try:
+                name = entry["name"]
+                if entry.get("key"):
+                    digest = key_digest(str(entry["key"]).encode())
+                else:
+                    digest = bytes.fromhex(entry["key_sha256"])
+                    if len(digest) != 32:
+                        raise ValueError("key_sha256 must be 64 hex characters")
+                tenant = Tenant(str(name), rpm=float(entry.get("rpm") or 0), tpm=float(entry.get("tpm") or 0),
+                                clock=clock)
+            except (KeyError, TypeError, ValueError) as e:
+                access_log.log("tenant_key_invalid", level="warning", tenant=str(entry.get("name")), error=str(e))
+                continue
+            tenants.append((digest, tenant))
+        return cls(tenants)
+
+    def __len__(self) -> int:
+        return len(self._by_digest)
+
+    @property
+    def tenants(self) -> List[Tenant]:
+        return list(self._by_digest.values())
+
+    def lookup(self, key: bytes) -> Optional[Tenant]:
+        return self._by_digest.get(key_digest(key))
+
+    def collectors(self) -> List[Any]:
+        return [
+            CallbackMetric("lb_tenant_requests_total", "Requests by tenant and admission result", ("tenant", "result"),
+                           lambda: [((t.name, "admitted"), t.requests) for t in self.tenants]
+                           + [((t.name, "rejected"), t.rejected) for t in self.tenants], kind="counter"),
+            CallbackMetric("lb_tenant_tokens_total", "Tokens reported in upstream usage by tenant", ("tenant", "type"),
+                           lambda: [((t.name, "prompt"), t.prompt_tokens) for t in self.tenants]
+                           + [((t.name, "completion"), t.completion_tokens) for t in self.tenants]
+                           + [((t.name, "estimated"), t.estimated_tokens) for t in self.tenants], kind="counter"),
+        ]
@@ -0,0 +1,108 @@
+from typing import Any, Dict, Mapping, Optional
+
+import httpx
+
+from src.utils import fast_json
+
+# 透传给客户端的上游响应头：内容类型、限流额度、请求 ID 和重试时间等。
+# content-length、content-encoding 和连接相关的头由本服务重新生成，不透传
+PASSTHROUGH_HEADERS = frozenset((
+    "content-type", "retry-after", "retry-after-ms", "x-request-id", "apim-request-id", "request-id",
+))
+PASSTHROUGH_PREFIXES = ("x-ratelimit-", "x-ms-", "openai-", "azureml-")
+
+_MAGIC = b"UR1\n"
+_JSON_HEADERS = {"content-type": "application/json"}
+
+
+def filter_headers(headers: Mapping[str, str]) -> Dict[str, str]:
+    filtered = {}
+    for name, value in headers.items():
+        name = name.lower()
+        if name in PASSTHROUGH_HEADERS or name.startswith(PASSTHROUGH_PREFIXES):
+            filtered[name] = value
+    return filtered
+
+
+class UpstreamResponse:
+    """
+    上游响应的原始字节、状态码和筛选后的响应头
+
+    响应体按原样返回给客户端，只有需要检查内容的功能（合并请求的拆分、兼容旧接口）
+    才调用 json() 解析，结果会被缓存。对象创建后不再修改，缓存和进行中请求去重
+    可以把同一个对象交给多个调用方。
+    """
+
+    __slots__ = ("status_code", "headers", "content", "instance", "_json")
+
+    def __init__(self, status_code: int, headers: Dict[str, str], content: bytes, instance: Optional[str] = None):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.instance = instance
+        self._json: Any = None
+
+    @classmethod
+    def from_httpx(cls, response: httpx.Response, instance: Optional[str] = None) -> "UpstreamResponse":
+        return cls(response.status_code, filter_headers(response.headers), response.content, instance)
+
+    @classmethod
+    def from_json(cls, value: Any, status_code: int = 200, headers: Optional[Dict[str, str]] = None,
+                  instance: Optional[str] = None) -> "UpstreamResponse":
+        response = cls(status_code, {**(headers or {}), **_JSON_HEADERS}, fast_json.dumps(value), instance)
+        response._json = value
+        return response
+
+    @property
+    def is_error(self) -> bool:
+        return self.status_code >= 400
+
+    @property
+    def is_json(self) -> bool:
+        return "json" in self.headers.get("content-type", "")
+
+    def json(self) -> Any:
+        """解析响应体；不是合法 JSON 时抛出 ValueError"""
+        if self._json is None:
+            self._json = fast_json.loads(self.content)
+        return self._json
+
+    def to_legacy(self) -> Any:
+        """
+        转换为旧接口返回的字典（每次调用都是新的对象）
+
+        成功时为解析后的响应（非 JSON 时为 {"text": ...}）；错误时在响应中加上
+        _azure_openai_instance 和 _azure_openai_status_code 元数据。
+        """
+        try:
+            value = fast_json.loads(self.content) if self.is_json or not self.is_error else None
+        except ValueError:
+            value = None
+        if not self.is_error:
+            return value if value is not None else {"text": self.content.decode("utf-8", "replace")}
+        if isinstance(value, dict):
+            value["_azure_openai_instance"] = self.instance
+            value["_azure_openai_status_code"] = self.status_code
+            return value
+        return {
+            "error": {
+                "message": self.content.decode("utf-8", "replace"),
+                "code": self.status_code,
+                "_azure_openai_instance": self.instance
+            }
+        }
+
+    def to_bytes(self) -> bytes:
+        """序列化为一行元数据加原始响应体，用于磁盘缓存"""
+        meta = fast_json.dumps({"status": self.status_code, "headers": self.headers, "instance": self.instance})
+        return _MAGIC + meta + b"\n" + self.content
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "UpstreamResponse":
+        meta, _, content = data[len(_MAGIC):].partition(b"\n")
+        fields = fast_json.loads(meta)
+        return cls(fields["status"], fields["headers"], content, fields.get("instance"))
+
+    @staticmethod
+    def is_serialized(data: bytes) -> bool:
+        return data.startswith(_MAGIC)
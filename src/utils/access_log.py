@@ -0,0 +1,194 @@
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from src.config.settings import settings
+from src.utils.metrics import CallbackMetric
+
+# 写入前替换为 *** 的字段名（不区分大小写），包括嵌套在 headers 等字典中的字段
+REDACTED_KEYS = frozenset(("api-key", "api_key", "authorization", "proxy-authorization", "x-api-key"))
+_REDACTED = "***"
+
+
+def redact(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {
+            k: (_REDACTED if isinstance(k, str) and k.lower() in REDACTED_KEYS else redact(v))
+            for k, v in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [redact(v) for v in value]
+    return value
+
+
+class AccessLog:
+    """
+    非阻塞的结构化日志管道
+
+    log() 只把记录（dict）追加到内存缓冲区，不做序列化和 I/O；后台线程按批次
+    序列化成 JSON Lines 写入 path（未配置时写 stdout），并按大小和时间轮转文件。
+    缓冲区已满时丢弃新记录并计数，而不是阻塞事件循环。
+    info 级别的记录按 sample_rate 采样，warning/error 级别的记录总是保留。
+    """
+
+    def __init__(self, path: Optional[str] = None, max_bytes: int = 100 * 1024 * 1024, backup_count: int = 5,
+                 rotate_interval: float = 0.0, sample_rate: float = 1.0, buffer_size: int = 10000,
+                 batch_size: int = 512, flush_interval: float = 1.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.rotate_interval = rotate_interval
+        self.sample_rate = sample_rate
+        self.buffer_size = buffer_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer: deque = deque()
+        # 丢弃计数按写入方分开：_overflowed 只由 log() 的调用方更新，_unencodable 只在持有
+        # _write_lock 的 flush() 中更新，两个线程不会对同一个计数做非原子的 += 1
+        self._overflowed = 0
+        self._unencodable = 0
+        self.sampled_out = 0
+        self.written = 0
+        self._wakeup = threading.Event()
+        self._write_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self._file = None
+        self._size = 0
+        self._opened_at = 0.0
+
+    @property
+    def dropped(self) -> int:
+        """缓冲区已满或无法序列化而丢弃的记录数"""
+        return self._overflowed + self._unencodable
+
+    def log(self, event: str, level: str = "info", **fields: Any):
+        if level == "info" and self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            self.sampled_out += 1
+            return
+        if len(self.buffer) >= self.buffer_size:
+            self._overflowed += 1
+            return
+        self.buffer.append({"ts": time.time(), "level": level, "event": event, **fields})
+        if self._thread is None:
+            self._start()
+        elif len(self.buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def _start(self):
+        if self._closed:
+            return
+        self._thread = threading.Thread(target=self._run, name="access-log-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """把缓冲区中的记录全部写出（后台线程定期调用，也可在关闭或测试时直接调用）"""
+        with self._write_lock:
+            while self.buffer:
+                batch = []
+                while self.buffer and len(batch) < self.batch_size:
+                    batch.append(self.buffer.popleft())
+                lines = []
+                for record in batch:
+                    try:
+                        lines.append(json.dumps(redact(record), ensure_ascii=False, default=str))
+                    except (TypeError, ValueError):
+                        self._unencodable += 1
+                if lines:
+                    self._write("\n".join(lines) + "\n")
+                    self.written += len(lines)
+
+    def _write(self, data: str):
+        if self.path is None:
+            sys.stdout.write(data)
+            sys.stdout.flush()
+            return
+        encoded = data.encode("utf-8")
+        if self._file is not None and self._should_rotate(len(encoded)):
+            self._rotate()
+        if self._file is None:
+            self._open()
+        self._file.write(encoded)
+        self._file.flush()
+        self._size += len(encoded)
+
+    def _should_rotate(self, incoming: int) -> bool:
+        if self.max_bytes and self._size and self._size + incoming > self.max_bytes:
+            return True
+        return bool(self.rotate_interval) and time.time() - self._opened_at >= self.rotate_interval
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(self.path, "ab")
+        self._size = self._file.tell()
+        self._opened_at = time.time()
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        if self.backup_count <= 0:
+            os.remove(self.path)
+            return
+        for i in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{i}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def close(self):
+        """停止后台线程并写出剩余的记录；之后再有记录时会重新启动后台线程"""
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self.flush()
+        with self._write_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        self._closed = False
+
+    def collectors(self) -> List[Any]:
+        return [
+            CallbackMetric("lb_log_records_total", "Log records by outcome", ("outcome",),
+                           lambda: [(("written",), self.written), (("dropped",), self.dropped),
+                                    (("sampled_out",), self.sampled_out)], kind="counter"),
+            CallbackMetric("lb_log_buffered_records", "Log records waiting to be written", (),
+                           lambda: [((), len(self.buffer))]),
+        ]
+
+
+class AccessLogHandler(logging.Handler):
+    """把标准 logging 的记录转发到 AccessLog，避免 FileHandler/StreamHandler 阻塞事件循环"""
+
+    def __init__(self, access_log: AccessLog):
+        super().__init__()
+        self.access_log = access_log
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            fields: Dict[str, Any] = {"logger": record.name, "message": record.getMessage()}
+            if record.exc_info:
+                fields["exception"] = logging.Formatter().formatException(record.exc_info)
+            self.access_log.log("log", level=record.levelname.lower(), **fields)
+        except Exception:
+            self.handleError(record)
+
+
+# 进程内共享的日志管道，配置来自环境变量
+access_log = AccessLog(**settings.get_access_log_options())
@@ -0,0 +1,26 @@
+import json
+from typing import Any, Union
+
+# orjson 可选：安装后解析和编码快数倍，未安装时退回标准库 json，行为一致
+try:
+    import orjson
+except ImportError:  # pragma: no cover - 取决于运行环境
+    orjson = None
+
+
+def loads(data: Union[bytes, bytearray, str]) -> Any:
+    """解析 JSON；格式错误时抛出 ValueError（orjson.JSONDecodeError 也是 ValueError 的子类）"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(value: Any) -> bytes:
+    """编码为紧凑的 UTF-8 JSON 字节"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(value)
+        except TypeError:
+            # orjson 不支持的类型（例如非字符串的字典键）交给标准库处理
+            pass
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode()
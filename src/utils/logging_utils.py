@@ -1,18 +1,11 @@
 def setup_logging():
     import logging
-    import os
-
-    log_dir = 'logs'
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
+    from src.utils.access_log import AccessLogHandler, access_log
 
+    # 标准 logging 的记录也交给非阻塞的日志管道写出（LOG_FILE 或 stdout）
     logging.basicConfig(
         level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler(os.path.join(log_dir, 'app.log')),
-            logging.StreamHandler()
-        ]
+        handlers=[AccessLogHandler(access_log)]
     )
 
 def log_request(request):
@@ -0,0 +1,129 @@
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+# Prometheus 文本格式的 Content-Type
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 上游请求耗时（秒）
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# 流式首字时间（秒）
+TTFT_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 20.0, 30.0)
+# 流式分块间隔（秒）
+GAP_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+# 准入队列等待时间（秒）
+QUEUE_BUCKETS = (0.001, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(names: Sequence[str], values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value) -> str:
+    if isinstance(value, float):
+        return repr(value) if value == value and abs(value) != float("inf") else ("+Inf" if value > 0 else "NaN")
+    return str(value)
+
+
+class Counter:
+    """
+    单调递增计数器
+
+    热路径只做一次字典查找和整数加法，不加锁：所有记录都发生在事件循环线程中。
+    标签值按位置传入元组，导出时才转换成字符串。
+    """
+
+    __slots__ = ("name", "help", "label_names", "values")
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, labels: Labels = (), amount: float = 1):
+        values = self.values
+        values[labels] = values.get(labels, 0) + amount
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in list(self.values.items()):
+            yield f"{self.name}{_label_text(self.label_names, labels)} {_number(value)}"
+
+
+class Histogram:
+    """
+    固定分桶直方图
+
+    每个标签组合对应一个列表：各分桶（非累积）的计数、+Inf 分桶计数和总和。
+    observe 只做一次二分查找和两次加法；累积计数在导出时计算。
+    """
+
+    __slots__ = ("name", "help", "label_names", "bounds", "series", "_le")
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.bounds = tuple(sorted(buckets))
+        self.series: Dict[Labels, List[float]] = {}
+        self._le = [f'le="{_number(float(bound))}"' for bound in self.bounds] + ['le="+Inf"']
+
+    def observe(self, labels: Labels, value: float):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.bounds) + 2)
+        series[bisect_left(self.bounds, value)] += 1
+        series[-1] += value
+
+    def samples(self) -> Iterable[str]:
+        for labels, series in list(self.series.items()):
+            cumulative = 0
+            for le, count in zip(self._le, series):
+                cumulative += count
+                yield f"{self.name}_bucket{_label_text(self.label_names, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_label_text(self.label_names, labels)} {_number(float(series[-1]))}"
+            yield f"{self.name}_count{_label_text(self.label_names, labels)} {cumulative}"
+
+
+class CallbackMetric:
+    """
+    导出时才读取的指标，用于已经在别处维护的状态（在途请求数、缓存命中数等）
+
+    callback 返回 (标签元组, 数值) 的可迭代对象，热路径上没有任何开销。
+    """
+
+    __slots__ = ("name", "help", "label_names", "kind", "callback")
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str], callback: Callable[[], Iterable[Tuple[Labels, float]]],
+                 kind: str = "gauge"):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.kind = kind
+        self.callback = callback
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in self.callback():
+            yield f"{self.name}{_label_text(self.label_names, labels)} {_number(value)}"
+
+
+def render_metrics(metrics: Iterable) -> str:
+    """把一组指标渲染为 Prometheus 文本格式"""
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,125 @@
+import re
+from typing import AsyncIterable, AsyncIterator, Iterator, List, Optional, Tuple
+
+# 只匹配键值位置上的标量值，扫描长度有上限，不会解码整个请求体
+_SCALAR_VALUE_RE = re.compile(
+    rb'(true|false|null|-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?|"[^"\\]{0,256}")'
+)
+# JSON 字符串（含转义）或括号：字符串整段跳过，其中的括号不影响嵌套深度。
+# 占有量词避免回溯；在扫描窗口末尾被截断的字符串也整段匹配，不会逐字节重试
+_TOKEN_RE = re.compile(rb'"[^"\\]*+(?:\\.[^"\\]*+)*+(?:"|\Z)|[{}\[\]]')
+_COLON_RE = re.compile(rb'\s*:\s*')
+
+
+def top_level_members(body: bytes) -> Iterator[Tuple[bytes, int]]:
+    """
+    依次产生最外层对象的 (键名, 值的起始位置)，不做完整解析
+
+    只向前扫描一遍：字符串由正则整段跳过，括号调整嵌套深度，嵌套对象或数组中的键不会产生。
+    调用方找到需要的键后停止迭代，就不会再扫描后面的字节。
+    """
+    depth = 0
+    for match in _TOKEN_RE.finditer(body):
+        start, end = match.span()
+        char = body[start]
+        if char == 0x22:  # "
+            if depth == 1:
+                colon = _COLON_RE.match(body, end)
+                if colon:
+                    yield body[start + 1:end - 1], colon.end()
+        elif char in b"{[":
+            depth += 1
+        else:
+            depth -= 1
+
+
+def find_top_level_value(body: bytes, key: str) -> int:
+    """
+    返回最外层对象中 `"key":` 之后值的起始位置，找不到时返回 -1
+
+    tools 参数 schema、response_format 等嵌套对象或数组中的同名键会被跳过，
+    扫描在第一个最外层的匹配处停止。
+    """
+    needle = b'"' + key.encode() + b'"'
+    pos = body.find(needle)
+    if pos == -1:
+        return -1
+    if body.count(b"{", 0, pos) == 1 and body.find(b"[", 0, pos) == -1:
+        # 前面只有最外层的 {：不用扫描
+        colon = _COLON_RE.match(body, pos + len(needle))
+        if colon:
+            return colon.end()
+    name = needle[1:-1]
+    for member, start in top_level_members(body):
+        if member == name:
+            return start
+    return -1
+
+
+def sniff_json_scalar(body: bytes, key: str) -> Optional[bytes]:
+    """
+    在原始 JSON 字节中查找最外层的 `"key": <标量>` 并返回标量的原始字节，不做完整解析。
+
+    JSON 字符串内部的引号必须转义，因此未转义的 `"key"` 后面跟冒号只可能是对象键。
+    返回标量值（true/false/null/数字/短字符串），找不到或值不是标量时返回 None。
+    """
+    if not body:
+        return None
+    pos = find_top_level_value(body, key)
+    if pos == -1:
+        return None
+    match = _SCALAR_VALUE_RE.match(body, pos)
+    return match.group(1) if match else None
+
+
+def json_container_prefix(body: bytes, start: int, limit: int) -> Optional[bytes]:
+    """
+    返回从 start 开始的对象或数组值的原始字节，最多 limit 字节
+
+    值在 limit 字节内结束时返回到配对的括号为止，否则截断在 limit 处；只扫描这 limit 字节。
+    start 处不是对象或数组时返回 None。
+    """
+    if start >= len(body) or body[start] not in b"{[":
+        return None
+    stop = min(start + limit, len(body))
+    depth = 0
+    for match in _TOKEN_RE.finditer(body, start, stop):
+        char = body[match.start()]
+        if char == 0x22:  # "
+            continue
+        depth += 1 if char in b"{[" else -1
+        if depth == 0:
+            return body[start:match.end()]
+    return body[start:stop]
+
+
+def sniff_stream(body: bytes) -> bool:
+    """判断原始请求体是否带有 `"stream": true`"""
+    return sniff_json_scalar(body, "stream") == b"true"
+
+
+class ReplayableBody:
+    """
+    把客户端的请求体流式转发给上游，同时保留已读取的分块以便故障转移时重放。
+
+    第一次迭代边读边转发；后续迭代先重放已缓存的分块，再继续读取剩余部分。
+    """
+
+    def __init__(self, source: AsyncIterable[bytes], content_length: Optional[int] = None):
+        self._source = source.__aiter__()
+        self._chunks: List[bytes] = []
+        self._exhausted = False
+        self.content_length = content_length
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        for chunk in list(self._chunks):
+            yield chunk
+        while not self._exhausted:
+            try:
+                chunk = await self._source.__anext__()
+            except StopAsyncIteration:
+                self._exhausted = True
+                break
+            if chunk:
+                self._chunks.append(chunk)
+                yield chunk
@@ -0,0 +1,65 @@
+import time
+from contextvars import ContextVar, Token
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+_current: ContextVar[Optional["ServerTiming"]] = ContextVar("server_timing", default=None)
+
+
+class ServerTiming:
+    """
+    一个请求的各阶段耗时，由中间件写入响应的 Server-Timing 头
+
+    中间件为每个请求创建一个实例并绑定到上下文变量，处理函数和 OpenAIService
+    通过 record() 写入；没有绑定实例时 record() 不做任何事。
+    """
+
+    __slots__ = ("durations",)
+
+    def __init__(self):
+        self.durations: Dict[str, float] = {}
+
+    def set(self, name: str, seconds: float):
+        self.durations[name] = seconds
+
+    def header_value(self) -> str:
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.durations.items())
+
+    def httpx_trace(self) -> Callable[[str, Dict[str, Any]], Awaitable[None]]:
+        """
+        返回 httpx 的 trace 回调，记录上游建立连接（TCP + TLS）和首字节的耗时
+
+        连接池复用已有连接时不会产生连接事件，upstream-connect 不出现在头中。
+        故障转移时只保留最后一次尝试的数值。
+        """
+        marks: Dict[str, float] = {}
+
+        async def trace(event: str, info: Dict[str, Any]):
+            now = time.perf_counter()
+            if event == "connection.connect_tcp.started":
+                marks["connect"] = now
+            elif event.startswith("connection.") and event.endswith(".complete") and "connect" in marks:
+                self.durations["upstream-connect"] = now - marks["connect"]
+            elif event.endswith("send_request_headers.started"):
+                marks["request"] = now
+            elif event.endswith("receive_response_headers.complete") and "request" in marks:
+                self.durations["upstream-ttfb"] = now - marks["request"]
+
+        return trace
+
+
+def bind(timing: ServerTiming) -> Token:
+    return _current.set(timing)
+
+
+def unbind(token: Token):
+    _current.reset(token)
+
+
+def current() -> Optional[ServerTiming]:
+    return _current.get()
+
+
+def record(name: str, seconds: float):
+    timing = _current.get()
+    if timing is not None:
+        timing.durations[name] = seconds
@@ -0,0 +1,64 @@
+import re
+from typing import Any
+
+from src.utils.request_body import sniff_json_scalar
+
+# 粗略估算：英文约 4 个字符一个 token，JSON 结构开销让结果偏保守
+BYTES_PER_TOKEN = 4
+# 图片按高细节模式的典型值计费（85 + 170 * 4 个分块）
+IMAGE_TOKENS = 765
+# 请求未指定 max_tokens 时按此值估算输出
+DEFAULT_COMPLETION_TOKENS = 1024
+
+_DATA_URL = b'"data:'
+# 只统计作为键出现的 image_url，"type": "image_url" 中的取值不算
+_IMAGE_URL_KEY_RE = re.compile(rb'"image_url"\s*:')
+
+
+def _sniff_int(body: bytes, key: str) -> int:
+    value = sniff_json_scalar(body, key)
+    if value is None:
+        return 0
+    try:
+        return max(int(float(value)), 0)
+    except ValueError:
+        return 0
+
+
+def estimate_prompt_tokens(body: bytes) -> int:
+    """
+    基于原始字节估算输入 token 数，不解析 JSON
+
+    base64 图片（data URL）不按长度计算，而是每张图片按固定 token 数计入。
+    """
+    inline_bytes = 0
+    pos = body.find(_DATA_URL)
+    while pos != -1:
+        end = body.find(b'"', pos + len(_DATA_URL))
+        if end == -1:
+            break
+        inline_bytes += end - pos
+        pos = body.find(_DATA_URL, end + 1)
+    images = len(_IMAGE_URL_KEY_RE.findall(body))
+    return (len(body) - inline_bytes) // BYTES_PER_TOKEN + images * IMAGE_TOKENS
+
+
+def estimate_request_tokens(body: Any, path: str = "") -> int:
+    """
+    估算一次请求会占用的 TPM 额度：输入 token + 最大输出 token
+
+    与 Azure 的限流计算方式一致，输出部分按 max_tokens（或 max_completion_tokens）乘以 n 计算。
+    非原始字节的请求体（文件上传等）返回 0。
+    """
+    if not isinstance(body, (bytes, bytearray)) or not body:
+        return 0
+    body = bytes(body)
+    prompt_tokens = estimate_prompt_tokens(body)
+    if "embeddings" in path:
+        return prompt_tokens
+    completion_tokens = (
+        _sniff_int(body, "max_completion_tokens")
+        or _sniff_int(body, "max_tokens")
+        or DEFAULT_COMPLETION_TOKENS
+    )
+    return prompt_tokens + completion_tokens * max(_sniff_int(body, "n"), 1)
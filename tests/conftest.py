@@ -0,0 +1,23 @@
+import httpx
+import pytest
+from src.main import app
+from src.services.openai_service import OpenAIService
+
+INSTANCES = [
+    {"name": "instance1", "url": "https://one.openai.azure.com", "api_key": "key-one"},
+    {"name": "instance2", "url": "https://two.openai.azure.com", "api_key": "key-two"},
+]
+
+
+@pytest.fixture
+def mock_service():
+    """把 app 的 OpenAIService 换成使用 httpx.MockTransport 的实例"""
+    def factory(handler, instances=None):
+        service = OpenAIService([dict(i) for i in (instances or INSTANCES)])
+        service.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        app.state.openai_service = service
+        return service
+
+    yield factory
+    if hasattr(app.state, "openai_service"):
+        del app.state.openai_service
@@ -0,0 +1,82 @@
+import json
+import logging
+from src.utils.access_log import AccessLog, AccessLogHandler, redact
+
+
+def read_lines(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_redacts_credentials_at_any_depth():
+    record = {"headers": {"Authorization": "Bearer x", "api-key": "k", "accept": "*/*"},
+              "payload": [{"api_key": "k", "input": "hi"}]}
+    assert redact(record) == {"headers": {"Authorization": "***", "api-key": "***", "accept": "*/*"},
+                              "payload": [{"api_key": "***", "input": "hi"}]}
+
+
+def test_records_are_written_as_json_lines_in_batches(tmp_path):
+    path = str(tmp_path / "logs" / "access.log")
+    log = AccessLog(path=path, batch_size=2)
+    for i in range(5):
+        log.log("request", status=200, n=i, headers={"api-key": "secret"})
+    log.close()
+    records = read_lines(path)
+    assert [r["n"] for r in records] == [0, 1, 2, 3, 4]
+    assert all(r["headers"]["api-key"] == "***" and r["level"] == "info" for r in records)
+    assert log.written == 5
+
+
+def test_full_buffer_drops_instead_of_blocking(tmp_path):
+    # 后台线程一小时才写一次，缓冲区保持满
+    log = AccessLog(path=str(tmp_path / "a.log"), buffer_size=3, flush_interval=3600)
+    for i in range(5):
+        log.log("request", n=i)
+    assert (len(log.buffer), log.dropped) == (3, 2)
+
+
+def test_dropped_counts_overflow_and_unencodable_records_separately(tmp_path):
+    log = AccessLog(path=str(tmp_path / "a.log"), buffer_size=2, flush_interval=3600)
+    log.log("request", data={(1, 2): "tuple keys cannot be encoded"})
+    log.log("request", n=1)
+    log.log("request", n=2)
+    log.flush()
+    # 溢出由事件循环线程计数，序列化失败由写入线程计数，合计后导出
+    assert (log._overflowed, log._unencodable, log.dropped, log.written) == (1, 1, 2, 1)
+    samples = dict(log.collectors()[0].callback())
+    assert samples[("dropped",)] == 2
+    log.close()
+
+
+def test_sampling_only_applies_to_info_records(tmp_path):
+    log = AccessLog(path=str(tmp_path / "a.log"), sample_rate=0.0, flush_interval=3600)
+    log.log("request", status=200)
+    log.log("request", level="warning", status=502)
+    log.log("upstream_error", level="error")
+    assert [r["level"] for r in log.buffer] == ["warning", "error"]
+    assert log.sampled_out == 1
+
+
+def test_size_rotation_keeps_backups(tmp_path):
+    path = str(tmp_path / "a.log")
+    log = AccessLog(path=path, max_bytes=200, backup_count=2, batch_size=1)
+    for i in range(12):
+        log.log("request", n=i, padding="x" * 40)
+        log.flush()
+    log.close()
+    current = read_lines(path)
+    first_backup = read_lines(path + ".1")
+    second_backup = read_lines(path + ".2")
+    assert not (tmp_path / "a.log.3").exists()
+    assert current[-1]["n"] == 11
+    assert second_backup[-1]["n"] < first_backup[0]["n"] and first_backup[-1]["n"] < current[0]["n"]
+
+
+def test_logging_handler_forwards_standard_records(tmp_path):
+    log = AccessLog(path=str(tmp_path / "a.log"), flush_interval=3600)
+    logger = logging.getLogger("test_access_log")
+    logger.addHandler(AccessLogHandler(log))
+    logger.warning("disk %s", "slow")
+    logger.handlers.clear()
+    assert log.buffer[-1]["message"] == "disk slow"
+    assert log.buffer[-1]["level"] == "warning"
@@ -0,0 +1,94 @@
+import asyncio
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from src.main import app
+from src.services.admission import PRIORITY_CLASSES, AdmissionController, AdmissionRejected
+
+client = TestClient(app)
+
+INTERACTIVE = PRIORITY_CLASSES["interactive"]
+BATCH = PRIORITY_CLASSES["batch"]
+
+
+def test_waiters_are_served_by_priority_then_fifo():
+    async def scenario():
+        controller = AdmissionController(max_concurrency=1, max_queue=10)
+        holder = await controller.acquire()
+        order = []
+
+        async def request(name, priority):
+            ticket = await controller.acquire(priority)
+            order.append(name)
+            ticket.release()
+
+        tasks = [asyncio.create_task(request(name, priority)) for name, priority in
+                 (("batch-1", BATCH), ("interactive-1", INTERACTIVE), ("batch-2", BATCH), ("interactive-2", INTERACTIVE))]
+        await asyncio.sleep(0)
+        holder.release()
+        await asyncio.gather(*tasks)
+        assert controller.active == 0
+        return order
+
+    assert asyncio.run(scenario()) == ["interactive-1", "interactive-2", "batch-1", "batch-2"]
+
+
+def test_full_queue_sheds_batch_for_interactive_and_rejects_otherwise():
+    async def scenario():
+        controller = AdmissionController(max_concurrency=1, max_queue=1)
+        await controller.acquire()
+        batch = asyncio.create_task(controller.acquire(BATCH))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.acquire(BATCH)
+        assert rejected.value.status_code == 429
+        interactive = asyncio.create_task(controller.acquire(INTERACTIVE))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected):
+            await batch
+        interactive.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_queue_deadline_returns_503():
+    async def scenario():
+        controller = AdmissionController(max_concurrency=1, max_queue=5, queue_timeout=0.01)
+        await controller.acquire()
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.acquire()
+        assert rejected.value.status_code == 503
+        assert controller.queued == 0
+
+    asyncio.run(scenario())
+
+
+def test_priority_from_header_and_api_key():
+    controller = AdmissionController(key_priorities={"batch-key": "batch"})
+    assert controller.priority_for({"authorization": "Bearer batch-key"}) == BATCH
+    assert controller.priority_for({"x-priority": "interactive"}) == INTERACTIVE
+    assert controller.priority_for({}) == PRIORITY_CLASSES["default"]
+    for value in ("0", "-1", "7", "urgent"):
+        assert controller.priority_for({"x-priority": value}) == PRIORITY_CLASSES["default"]
+
+
+def test_overloaded_proxy_answers_429_with_retry_after(mock_service):
+    mock_service(lambda request: httpx.Response(200, json={"ok": True}))
+    original = app.state.admission
+    app.state.admission = AdmissionController(max_concurrency=1, max_queue=0, queue_timeout=3)
+    app.state.admission.active = 1
+    try:
+        response = client.post("/openai/deployments/gpt-4o/chat/completions", json={})
+    finally:
+        app.state.admission = original
+    assert response.status_code == 429
+    assert response.headers["retry-after"] == "3"
+    assert response.json()["error"]["code"] == "server_overloaded"
+
+
+def test_stream_holds_admission_slot_until_finished(mock_service):
+    mock_service(lambda request: httpx.Response(200, content=b"data: [DONE]\n\n"))
+    response = client.post("/openai/deployments/gpt-4o/chat/completions", content=b'{"stream": true}',
+                           headers={"content-type": "application/json"})
+    assert response.status_code == 200
+    assert app.state.admission.active == 0
@@ -0,0 +1,119 @@
+import asyncio
+import httpx
+from src.load_balancer.affinity import HashRing, bounded_capacity, prefix_key
+from src.load_balancer.balancer import LoadBalancer
+from src.utils.metrics import render_metrics
+
+INSTANCES = [
+    {"name": f"instance{i}", "url": f"https://{i}.openai.azure.com", "api_key": f"key-{i}"} for i in range(1, 5)
+]
+SYSTEM = "You are a support agent. " * 200
+
+
+def chat(question, system=SYSTEM):
+    return {"messages": [{"role": "system", "content": system}, {"role": "user", "content": question}],
+            "temperature": 0}
+
+
+def test_prefix_key_ignores_everything_after_the_prefix():
+    key = prefix_key(chat("first question"), "gpt-4o", prefix_chars=1024)
+    assert key is not None
+    assert prefix_key(dict(chat("other question"), user="u-2"), "gpt-4o", prefix_chars=1024) == key
+    # 只对 messages 的原始字节取哈希：其他字段及其位置、格式不影响键
+    assert prefix_key(b'{"user": "u-3", "messages":[{"role":"system","content":"' + SYSTEM.encode() + b'"}]}',
+                      "gpt-4o", prefix_chars=1024) == key
+    assert prefix_key(b'{"messages":[{"content":"' + SYSTEM.encode() + b'","role":"system"}]}',
+                      "gpt-4o", prefix_chars=1024) != key
+    assert prefix_key(chat("first question"), "gpt-4o-mini", prefix_chars=1024) != key
+    assert prefix_key(chat("short", system="Be brief."), "gpt-4o", prefix_chars=1024) is None
+    assert prefix_key({"input": "embeddings"}, "gpt-4o") is None
+
+
+def test_prefix_key_hashes_tools_before_messages_without_decoding():
+    tools = b'[{"type":"function","function":{"name":"lookup","parameters":{"type":"object"}}}]'
+    messages = b'[{"role":"system","content":"' + SYSTEM.encode() + b'"}]'
+    key = prefix_key(b'{"tools":' + tools + b',"messages":' + messages + b',"temperature":0}', "gpt-4o", 1024)
+    assert key == prefix_key(b'{"model":"gpt-4o","tools":' + tools + b',"messages":' + messages + b',"user":"u-2"}',
+                             "gpt-4o", 1024)
+    assert key != prefix_key(b'{"messages":' + messages + b'}', "gpt-4o", 1024)
+    # 截断的请求体只用到前缀，照样得到相同的键
+    assert prefix_key(b'{"tools":' + tools + b',"messages":' + messages[:1500], "gpt-4o", 1024) == key
+
+
+def test_ring_only_moves_keys_of_the_removed_instance():
+    keys = [prefix_key(chat("q", system=f"{n} " + SYSTEM), "gpt-4o", prefix_chars=1024) for n in range(200)]
+    ring = HashRing(INSTANCES)
+    before = {key: next(ring.walk(key)) for key in keys}
+    assert len(set(before.values())) == 4
+    smaller = HashRing(INSTANCES[:3])
+    moved = [key for key in keys if next(smaller.walk(key)) != before[key]]
+    assert moved and all(before[key] == "instance4" for key in moved)
+    assert sorted(ring.walk(keys[0])) == ["instance1", "instance2", "instance3", "instance4"]
+
+
+def test_bounded_load_spills_to_the_next_instance_on_the_ring():
+    balancer = LoadBalancer(INSTANCES, strategy="round_robin", affinity={"load_factor": 1.0})
+    key = prefix_key(chat("q"), "gpt-4o", prefix_chars=1024)
+    owner, second = list(balancer.ring.walk(key))[:2]
+    assert bounded_capacity(0, 4, 1.0) == 1
+
+    async def scenario():
+        first = await balancer.acquire(affinity_key=key)
+        spilled = await balancer.acquire(affinity_key=key)
+        return first, spilled
+
+    first, spilled = asyncio.run(scenario())
+    assert first.instance["name"] == owner
+    assert spilled.instance["name"] == second
+    assert balancer.affinity_routes == {"owner": 1, "spill": 1, "fallback": 0}
+
+
+def test_load_bound_is_relative_to_the_instances_hosting_the_deployment():
+    instances = [dict(instance, name=f"instance{i}") for i, instance in enumerate(INSTANCES * 3)][:10]
+    balancer = LoadBalancer(instances, strategy="round_robin", affinity={})
+    hosting = instances[7:9]
+
+    async def scenario():
+        leases = []
+        for n in range(20):
+            key = prefix_key(chat("q", system=f"{n} " + SYSTEM), "gpt-4o", prefix_chars=1024)
+            leases.append(await balancer.acquire(instances=hosting, affinity_key=key))
+        return leases
+
+    leases = asyncio.run(scenario())
+    assert {lease.instance["name"] for lease in leases} == {"instance7", "instance8"}
+    assert balancer.affinity_routes["fallback"] == 0
+    assert balancer.affinity_routes["owner"] >= 10
+
+
+def test_unhealthy_owner_is_skipped_and_cached_tokens_are_reported(mock_service, monkeypatch):
+    monkeypatch.setenv("PREFIX_AFFINITY_ENABLED", "true")
+    monkeypatch.setenv("PREFIX_AFFINITY_CHARS", "1024")
+    hosts = []
+
+    def handler(request):
+        hosts.append(request.url.host)
+        return httpx.Response(200, json={"usage": {"prompt_tokens": 1200, "completion_tokens": 5,
+                                                   "prompt_tokens_details": {"cached_tokens": 1024}}})
+
+    service = mock_service(handler)
+    ring = service.balancer.ring
+    # 选一个由 instance1 负责的前缀，然后让 instance1 熔断
+    system = next(system for system in (f"{n} " + SYSTEM for n in range(100))
+                  if next(ring.walk(prefix_key(chat("q", system=system), "gpt-4o", 1024))) == "instance1")
+    path = "/openai/deployments/gpt-4o/chat/completions?api-version=2024-10-21"
+
+    async def scenario():
+        await service.forward_full_request("POST", path, chat("q", system=system), {}, raw=True)
+        service.balancer.breaker_for(service.instances[0]).record_failure(retry_after=60, throttled=True)
+        for _ in range(2):
+            result = await service.forward_full_request("POST", path, chat("q", system=system), {}, raw=True)
+            assert result.status_code == 200
+
+    asyncio.run(scenario())
+    assert hosts == ["one.openai.azure.com", "two.openai.azure.com", "two.openai.azure.com"]
+    assert service.balancer.affinity_routes == {"owner": 1, "spill": 2, "fallback": 0}
+    text = render_metrics(service.metrics.collectors())
+    assert 'lb_tokens_total{instance="instance2",deployment="gpt-4o",type="cached"} 2048' in text
+    assert 'lb_prompt_cache_hit_ratio{instance="instance2",deployment="gpt-4o"} 0.8533' in text
+    assert 'lb_affinity_routes_total{result="spill"} 2' in text
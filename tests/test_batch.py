@@ -0,0 +1,134 @@
+import asyncio
+import json
+import httpx
+import pytest
+from src.batch import BatchRunner, Checkpoint, request_path
+from src.services.retry import RetryPolicy
+
+
+def write_requests(path, count, start=0):
+    with open(path, "w") as f:
+        for i in range(start, start + count):
+            f.write(json.dumps({"custom_id": f"task-{i}", "method": "POST", "url": "/chat/completions",
+                                "body": {"model": "gpt-4o", "messages": [{"role": "user", "content": str(i)}],
+                                         "stream": True}}) + "\n")
+
+
+def echo_handler(calls):
+    def handler(request):
+        body = json.loads(request.content)
+        calls.append((request.url.path, body["messages"][0]["content"], "stream" in body))
+        return httpx.Response(200, json={"echo": body["messages"][0]["content"]}, headers={"apim-request-id": "r"})
+    return handler
+
+
+def read_output(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_short_urls_use_the_model_as_deployment():
+    assert request_path({"url": "/embeddings", "body": {"model": "ada"}}, None, "v1") == \
+        "openai/deployments/ada/embeddings?api-version=v1"
+    assert request_path({"url": "/openai/deployments/x/chat/completions?api-version=v2", "body": {}}, None, "v1") == \
+        "openai/deployments/x/chat/completions?api-version=v2"
+    assert request_path({"url": "/chat/completions", "body": {}}, "gpt", "v1").startswith("openai/deployments/gpt/")
+
+
+def test_runs_every_line_and_writes_batch_output(tmp_path, mock_service):
+    calls = []
+    service = mock_service(echo_handler(calls))
+    write_requests(tmp_path / "in.jsonl", 25)
+    with open(tmp_path / "in.jsonl", "a") as f:
+        f.write("\nnot json\n")
+
+    runner = BatchRunner(service, str(tmp_path / "in.jsonl"), str(tmp_path / "out.jsonl"), concurrency=4)
+    counts = asyncio.run(runner.run())
+
+    assert counts == {"succeeded": 25, "failed": 1, "skipped": 0}
+    assert calls[0][0] == "/openai/deployments/gpt-4o/chat/completions"
+    assert not any(stream for _, _, stream in calls)
+    records = {record["custom_id"]: record for record in read_output(tmp_path / "out.jsonl")}
+    assert records["task-7"]["response"] == {"status_code": 200, "request_id": "r", "body": {"echo": "7"}}
+    assert records["line-27"]["error"]["code"] == "invalid_request"
+    assert Checkpoint.load(str(tmp_path / "out.jsonl.checkpoint")).watermark == 27
+
+
+def test_resumes_from_the_checkpoint_without_duplicates(tmp_path, mock_service):
+    calls = []
+    service = mock_service(echo_handler(calls))
+    write_requests(tmp_path / "in.jsonl", 10)
+    output = tmp_path / "out.jsonl"
+    # 上次运行完成了第 0-3 行和第 6 行；检查点之后还写出了半行
+    done = b"".join(json.dumps({"custom_id": f"task-{i}", "response": {}, "error": None}).encode() + b"\n"
+                    for i in (0, 1, 2, 3, 6))
+    output.write_bytes(done + b'{"custom_id": "task-4", "resp')
+    checkpoint = Checkpoint(str(tmp_path / "out.jsonl.checkpoint"))
+    for i in (0, 1, 2, 3, 6):
+        checkpoint.mark(i)
+    checkpoint.save(len(done))
+
+    counts = asyncio.run(BatchRunner(service, str(tmp_path / "in.jsonl"), str(output), concurrency=2).run())
+
+    assert counts == {"succeeded": 5, "failed": 0, "skipped": 5}
+    assert sorted(int(content) for _, content, _ in calls) == [4, 5, 7, 8, 9]
+    ids = [record["custom_id"] for record in read_output(output)]
+    assert sorted(ids) == sorted(f"task-{i}" for i in range(10))
+
+
+def test_existing_output_without_a_checkpoint_is_not_truncated(tmp_path, mock_service):
+    calls = []
+    service = mock_service(echo_handler(calls))
+    write_requests(tmp_path / "in.jsonl", 3)
+    output = tmp_path / "out.jsonl"
+    output.write_text('{"custom_id": "earlier-run"}\n')
+
+    with pytest.raises(FileExistsError):
+        asyncio.run(BatchRunner(service, str(tmp_path / "in.jsonl"), str(output)).run())
+    assert output.read_text() == '{"custom_id": "earlier-run"}\n'
+    assert calls == []
+
+    counts = asyncio.run(BatchRunner(service, str(tmp_path / "in.jsonl"), str(output), overwrite=True).run())
+    assert counts["succeeded"] == 3
+    assert "earlier-run" not in output.read_text()
+
+
+def test_unexpected_worker_failure_fails_the_run_instead_of_hanging(tmp_path, mock_service):
+    service = mock_service(echo_handler([]))
+    write_requests(tmp_path / "in.jsonl", 20)
+    runner = BatchRunner(service, str(tmp_path / "in.jsonl"), str(tmp_path / "out.jsonl"), concurrency=1)
+    process = runner._process
+
+    async def crashing_process(line_no, line):
+        if line_no == 3:
+            raise RuntimeError("disk full")
+        return await process(line_no, line)
+
+    runner._process = crashing_process
+    with pytest.raises(RuntimeError, match="disk full"):
+        asyncio.run(asyncio.wait_for(runner.run(), timeout=5))
+    # 已完成的行仍然写入检查点，下次从第 3 行继续
+    assert Checkpoint.load(str(tmp_path / "out.jsonl.checkpoint")).watermark == 3
+    assert len(read_output(tmp_path / "out.jsonl")) == 3
+
+
+def test_throttling_pauses_and_retries_instead_of_failing(tmp_path, mock_service):
+    calls = []
+
+    def handler(request):
+        calls.append(request.url.host)
+        if len(calls) <= 2:
+            return httpx.Response(429, json={"error": {"code": "429"}}, headers={"retry-after": "0.05"})
+        return httpx.Response(200, json={"ok": True})
+
+    service = mock_service(handler)
+    # 服务自身不重试，限流直接交给批量运行器处理
+    service.retry_policy = RetryPolicy(max_attempts=1)
+    write_requests(tmp_path / "in.jsonl", 1)
+    runner = BatchRunner(service, str(tmp_path / "in.jsonl"), str(tmp_path / "out.jsonl"), concurrency=1)
+
+    counts = asyncio.run(runner.run())
+    assert counts == {"succeeded": 1, "failed": 0, "skipped": 0}
+    assert len(calls) == 3
+    assert runner.paused_until > 0
+    assert read_output(tmp_path / "out.jsonl")[0]["response"]["body"] == {"ok": True}
@@ -0,0 +1,94 @@
+import asyncio
+import httpx
+from fastapi.testclient import TestClient
+from src.main import app
+from src.services.cache import ResponseCache, cache_key, is_cacheable
+
+client = TestClient(app)
+
+EMBEDDINGS = "/openai/deployments/ada/embeddings?api-version=2024-02-01"
+
+
+def test_only_deterministic_requests_are_cacheable():
+    assert is_cacheable("POST", "openai/deployments/ada/embeddings", b'{"input": "x"}')
+    assert is_cacheable("POST", "openai/deployments/gpt/chat/completions", b'{"temperature": 0.0}')
+    assert not is_cacheable("POST", "openai/deployments/gpt/chat/completions", b'{"temperature": 0.7}')
+    assert not is_cacheable("POST", "openai/deployments/gpt/chat/completions", b'{"messages": []}')
+    assert not is_cacheable("GET", "openai/deployments/ada/embeddings", b"")
+
+
+def test_key_is_canonical_over_field_order_and_whitespace():
+    assert cache_key("p", b'{"a": 1, "b": [1, 2]}') == cache_key("p", b'{"b":[1,2],"a":1}')
+    assert cache_key("p", b'{"a": 1}') != cache_key("q", b'{"a": 1}')
+    assert cache_key("p", b"not json") is None
+
+
+def test_lru_respects_entry_and_byte_limits_and_ttl():
+    async def scenario():
+        cache = ResponseCache(max_entries=2, max_bytes=1000, ttl=60)
+        await cache.set("a", {"v": 1})
+        await cache.set("b", {"v": 2})
+        assert await cache.get("a") == {"v": 1}
+        await cache.set("c", {"v": 3})
+        assert await cache.get("b") is None
+        assert await cache.get("a") == {"v": 1}
+        await cache.set("big", {"v": "x" * 2000})
+        assert await cache.get("big") is None
+        cache.ttl = -1
+        await cache.set("expired", {"v": 4})
+        assert await cache.get("expired") is None
+        assert (cache.hits, cache.misses) == (2, 3)
+
+    asyncio.run(scenario())
+
+
+def test_disk_tier_survives_restart(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+
+    async def scenario():
+        cache = ResponseCache(path=path)
+        await cache.set("k", {"data": [1, 2, 3]})
+        cache.close()
+        restarted = ResponseCache(path=path)
+        assert await restarted.get("k") == {"data": [1, 2, 3]}
+        assert restarted.disk_hits == 1
+        restarted.close()
+
+    asyncio.run(scenario())
+
+
+def test_cache_hit_skips_upstream_and_headers_control_it(mock_service):
+    calls = []
+
+    def handler(request: httpx.Request):
+        calls.append(1)
+        return httpx.Response(200, json={"data": [{"embedding": [len(calls)]}]})
+
+    service = mock_service(handler)
+    service.cache = ResponseCache()
+    first = client.post(EMBEDDINGS, json={"input": "hello", "model": "ada"})
+    second = client.post(EMBEDDINGS, content=b'{"model":"ada","input":"hello"}',
+                         headers={"content-type": "application/json"})
+    assert first.json() == second.json() == {"data": [{"embedding": [1]}]}
+    assert len(calls) == 1
+
+    bypass = client.post(EMBEDDINGS, json={"input": "hello", "model": "ada"}, headers={"x-lb-cache": "bypass"})
+    assert bypass.json() == {"data": [{"embedding": [2]}]}
+    refreshed = client.post(EMBEDDINGS, json={"input": "hello", "model": "ada"}, headers={"x-lb-cache": "refresh"})
+    assert refreshed.json() == {"data": [{"embedding": [3]}]}
+    assert client.post(EMBEDDINGS, json={"input": "hello", "model": "ada"}).json() == {"data": [{"embedding": [3]}]}
+    assert len(calls) == 3
+
+
+def test_errors_are_not_cached(mock_service):
+    calls = []
+
+    def handler(request: httpx.Request):
+        calls.append(1)
+        return httpx.Response(400, json={"error": {"message": "bad"}})
+
+    service = mock_service(handler)
+    service.cache = ResponseCache()
+    for _ in range(2):
+        assert client.post(EMBEDDINGS, json={"input": "x"}).status_code == 400
+    assert service.cache.entries == {}
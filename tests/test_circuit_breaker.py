@@ -0,0 +1,103 @@
+import asyncio
+import httpx
+from fastapi.testclient import TestClient
+from src.main import app
+from src.load_balancer.balancer import LoadBalancer
+from src.load_balancer.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, parse_retry_after
+
+client = TestClient(app)
+
+PATH = "/openai/deployments/gpt-4o/chat/completions?api-version=2025-01-01-preview"
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_parse_retry_after_prefers_milliseconds():
+    assert parse_retry_after({"retry-after-ms": "1500", "retry-after": "10"}) == 1.5
+    assert parse_retry_after({"retry-after": "10"}) == 10.0
+    assert parse_retry_after({"retry-after": "not-a-date"}) is None
+    assert parse_retry_after({}) is None
+
+
+def test_throttle_opens_immediately_for_retry_after():
+    clock = FakeClock()
+    breaker = CircuitBreaker(clock=clock)
+    breaker.record_failure(retry_after=3.0, throttled=True)
+    assert breaker.state == OPEN
+    assert not breaker.is_available()
+    clock.now += 3.0
+    assert breaker.state == HALF_OPEN
+    assert breaker.is_available()
+
+
+def test_consecutive_failures_open_and_half_open_probe_is_limited():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=2, cooldown=1.0, half_open_max_calls=1, clock=clock)
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+    breaker.record_failure()
+    assert breaker.state == OPEN
+
+    clock.now += 1.0
+    assert breaker.is_available()
+    breaker.on_dispatch()
+    assert not breaker.is_available()
+
+    # 试探失败后重新打开，冷却时间翻倍
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    clock.now += 1.0
+    assert breaker.state == OPEN
+    clock.now += 1.0
+    breaker.on_dispatch()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+
+
+def test_late_success_does_not_close_a_throttled_circuit():
+    balancer = LoadBalancer([{"name": "only", "url": "https://only", "api_key": "k"}])
+    first = asyncio.run(balancer.acquire())
+    second = asyncio.run(balancer.acquire())
+    # 两个请求同时在途：一个先收到 429，另一个在之后才成功返回
+    first.record_response(429, {"retry-after": "30"})
+    second.record_response(200)
+    breaker = balancer.breaker_for(first.instance)
+    assert breaker.state == OPEN
+    assert breaker.remaining_cooldown() > 29
+    first.release()
+    second.release()
+    assert asyncio.run(balancer.acquire()) is None
+
+
+def test_throttled_instance_is_skipped_on_next_request(mock_service, monkeypatch):
+    # 轮询保证第一个请求先发到 instance1
+    monkeypatch.setenv("LOAD_BALANCING_STRATEGY", "round_robin")
+    hosts = []
+
+    def handler(request: httpx.Request):
+        hosts.append(request.url.host)
+        if request.url.host.startswith("one"):
+            return httpx.Response(429, headers={"retry-after": "30"}, json={"error": {"code": "429"}})
+        return httpx.Response(200, json={"ok": True})
+
+    mock_service(handler)
+    for _ in range(5):
+        assert client.post(PATH, json={"messages": []}).status_code == 200
+    assert hosts.count("one.openai.azure.com") == 1
+
+
+def test_all_instances_open_fails_fast_with_retry_after(mock_service):
+    def handler(request: httpx.Request):
+        return httpx.Response(429, headers={"retry-after": "20"}, json={"error": {"code": "429"}})
+
+    mock_service(handler)
+    assert client.post(PATH, json={"messages": []}).status_code == 429
+    response = client.post(PATH, json={"messages": []})
+    assert response.status_code == 503
+    assert 1 <= int(response.headers["retry-after"]) <= 20
@@ -0,0 +1,105 @@
+import asyncio
+import random
+import httpx
+import pytest
+from src.load_balancer.balancer import CapacityExhausted, LoadBalancer
+from src.load_balancer.concurrency import AdaptiveLimit
+from src.utils.metrics import render_metrics
+
+INSTANCES = [
+    {"name": "instance1", "url": "https://one.openai.azure.com", "api_key": "key-one"},
+    {"name": "instance2", "url": "https://two.openai.azure.com", "api_key": "key-two"},
+]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_limit_grows_only_while_in_use_and_latency_is_flat():
+    limit = AdaptiveLimit(initial_limit=4)
+    for _ in range(20):
+        limit.on_success(0.5, in_flight=1)
+    assert limit.limit == 4
+    for _ in range(20):
+        limit.on_success(0.5, in_flight=4)
+    assert 7 < limit.limit < 8
+
+
+def test_throttling_halves_the_limit_once_per_burst():
+    clock = FakeClock()
+    limit = AdaptiveLimit(initial_limit=16, min_limit=2, clock=clock)
+    limit.on_throttled()
+    limit.on_throttled()
+    assert limit.limit == 8
+    clock.now += 1.0
+    for _ in range(5):
+        limit.on_throttled()
+        clock.now += 1.0
+    assert limit.limit == 2
+
+
+def test_latency_inflation_shrinks_the_limit():
+    clock = FakeClock()
+    limit = AdaptiveLimit(initial_limit=20, clock=clock)
+    for _ in range(50):
+        limit.on_success(1.0, in_flight=20)
+    grown = limit.limit
+    for _ in range(5):
+        clock.now += 1.0
+        limit.on_success(5.0, in_flight=20)
+    assert limit.limit < grown
+
+
+def test_mixed_stream_and_full_latencies_do_not_cut_a_healthy_limit():
+    clock = FakeClock()
+    rng = random.Random(7)
+    balancer = LoadBalancer(INSTANCES[:1], concurrency={"initial_limit": 20, "clock": clock}, clock=clock)
+    instance = INSTANCES[0]
+    stats = balancer.stats_for(instance)
+    lowest = 20
+    for _ in range(5000):
+        clock.now += 0.05
+        stats.in_flight = int(balancer.limit_for(instance).limit)
+        if rng.random() < 0.5:
+            balancer.record_response(instance, 200, {}, rng.lognormvariate(-0.7, 0.3), kind="ttft")
+        else:
+            # 完整响应时间随输出长度变化很大，不应被当成过载
+            balancer.record_response(instance, 200, {}, 0.3 + rng.randint(10, 1500) * 0.02)
+        lowest = min(lowest, balancer.limit_for(instance).limit)
+    assert lowest >= 20
+    assert balancer.limit_for(instance).limit > 60
+
+
+def test_full_instances_are_skipped_then_requests_queue_for_a_slot():
+    balancer = LoadBalancer(INSTANCES, strategy="round_robin", concurrency={"initial_limit": 1},
+                            concurrency_wait=0.5)
+
+    async def scenario():
+        first = await balancer.acquire()
+        second = await balancer.acquire()
+        assert {first.instance["name"], second.instance["name"]} == {"instance1", "instance2"}
+        waiter = asyncio.create_task(balancer.acquire())
+        await asyncio.sleep(0.05)
+        assert not waiter.done()
+        second.release()
+        third = await waiter
+        assert third.instance is second.instance
+        with pytest.raises(CapacityExhausted):
+            await balancer.acquire(max_wait=0.05)
+
+    asyncio.run(scenario())
+
+
+def test_limits_are_exported_when_enabled(mock_service, monkeypatch):
+    monkeypatch.setenv("ADAPTIVE_CONCURRENCY_ENABLED", "true")
+    monkeypatch.setenv("CONCURRENCY_INITIAL_LIMIT", "8")
+    service = mock_service(lambda request: httpx.Response(429, headers={"retry-after": "30"}, json={}))
+    asyncio.run(service.forward_full_request("POST", "/openai/deployments/gpt-4o/chat/completions", b"{}", {}))
+    text = render_metrics(service.metrics.collectors())
+    assert 'lb_concurrency_limit{instance="instance1"} 4' in text
+    assert 'lb_concurrency_limit{instance="instance2"} 4' in text
@@ -0,0 +1,147 @@
+import asyncio
+import json
+import os
+import httpx
+from fastapi.testclient import TestClient
+from src.main import app
+from src.services.config_watcher import ConfigWatcher
+
+client = TestClient(app)
+
+PATH = "/openai/deployments/gpt-4o/chat/completions?api-version=2025-01-01-preview"
+INSTANCE1 = {"name": "instance1", "url": "https://one.openai.azure.com", "api_key": "key-one"}
+INSTANCE2 = {"name": "instance2", "url": "https://two.openai.azure.com", "api_key": "key-two"}
+INSTANCE3 = {"name": "instance3", "url": "https://three.openai.azure.com", "api_key": "key-three"}
+
+
+def recording_handler(calls):
+    def handler(request):
+        calls.append((request.url.host, request.url.path, request.headers.get("api-key")))
+        return httpx.Response(200, json={"ok": True})
+    return handler
+
+
+def test_added_instance_is_prewarmed_and_unchanged_keep_their_state(mock_service):
+    calls = []
+    service = mock_service(recording_handler(calls))
+    breaker = service.balancer.breaker_for(service.instances[0])
+
+    summary = asyncio.run(service.update_instances([dict(INSTANCE1), dict(INSTANCE2), dict(INSTANCE3)]))
+
+    assert summary == {"added": ["instance3"], "updated": [], "removed": []}
+    assert calls == [("three.openai.azure.com", "/", None)]
+    assert service.balancer.breaker_for(service.instances[0]) is breaker
+    assert [i["name"] for i in service.balancer.instances] == ["instance1", "instance2", "instance3"]
+
+
+def test_rotated_key_is_used_without_resetting_health(mock_service):
+    calls = []
+    service = mock_service(recording_handler(calls))
+    service.balancer.breaker_for(service.instances[0]).record_failure()
+
+    rotated = dict(INSTANCE1, api_key="key-rotated")
+    summary = asyncio.run(service.update_instances([rotated]))
+
+    assert summary == {"added": [], "updated": ["instance1"], "removed": ["instance2"]}
+    assert calls == []
+    assert service.balancer.breaker_for(rotated).failures == 1
+    asyncio.run(service.forward_full_request("POST", PATH, {"messages": []}, {}))
+    assert calls == [("one.openai.azure.com", "/openai/deployments/gpt-4o/chat/completions", "key-rotated")]
+
+
+def test_removed_instance_drains_before_its_state_is_dropped(mock_service):
+    service = mock_service(recording_handler([]))
+
+    async def scenario():
+        lease = await service.balancer.acquire(instances=[service.instances[1]])
+        await service.update_instances([dict(INSTANCE1)])
+        assert [i["name"] for i in service.balancer.candidates()] == ["instance1"]
+        await asyncio.sleep(0.15)
+        assert "instance2" in service.balancer.stats
+        lease.release()
+        await asyncio.sleep(0.15)
+        assert "instance2" not in service.balancer.stats
+
+    asyncio.run(scenario())
+
+
+def test_watcher_applies_file_changes_and_ignores_invalid_ones(tmp_path, mock_service):
+    service = mock_service(recording_handler([]))
+    path = tmp_path / "openai_instances.json"
+    path.write_text(json.dumps({"instances": [INSTANCE1, INSTANCE2]}))
+    watcher = ConfigWatcher(path, service.update_instances)
+
+    assert asyncio.run(watcher.check()) is False
+    path.write_text(json.dumps({"instances": [INSTANCE1, INSTANCE2, INSTANCE3]}))
+    os.utime(path, ns=(1, 1))
+    assert asyncio.run(watcher.check()) is True
+    assert len(service.instances) == 3
+
+    path.write_text('{"instances": [')
+    assert asyncio.run(watcher.check()) is False
+    path.write_text(json.dumps({"instances": []}))
+    os.utime(path, ns=(2, 2))
+    assert asyncio.run(watcher.check()) is False
+    assert len(service.instances) == 3
+
+
+def test_watcher_keeps_running_when_applying_a_change_fails(tmp_path):
+    path = tmp_path / "openai_instances.json"
+    path.write_text(json.dumps({"instances": [INSTANCE1]}))
+    applied = []
+
+    async def on_change(instances):
+        if not applied:
+            applied.append(None)
+            raise RuntimeError("prewarm exploded")
+        applied.append([i["name"] for i in instances])
+
+    async def scenario():
+        watcher = ConfigWatcher(path, on_change, interval=0.01)
+        watcher.start()
+        path.write_text(json.dumps({"instances": [INSTANCE1, INSTANCE2]}))
+        os.utime(path, ns=(1, 1))
+        await asyncio.sleep(0.1)
+        path.write_text(json.dumps({"instances": [INSTANCE1, INSTANCE2, INSTANCE3]}))
+        os.utime(path, ns=(2, 2))
+        await asyncio.sleep(0.1)
+        running = not watcher._task.done()
+        await watcher.stop()
+        return running
+
+    assert asyncio.run(scenario()) is True
+    assert applied == [None, ["instance1", "instance2", "instance3"]]
+
+
+def test_admin_endpoints_require_the_admin_key(mock_service, monkeypatch):
+    service = mock_service(recording_handler([]))
+    monkeypatch.delenv("API_KEY", raising=False)
+    monkeypatch.delenv("ADMIN_API_KEY", raising=False)
+    assert client.get("/admin/instances").status_code == 403
+
+    monkeypatch.setenv("ADMIN_API_KEY", "admin-secret")
+    assert client.get("/admin/instances", headers={"Authorization": "Bearer wrong"}).status_code == 401
+
+    headers = {"Authorization": "Bearer admin-secret"}
+    listed = client.get("/admin/instances", headers=headers).json()["instances"]
+    assert [i["name"] for i in listed] == ["instance1", "instance2"]
+    assert all("api_key" not in i for i in listed)
+
+    response = client.put("/admin/instances", headers=headers, json={"instances": [INSTANCE3]})
+    assert response.json() == {"added": ["instance3"], "updated": [], "removed": ["instance1", "instance2"]}
+    assert [i["name"] for i in service.instances] == ["instance3"]
+    assert client.put("/admin/instances", headers=headers, json={"instances": []}).status_code == 400
+
+
+def test_undefined_admin_methods_are_never_forwarded(mock_service, monkeypatch):
+    forwarded = []
+    mock_service(recording_handler(forwarded))
+    monkeypatch.setenv("ADMIN_API_KEY", "admin-secret")
+    for method in ("POST", "DELETE", "PATCH"):
+        assert client.request(method, "/admin/instances").status_code == 401
+    assert client.post("/admin/other", headers={"Authorization": "Bearer wrong"}).status_code == 401
+
+    headers = {"Authorization": "Bearer admin-secret"}
+    assert client.post("/admin/instances", headers=headers, json={}).status_code == 405
+    assert client.delete("/admin/instances", headers=headers).status_code == 405
+    assert forwarded == []
@@ -0,0 +1,121 @@
+import asyncio
+import httpx
+from src import main
+from src.services.connection_pool import InstancePools
+
+DEFAULTS = {"max_connections": 100, "max_keepalive_connections": 20, "keepalive_expiry": 60.0,
+            "prewarm_connections": 1}
+INSTANCE1 = {"name": "instance1", "url": "https://one.openai.azure.com", "api_key": "key-one"}
+INSTANCE2 = {"name": "instance2", "url": "https://two.openai.azure.com", "api_key": "key-two",
+             "pool": {"max_keepalive_connections": 50, "prewarm_connections": 3}}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def pooled_service(mock_service, handler, clock=None):
+    """让服务经过 InstancePools，每个连接池是一个记录自身配置的 MockTransport"""
+    service = mock_service(handler, instances=[INSTANCE1, INSTANCE2])
+    created = []
+
+    def factory(options):
+        created.append(options)
+        return httpx.MockTransport(handler)
+
+    service.pools = InstancePools(DEFAULTS, factory=factory, clock=clock or FakeClock())
+    service.pools.configure(service.instances)
+    service.client = httpx.AsyncClient(transport=service.pools)
+    return service, created
+
+
+def test_each_instance_gets_a_pool_with_its_own_settings(mock_service):
+    hosts = []
+    service, created = pooled_service(mock_service, lambda request: hosts.append(request.url.host)
+                                      or httpx.Response(200, json={}))
+    assert [options["max_keepalive_connections"] for options in created] == [20, 50]
+
+    assert service.pools.configure(service.instances) == []
+    changed = dict(INSTANCE1, pool={"max_connections": 10})
+    retired = service.pools.configure([changed, INSTANCE2])
+    assert len(retired) == 1 and created[-1]["max_connections"] == 10
+    assert len(service.pools.prune([changed])) == 1
+    assert list(service.pools.pools) == [("https", "one.openai.azure.com", None)]
+
+
+def test_warm_up_opens_the_configured_connections_before_ready(mock_service):
+    hosts = []
+    release = asyncio.Event()
+
+    async def handler(request):
+        hosts.append(request.url.host)
+        await release.wait()
+        return httpx.Response(404)
+
+    service, _ = pooled_service(mock_service, handler)
+
+    async def scenario():
+        service.keepalive_interval = 0
+        service.start()
+        await asyncio.sleep(0.01)
+        not_ready = await main.health_check()
+        release.set()
+        await service.warming
+        return not_ready, await main.health_check()
+
+    not_ready, ready = asyncio.run(scenario())
+    assert not_ready.status_code == 503
+    assert ready["status"] == "ok"
+    assert sorted(hosts) == ["one.openai.azure.com"] + ["two.openai.azure.com"] * 3
+
+
+def test_keepalive_pings_only_idle_pools(mock_service):
+    hosts = []
+    clock = FakeClock()
+    service, _ = pooled_service(mock_service, lambda request: hosts.append(request.url.host)
+                                or httpx.Response(404), clock=clock)
+    service.keepalive_interval = 30.0
+
+    async def scenario():
+        clock.now = 20.0
+        await service.client.get("https://two.openai.azure.com/openai/models")
+        clock.now = 40.0
+        await service.keepalive()
+
+    asyncio.run(scenario())
+    assert hosts == ["two.openai.azure.com", "one.openai.azure.com"]
+
+
+def test_repooled_instance_is_served_by_the_old_pool_until_the_new_one_is_warm(mock_service):
+    seen = []
+    release = asyncio.Event()
+
+    def factory(options):
+        async def handler(request):
+            seen.append((request.url.path, options["max_connections"]))
+            if request.url.path == "/":
+                await release.wait()
+            return httpx.Response(200, json={})
+        return httpx.MockTransport(handler)
+
+    service = mock_service(lambda request: httpx.Response(200), instances=[INSTANCE1, INSTANCE2])
+    service.pools = InstancePools(DEFAULTS, factory=factory, clock=FakeClock())
+    service.pools.configure(service.instances)
+    service.client = httpx.AsyncClient(transport=service.pools)
+    live = "https://one.openai.azure.com/openai/models"
+
+    async def scenario():
+        reload = asyncio.create_task(service.update_instances([dict(INSTANCE1, pool={"max_connections": 10}),
+                                                               INSTANCE2]))
+        await asyncio.sleep(0.01)
+        await service.client.get(live)
+        release.set()
+        await reload
+        await service.client.get(live)
+
+    asyncio.run(scenario())
+    assert seen == [("/", 10), ("/openai/models", 100), ("/openai/models", 10)]
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import httpx
+from src.services.embeddings_batcher import EmbeddingsBatcher, split_usage
+
+EMBEDDINGS = "openai/deployments/ada/embeddings?api-version=2024-02-01"
+
+
+def embeddings_handler(calls):
+    def handler(request: httpx.Request):
+        payload = json.loads(request.content)
+        calls.append(payload)
+        inputs = payload["input"] if isinstance(payload["input"], list) else [payload["input"]]
+        data = [{"object": "embedding", "index": i, "embedding": [len(text)]} for i, text in enumerate(inputs)]
+        # 故意打乱顺序，合并器应按 index 重新排列
+        data.reverse()
+        tokens = sum(len(text) for text in inputs)
+        return httpx.Response(200, json={"object": "list", "model": "ada", "data": data,
+                                         "usage": {"prompt_tokens": tokens, "total_tokens": tokens}})
+    return handler
+
+
+def test_split_usage_keeps_the_total():
+    assert split_usage(10, [1, 1, 1]) == [4, 3, 3]
+    assert sum(split_usage(7, [5, 0, 2])) == 7
+    assert split_usage(3, [0, 0]) == [2, 1]
+
+
+def test_concurrent_requests_share_one_upstream_call(mock_service):
+    calls = []
+    service = mock_service(embeddings_handler(calls))
+    service.embeddings_batcher = EmbeddingsBatcher(service._forward_upstream, window=0.05)
+
+    async def scenario():
+        bodies = [b'{"model": "ada", "input": "a"}', b'{"input": ["bb", "ccc"], "model": "ada"}',
+                  b'{"model": "ada", "input": "dddd"}']
+        return await asyncio.gather(*(
+            service.forward_full_request("POST", EMBEDDINGS, body, {}) for body in bodies
+        ))
+
+    first, second, third = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert calls[0]["input"] == ["a", "bb", "ccc", "dddd"]
+    assert [item["embedding"] for item in first["data"]] == [[1]]
+    assert [(item["index"], item["embedding"]) for item in second["data"]] == [(0, [2]), (1, [3])]
+    assert [item["embedding"] for item in third["data"]] == [[4]]
+    assert sum(r["usage"]["prompt_tokens"] for r in (first, second, third)) == 10
+    assert service.embeddings_batcher.requests_batched == 3
+
+
+def test_different_parameters_and_single_callers_are_not_merged(mock_service):
+    calls = []
+    service = mock_service(embeddings_handler(calls))
+    service.embeddings_batcher = EmbeddingsBatcher(service._forward_upstream, window=0.01)
+
+    async def scenario():
+        return await asyncio.gather(
+            service.forward_full_request("POST", EMBEDDINGS, b'{"input": "a", "dimensions": 256}', {}),
+            service.forward_full_request("POST", EMBEDDINGS, b'{"input": "b", "dimensions": 512}', {}),
+        )
+
+    asyncio.run(scenario())
+    assert sorted(call["dimensions"] for call in calls) == [256, 512]
+    assert [call["input"] for call in calls if call["dimensions"] == 256] == ["a"]
+    assert service.embeddings_batcher.batches_sent == 0
+
+
+def test_invalid_input_fails_only_its_own_caller(mock_service):
+    calls = []
+    ok = embeddings_handler(calls)
+
+    def handler(request: httpx.Request):
+        if b"too long" in request.content:
+            calls.append(json.loads(request.content))
+            return httpx.Response(400, json={"error": {"message": "input is too long"}})
+        return ok(request)
+
+    service = mock_service(handler)
+    service.embeddings_batcher = EmbeddingsBatcher(service._forward_upstream, window=0.05)
+
+    async def scenario():
+        bodies = [b'{"input": "a"}', b'{"input": "too long"}', b'{"input": "ccc"}', b'{"input": ["dd", "e"]}']
+        return await asyncio.gather(*(
+            service.forward_full_request("POST", EMBEDDINGS, body, {}) for body in bodies
+        ))
+
+    first, bad, third, fourth = asyncio.run(scenario())
+    assert bad["error"]["message"] == "input is too long"
+    assert [item["embedding"] for item in first["data"]] == [[1]]
+    assert [item["embedding"] for item in third["data"]] == [[3]]
+    assert [item["embedding"] for item in fourth["data"]] == [[2], [1]]
+    # 整批失败后对半拆分：["a", "too long"] 再拆开，["ccc", "dd", "e"] 合并成功
+    assert sorted(str(call["input"]) for call in calls) == sorted(str(inputs) for inputs in [
+        ["a", "too long", "ccc", "dd", "e"], ["a", "too long"], ["ccc", "dd", "e"], "a", "too long"])
+
+def test_requests_with_different_upstream_headers_are_not_merged(mock_service):
+    calls = []
+    seen = []
+    ok = embeddings_handler(calls)
+
+    def handler(request: httpx.Request):
+        seen.append((request.headers.get("x-ms-region"), request.headers.get("x-request-id")))
+        return ok(request)
+
+    service = mock_service(handler)
+    service.embeddings_batcher = EmbeddingsBatcher(service._forward_upstream, window=0.05)
+
+    async def scenario():
+        await asyncio.gather(
+            service.forward_full_request("POST", EMBEDDINGS, b'{"input": "a"}', {"x-ms-region": "east", "x-request-id": "1"}),
+            service.forward_full_request("POST", EMBEDDINGS, b'{"input": "b"}', {"x-ms-region": "east", "x-request-id": "2"}),
+            service.forward_full_request("POST", EMBEDDINGS, b'{"input": "c"}', {"x-ms-region": "west", "x-request-id": "3"}),
+        )
+
+    asyncio.run(scenario())
+    assert sorted(str(call["input"]) for call in calls) == ["['a', 'b']", "c"]
+    assert ("west", "3") in seen
@@ -0,0 +1,73 @@
+import asyncio
+import httpx
+from src.load_balancer.balancer import RoundRobinStrategy
+from src.services.hedging import Hedger, LatencyWindow
+
+PATH = "/openai/deployments/gpt-4o/chat/completions?api-version=2025-01-01-preview"
+BODY = b'{"messages": []}'
+
+
+def slow_first_instance(calls, delay=0.5):
+    async def handler(request):
+        calls.append(request.url.host)
+        if request.url.host.startswith("one"):
+            await asyncio.sleep(delay)
+        return httpx.Response(200, json={"host": request.url.host})
+    return handler
+
+
+def hedged(service, **options):
+    service.hedger = Hedger(**{"max_delay": 0.05, **options})
+    return service
+
+
+def pin_primary(service):
+    # round_robin makes instance1 the primary of the first request
+    service.balancer.strategy = RoundRobinStrategy()
+    return service
+
+
+def test_latency_window_quantile():
+    window = LatencyWindow(0.95, size=100)
+    for i in range(100):
+        window.observe(i / 100)
+    assert window.value() == 0.95
+    window.observe(5.0)
+    assert window.value() == 0.95
+
+
+def test_delay_is_clamped_and_waits_for_samples():
+    hedger = Hedger(min_delay=0.1, max_delay=2.0, min_samples=5)
+    labels = ("instance1", "gpt-4o")
+    assert hedger.delay_for(labels) == 2.0
+    for _ in range(5):
+        hedger.observe(labels, 0.01)
+    assert hedger.delay_for(labels) == 0.1
+
+
+def test_backup_wins_and_slow_primary_is_cancelled(mock_service):
+    calls = []
+    service = pin_primary(hedged(mock_service(slow_first_instance(calls))))
+
+    result = asyncio.run(service.forward_full_request("POST", PATH, BODY, {}))
+
+    assert result == {"host": "two.openai.azure.com"}
+    assert calls == ["one.openai.azure.com", "two.openai.azure.com"]
+    assert service.hedger.hedges.values[("instance2", "gpt-4o", "won")] == 1
+    assert all(service.balancer.stats_for(i).in_flight == 0 for i in service.instances)
+
+
+def test_fast_primary_sends_no_backup(mock_service):
+    calls = []
+    service = pin_primary(hedged(mock_service(slow_first_instance(calls, delay=0.0)), max_delay=1.0))
+    assert asyncio.run(service.forward_full_request("POST", PATH, BODY, {})) == {"host": "one.openai.azure.com"}
+    assert calls == ["one.openai.azure.com"]
+
+
+def test_empty_hedge_budget_waits_for_the_primary(mock_service):
+    calls = []
+    service = pin_primary(hedged(mock_service(slow_first_instance(calls, delay=0.1))))
+    service.hedger.budget.balance = 0.0
+    assert asyncio.run(service.forward_full_request("POST", PATH, BODY, {})) == {"host": "one.openai.azure.com"}
+    assert calls == ["one.openai.azure.com"]
+    assert service.hedger.budget.exhausted == 1
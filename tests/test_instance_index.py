@@ -0,0 +1,64 @@
+import httpx
+from fastapi.testclient import TestClient
+from src.main import app
+from src.config.settings import Settings
+from src.load_balancer.instance_index import InstanceIndex, parse_path
+
+client = TestClient(app)
+
+INSTANCES = [
+    {"name": "east", "url": "https://east.openai.azure.com/", "api_key": "k1", "deployments": ["gpt-4o"],
+     "aliases": {"embed": "text-embedding-3-large-east"}},
+    {"name": "west", "url": "https://west.openai.azure.com", "api_key": "k2", "deployments": ["gpt-4o-mini"]},
+    {"name": "any", "url": "https://any.openai.azure.com", "api_key": "k3"},
+]
+
+
+def test_parse_path_extracts_deployment():
+    path = parse_path("/openai/deployments/gpt-4o/chat/completions?api-version=2025-01-01-preview")
+    assert path.deployment == "gpt-4o"
+    assert path.suffix == "/chat/completions?api-version=2025-01-01-preview"
+    assert parse_path("deployments/gpt-4o?x=1") == ("openai/deployments/gpt-4o?x=1", "gpt-4o", "?x=1")
+    assert parse_path("openai/models?api-version=1").deployment is None
+
+
+def test_index_maps_deployments_to_hosting_and_wildcard_instances():
+    index = InstanceIndex(INSTANCES)
+    assert [i["name"] for i in index.eligible("gpt-4o")] == ["east", "any"]
+    assert [i["name"] for i in index.eligible("embed")] == ["east", "any"]
+    assert [i["name"] for i in index.eligible("unknown")] == ["any"]
+    assert len(index.eligible(None)) == 3
+
+
+def test_alias_is_rewritten_in_precomputed_url():
+    index = InstanceIndex(INSTANCES)
+    path = parse_path("openai/deployments/embed/embeddings?api-version=1")
+    assert index.route(INSTANCES[0]).url_for(path) == \
+        "https://east.openai.azure.com/openai/deployments/text-embedding-3-large-east/embeddings?api-version=1"
+    assert index.route(INSTANCES[2]).url_for(path) == \
+        "https://any.openai.azure.com/openai/deployments/embed/embeddings?api-version=1"
+
+
+def test_settings_drop_invalid_routing_fields():
+    normalized = Settings._normalize_instances(None, [
+        {"name": "a", "url": "https://a", "api_key": "k", "deployments": "gpt-4o"},
+        {"name": "a", "url": "https://dup", "api_key": "k"},
+        {"name": "b", "url": "https://b"},
+    ])
+    assert normalized == [{"name": "a", "url": "https://a", "api_key": "k"}]
+
+
+def test_requests_only_reach_instances_hosting_the_deployment(mock_service):
+    hosts = []
+
+    def handler(request: httpx.Request):
+        hosts.append((request.url.host, request.headers["api-key"]))
+        return httpx.Response(200, json={"ok": True})
+
+    mock_service(handler, instances=INSTANCES[:2])
+    for _ in range(5):
+        assert client.post("/openai/deployments/gpt-4o-mini/chat/completions", json={}).status_code == 200
+    assert set(hosts) == {("west.openai.azure.com", "k2")}
+    response = client.post("/openai/deployments/missing/chat/completions", json={})
+    assert response.status_code == 404
+    assert len(hosts) == 5
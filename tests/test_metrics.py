@@ -0,0 +1,99 @@
+import httpx
+from fastapi.testclient import TestClient
+from src.main import app
+from src.utils.metrics import Counter, Histogram, render_metrics
+
+client = TestClient(app)
+
+PATH = "/openai/deployments/gpt-4o/chat/completions?api-version=2025-01-01-preview"
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram("latency_seconds", "Latency", ("instance",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(("a",), value)
+    text = render_metrics([histogram])
+    assert "# TYPE latency_seconds histogram" in text
+    assert 'latency_seconds_bucket{instance="a",le="0.1"} 2' in text
+    assert 'latency_seconds_bucket{instance="a",le="1.0"} 3' in text
+    assert 'latency_seconds_bucket{instance="a",le="+Inf"} 4' in text
+    assert 'latency_seconds_count{instance="a"} 4' in text
+    assert 'latency_seconds_sum{instance="a"} 3.65' in text
+
+
+def test_counter_escapes_label_values():
+    counter = Counter("requests_total", "Requests", ("deployment",))
+    counter.inc(('we"ird\\name',))
+    counter.inc(('we"ird\\name',), 2)
+    assert 'requests_total{deployment="we\\"ird\\\\name"} 3' in render_metrics([counter])
+
+
+def test_metrics_endpoint_reports_requests_tokens_and_failovers(mock_service):
+    calls = []
+
+    def handler(request: httpx.Request):
+        calls.append(request.url.host)
+        if len(calls) == 1:
+            return httpx.Response(500, json={"error": {"code": "boom"}})
+        return httpx.Response(200, json={"usage": {"prompt_tokens": 12, "completion_tokens": 5}})
+
+    mock_service(handler)
+    assert client.post(PATH, json={"messages": []}).status_code == 200
+    failed, succeeded = calls
+
+    text = client.get("/metrics").text
+    instance = {"one.openai.azure.com": "instance1", "two.openai.azure.com": "instance2"}
+    first, second = instance[failed], instance[succeeded]
+    assert f'lb_upstream_requests_total{{instance="{first}",deployment="gpt-4o",status="500"}} 1' in text
+    assert f'lb_upstream_requests_total{{instance="{second}",deployment="gpt-4o",status="200"}} 1' in text
+    assert f'lb_failovers_total{{instance="{second}",deployment="gpt-4o"}} 1' in text
+    assert f'lb_tokens_total{{instance="{second}",deployment="gpt-4o",type="prompt"}} 12' in text
+    assert f'lb_tokens_total{{instance="{second}",deployment="gpt-4o",type="completion"}} 5' in text
+    assert f'lb_upstream_latency_seconds_count{{instance="{second}",deployment="gpt-4o"}} 1' in text
+    assert f'lb_in_flight_requests{{instance="{second}"}} 0' in text
+    assert "lb_admission_queued_requests 0" in text
+
+
+def test_stream_records_ttft_chunk_gaps_and_usage(mock_service):
+    body = (
+        b'data: {"choices":[{"delta":{"content":"Hi"}}],"usage":null}\n\n'
+        b'data: {"choices":[],"usage":{"prompt_tokens":7,"completion_tokens":2,"total_tokens":9}}\n\n'
+        b'data: [DONE]\n\n'
+    )
+
+    def handler(request: httpx.Request):
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=body)
+
+    service = mock_service(handler, instances=[{"name": "only", "url": "https://only.openai.azure.com", "api_key": "k"}])
+    response = client.post(PATH, content=b'{"stream":true}', headers={"content-type": "application/json"})
+    assert response.content == body
+
+    labels = ("only", "gpt-4o")
+    assert sum(service.metrics.ttft.series[labels][:-1]) == 1
+    assert service.metrics.tokens.values[labels + ("prompt",)] == 7
+    assert service.metrics.tokens.values[labels + ("completion",)] == 2
+    assert service.metrics.requests.values[labels + (200,)] == 1
+
+
+class SplitUsageStream(httpx.AsyncByteStream):
+    """最后的 usage 事件被切成三个分块，"usage" 键本身也被切断"""
+
+    async def __aiter__(self):
+        yield b'data: {"choices":[{"delta":{"content":"Hi"}}],"usage":null}\n\n'
+        yield b'data: {"choices":[],"us'
+        yield b'age":{"prompt_tokens":11,"completion_tokens":3,'
+        yield b'"total_tokens":14,"prompt_tokens_details":{"cached_tokens":4}}}\n\ndata: [DONE]\n\n'
+
+
+def test_stream_usage_split_across_chunks_is_counted(mock_service):
+    def handler(request: httpx.Request):
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, stream=SplitUsageStream())
+
+    service = mock_service(handler, instances=[{"name": "only", "url": "https://only.openai.azure.com", "api_key": "k"}])
+    response = client.post(PATH, content=b'{"stream":true}', headers={"content-type": "application/json"})
+    assert response.status_code == 200
+
+    labels = ("only", "gpt-4o")
+    assert service.metrics.tokens.values[labels + ("prompt",)] == 11
+    assert service.metrics.tokens.values[labels + ("cached",)] == 4
+    assert service.metrics.tokens.values[labels + ("completion",)] == 3
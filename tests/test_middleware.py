@@ -0,0 +1,61 @@
+import asyncio
+import httpx
+from fastapi.testclient import TestClient
+from starlette.responses import PlainTextResponse, StreamingResponse
+from src.main import app
+from src.middleware.auth_middleware import ApiKeyMiddleware
+from src.middleware.logging_middleware import LoggingMiddleware
+from src.utils import server_timing
+from src.utils.access_log import AccessLog
+
+client = TestClient(app)
+
+PATH = "/openai/deployments/gpt-4o/chat/completions?api-version=2025-01-01-preview"
+
+
+async def ok_app(scope, receive, send):
+    await PlainTextResponse("ok")(scope, receive, send)
+
+
+def test_server_timing_header_reports_queue_and_upstream(mock_service):
+    mock_service(lambda request: httpx.Response(200, json={"id": "x"}))
+    response = client.post(PATH, json={"messages": []})
+    names = [part.split(";")[0].strip() for part in response.headers["server-timing"].split(",")]
+    assert names[:2] == ["queue", "upstream"]
+    assert "app" in names
+
+
+def test_access_log_records_duration_and_bytes_after_stream_ends():
+    async def stream_app(scope, receive, send):
+        async def chunks():
+            for _ in range(3):
+                await asyncio.sleep(0.01)
+                yield b"data: x\n\n"
+        server_timing.record("upstream-ttft", 0.005)
+        await StreamingResponse(chunks(), media_type="text/event-stream")(scope, receive, send)
+
+    log = AccessLog(flush_interval=3600)
+    response = TestClient(LoggingMiddleware(stream_app, log=log)).get("/stream?x=1")
+    assert response.content == b"data: x\n\n" * 3
+    assert response.headers["server-timing"].startswith("upstream-ttft;dur=5.0, app;dur=")
+    record = log.buffer[-1]
+    assert (record["event"], record["method"], record["path"], record["status"]) == ("request", "GET", "/stream?x=1", 200)
+    assert record["bytes_sent"] == 27
+    assert record["duration_ms"] >= 30
+    assert record["timings_ms"]["upstream-ttft"] == 5.0
+    assert server_timing.current() is None
+
+
+def test_api_key_middleware_rejects_missing_malformed_and_wrong_keys():
+    auth_client = TestClient(ApiKeyMiddleware(ok_app, api_key="secret", exempt_paths=("/health",)))
+    missing = auth_client.get("/openai/models")
+    assert missing.status_code == 401
+    assert missing.json()["detail"]["error"]["code"] == "unauthorized"
+    assert auth_client.get("/openai/models", headers={"authorization": "secret"}).status_code == 401
+    assert auth_client.get("/openai/models", headers={"authorization": "Bearer nope"}).status_code == 401
+    assert auth_client.get("/openai/models", headers={"authorization": "Bearer secret"}).text == "ok"
+    assert auth_client.get("/health").text == "ok"
+
+
+def test_api_key_middleware_is_disabled_without_a_key():
+    assert TestClient(ApiKeyMiddleware(ok_app, api_key="")).get("/anything").text == "ok"
@@ -0,0 +1,47 @@
+import json
+import random
+import pytest
+from fastapi.testclient import TestClient
+from benchmarks.load_test import replay_workload
+from benchmarks.mock_azure import LatencyModel, MockProfile, create_app
+
+CHAT = "/i0/openai/deployments/gpt-4o/chat/completions?api-version=2024-10-21"
+
+
+def test_latency_models():
+    rng = random.Random(1)
+    assert LatencyModel("fixed:20").sample(rng) == 0.02
+    assert 0.1 <= LatencyModel("uniform:100,200").sample(rng) <= 0.2
+    assert LatencyModel("lognormal:50,0.1").sample(rng) > 0
+    with pytest.raises(ValueError):
+        LatencyModel("gamma:1")
+
+
+def test_mock_streams_tokens_and_injects_faults_per_instance():
+    fast = MockProfile(latency="fixed:0", tokens=3, tokens_per_second=0)
+    client = TestClient(create_app({"bad": MockProfile(rate_429=1.0, retry_after=2.5)}, fast, seed=1))
+
+    streamed = client.post(CHAT, json={"stream": True, "messages": []})
+    events = [line for line in streamed.text.split("\n\n") if line]
+    assert events[-1] == "data: [DONE]"
+    assert len(events) == 3 + 3
+
+    completion = client.post(CHAT, json={"messages": []}).json()
+    assert completion["usage"]["completion_tokens"] == 3
+
+    throttled = client.post(CHAT.replace("/i0/", "/bad/"), json={"messages": []})
+    assert throttled.status_code == 429
+    assert (throttled.headers["retry-after"], throttled.headers["retry-after-ms"]) == ("3", "2500")
+    assert client.get("/_mock/stats").json() == {"i0": 2, "bad": 1}
+
+
+def test_replay_accepts_request_bodies_and_plain_prompts(tmp_path):
+    path = tmp_path / "capture.jsonl"
+    path.write_text("\n".join([
+        json.dumps({"path": "/openai/deployments/ada/embeddings", "body": {"input": "x"}}),
+        json.dumps({"request_id": "r1", "title": "t", "body": "Explain the change"}),
+    ]), encoding="utf-8")
+    workload = replay_workload(str(path), 3, 0.0, random.Random(1))
+    assert [item.path for item in workload][:1] == ["openai/deployments/ada/embeddings"]
+    assert json.loads(workload[1].body)["messages"][0]["content"] == "Explain the change"
+    assert workload[2].path == workload[0].path
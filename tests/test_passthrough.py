@@ -0,0 +1,80 @@
+import json
+import httpx
+from fastapi.testclient import TestClient
+from src.main import app
+from src.utils.request_body import sniff_json_scalar, sniff_stream
+
+client = TestClient(app)
+
+
+def test_sniff_stream_detects_top_level_flag():
+    assert sniff_stream(b'{"messages": [], "stream": true}')
+    assert sniff_stream(b'{"stream" :  true, "messages": []}')
+    assert not sniff_stream(b'{"messages": [], "stream": false}')
+    assert not sniff_stream(b'{"messages": []}')
+    assert not sniff_stream(b'')
+
+
+def test_sniff_stream_ignores_escaped_text_in_content():
+    body = json.dumps({"messages": [{"role": "user", "content": '{"stream": true}'}]}).encode()
+    assert not sniff_stream(body)
+
+
+def test_sniff_json_scalar_returns_raw_value():
+    body = b'{"max_tokens": 300, "stream_options": {"include_usage": true}}'
+    assert sniff_json_scalar(body, "max_tokens") == b"300"
+    assert sniff_json_scalar(body, "stream") is None
+
+
+def test_sniff_json_scalar_ignores_nested_keys():
+    tools = [{"type": "function", "function": {"name": "pick", "parameters": {
+        "type": "object", "properties": {"n": {"type": "integer", "max_tokens": 5}, "temperature": {"type": "number"}},
+        "max_tokens": 7, "stream": True}}}]
+    body = json.dumps({"messages": [{"role": "user", "content": "a {[ b"}], "tools": tools,
+                       "temperature": 0, "max_tokens": 300}).encode()
+    assert sniff_json_scalar(body, "max_tokens") == b"300"
+    assert sniff_json_scalar(body, "temperature") == b"0"
+    assert sniff_json_scalar(body, "n") is None
+    assert not sniff_stream(body)
+    nested_only = json.dumps({"response_format": {"json_schema": {"schema": {"max_tokens": 9}}}}).encode()
+    assert sniff_json_scalar(nested_only, "max_tokens") is None
+    escaped = json.dumps({"messages": [{"content": 'quote \\" and } ] braces', "n": 2}], "n": 3}).encode()
+    assert sniff_json_scalar(escaped, "n") == b"3"
+
+
+def test_post_body_is_forwarded_byte_for_byte(mock_service):
+    seen = {}
+
+    def handler(request: httpx.Request):
+        seen["body"] = request.content
+        return httpx.Response(200, json={"ok": True})
+
+    mock_service(handler)
+    raw = b'{"messages":[{"role":"user","content":"hi"}],   "max_tokens":5}'
+    response = client.post(
+        "/openai/deployments/gpt-4o/chat/completions?api-version=2025-01-01-preview",
+        content=raw,
+        headers={"content-type": "application/json"},
+    )
+    assert response.status_code == 200
+    assert seen["body"] == raw
+
+
+def test_non_json_body_is_streamed_and_replayed_on_failover(mock_service):
+    bodies = []
+
+    def handler(request: httpx.Request):
+        bodies.append(request.read())
+        if len(bodies) == 1:
+            return httpx.Response(500, json={"error": {"message": "boom"}})
+        return httpx.Response(200, json={"text": "ok"})
+
+    mock_service(handler)
+    payload = b"--boundary\r\nfile-content\r\n--boundary--\r\n"
+    response = client.post(
+        "/openai/deployments/whisper/audio/transcriptions",
+        content=payload,
+        headers={"content-type": "multipart/form-data; boundary=boundary"},
+    )
+    assert response.status_code == 200
+    assert bodies == [payload, payload]
@@ -0,0 +1,86 @@
+import asyncio
+import base64
+import json
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from src.main import app
+from src.load_balancer.balancer import CapacityExhausted, LoadBalancer
+from src.load_balancer.rate_limit import RateLimitBudget
+from src.utils.tokens import IMAGE_TOKENS, estimate_request_tokens
+
+client = TestClient(app)
+
+PATH = "/openai/deployments/gpt-4o/chat/completions?api-version=2025-01-01-preview"
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_estimate_counts_max_tokens_and_images_not_base64_length():
+    image = "data:image/png;base64," + base64.b64encode(b"\0" * 300000).decode()
+    body = json.dumps({
+        "messages": [{"role": "user", "content": [
+            {"type": "text", "text": "describe"},
+            {"type": "image_url", "image_url": {"url": image}},
+        ]}],
+        "max_tokens": 200,
+    }).encode()
+    estimate = estimate_request_tokens(body, "openai/deployments/gpt-4o/chat/completions")
+    assert IMAGE_TOKENS + 200 < estimate < IMAGE_TOKENS + 300
+    assert estimate_request_tokens(b'{"input": "hello"}', "openai/deployments/ada/embeddings") == 4
+    assert estimate_request_tokens(b"", "") == 0
+
+
+def test_budget_refills_towards_limit():
+    clock = FakeClock()
+    budget = RateLimitBudget(clock=clock)
+    assert budget.can_admit(10 ** 9)
+    budget.update_from_headers({"x-ratelimit-remaining-tokens": "600", "x-ratelimit-limit-tokens": "6000"})
+    assert budget.can_admit(600)
+    assert not budget.can_admit(700)
+    # 6000 TPM = 100 tokens/s
+    assert budget.wait_time(700) == pytest.approx(1.0)
+    clock.now += 1.0
+    assert budget.can_admit(700)
+    budget.reserve(700)
+    assert not budget.can_admit(1)
+
+
+def test_acquire_prefers_instance_with_headroom_then_holds_and_rejects():
+    clock = FakeClock()
+    instances = [{"name": "a", "url": "https://a", "api_key": "k"}, {"name": "b", "url": "https://b", "api_key": "k"}]
+    balancer = LoadBalancer(instances, strategy="random", max_capacity_wait=0.5, clock=clock)
+    balancer.record_response(instances[0], 200, {"x-ratelimit-remaining-tokens": "100", "x-ratelimit-limit-tokens": "60000"}, 0.1)
+    balancer.record_response(instances[1], 200, {"x-ratelimit-remaining-tokens": "5000", "x-ratelimit-limit-tokens": "60000"}, 0.1)
+
+    lease = asyncio.run(balancer.acquire(tokens=3000))
+    assert lease.instance["name"] == "b"
+    lease.release()
+
+    # 两个实例都不足，b 需要 (3000 - 2000) / 1000 = 1 秒才能恢复，超过等待上限
+    with pytest.raises(CapacityExhausted) as error:
+        asyncio.run(balancer.acquire(tokens=3000))
+    assert error.value.retry_after == pytest.approx(1.0)
+
+
+def test_exhausted_budget_is_rejected_locally(mock_service):
+    calls = []
+
+    def handler(request: httpx.Request):
+        calls.append(request.url.host)
+        return httpx.Response(200, headers={"x-ratelimit-remaining-tokens": "10", "x-ratelimit-limit-tokens": "60"},
+                              json={"ok": True})
+
+    service = mock_service(handler, instances=[{"name": "only", "url": "https://only", "api_key": "k"}])
+    service.balancer.max_capacity_wait = 0
+    assert client.post(PATH, json={"messages": [], "max_tokens": 5}).status_code == 200
+    response = client.post(PATH, json={"messages": [], "max_tokens": 5000})
+    assert response.status_code == 429
+    assert "retry-after" in response.headers
+    assert len(calls) == 1
@@ -0,0 +1,137 @@
+import asyncio
+import httpx
+from src.services.retry import RetryBudget, RetryPolicy, RetryState
+
+PATH = "/openai/deployments/gpt-4o/chat/completions?api-version=2025-01-01-preview"
+INSTANCES = [
+    {"name": "instance1", "url": "https://one.openai.azure.com", "api_key": "key-one"},
+    {"name": "instance2", "url": "https://two.openai.azure.com", "api_key": "key-two"},
+    {"name": "instance3", "url": "https://three.openai.azure.com", "api_key": "key-three"},
+]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_budget_limits_retries_to_a_fraction_of_requests():
+    clock = FakeClock()
+    budget = RetryBudget(ratio=0.25, min_per_second=0.0, clock=clock)
+    budget.balance = 0.0
+    allowed = 0
+    for _ in range(100):
+        budget.deposit()
+        allowed += budget.try_withdraw()
+    assert allowed == 25
+    assert budget.exhausted == 75
+
+    budget = RetryBudget(ratio=0.0, min_per_second=2.0, clock=clock)
+    budget.balance = 0.0
+    clock.now += 1.0
+    assert [budget.try_withdraw() for _ in range(3)] == [True, True, False]
+
+
+def test_state_stops_at_max_attempts_and_deadline():
+    clock = FakeClock()
+    policy = RetryPolicy(timeout=10.0, max_attempts=2, backoff_base=0.0)
+    state = RetryState(policy, RetryBudget(clock=clock), clock=clock)
+    state.start_attempt("a")
+    assert asyncio.run(state.retry())
+    state.start_attempt("b")
+    assert not asyncio.run(state.retry())
+
+    state = RetryState(policy, RetryBudget(clock=clock), clock=clock)
+    state.start_attempt("a")
+    clock.now += 10.0
+    assert not asyncio.run(state.retry())
+
+
+def test_waits_for_a_short_retry_after_then_retries_the_same_instance():
+    clock = FakeClock()
+    state = RetryState(RetryPolicy(max_wait=2.0), RetryBudget(clock=clock), clock=clock)
+    state.start_attempt("a")
+    assert not asyncio.run(state.retry(cooldown=0.0))
+    assert not asyncio.run(state.retry(cooldown=5.0))
+    assert asyncio.run(state.retry(cooldown=0.01))
+    assert state.tried == []
+
+
+def test_terminal_status_is_returned_without_failover(mock_service):
+    calls = []
+
+    def handler(request):
+        calls.append(request.url.host)
+        return httpx.Response(400, json={"error": {"code": "content_filter"}})
+
+    service = mock_service(handler)
+    result = asyncio.run(service.forward_full_request("POST", PATH, b'{"messages": []}', {}))
+    assert result["_azure_openai_status_code"] == 400
+    assert len(calls) == 1
+
+
+def test_retryable_failures_stop_at_max_attempts(mock_service):
+    calls = []
+
+    def handler(request):
+        calls.append(request.url.host)
+        return httpx.Response(500, json={"error": {"code": "InternalServerError"}})
+
+    service = mock_service(handler, instances=INSTANCES)
+    service.retry_policy = RetryPolicy(max_attempts=2, backoff_base=0.0)
+    result = asyncio.run(service.forward_full_request("POST", PATH, b'{"messages": []}', {}))
+    assert result["_azure_openai_status_code"] == 500
+    assert len(calls) == 2
+    assert service.retry_budget.retries == 1
+
+
+def test_empty_budget_returns_the_first_error(mock_service):
+    calls = []
+
+    def handler(request):
+        calls.append(request.url.host)
+        return httpx.Response(503, json={"error": {"code": "unavailable"}})
+
+    service = mock_service(handler)
+    service.retry_budget = RetryBudget(ratio=0.0, min_per_second=0.0)
+    service.retry_budget.balance = 0.0
+    result = asyncio.run(service.forward_full_request("POST", PATH, b'{"messages": []}', {}))
+    assert result["_azure_openai_status_code"] == 503
+    assert len(calls) == 1
+    assert service.retry_budget.exhausted == 1
+
+
+def test_concurrent_requests_keep_their_own_errors(mock_service):
+    def handler(request):
+        code = "a" if b'"a"' in request.content else "b"
+        return httpx.Response(500, json={"error": {"code": code}})
+
+    service = mock_service(handler)
+    service.retry_policy = RetryPolicy(backoff_base=0.01)
+
+    async def scenario():
+        return await asyncio.gather(
+            service.forward_full_request("POST", PATH, b'{"user": "a"}', {}),
+            service.forward_full_request("POST", PATH, b'{"user": "b"}', {}),
+        )
+
+    first, second = asyncio.run(scenario())
+    assert first["error"]["code"] == "a"
+    assert second["error"]["code"] == "b"
+
+
+def test_attempt_timeout_is_bounded_by_the_request_deadline(mock_service):
+    timeouts = []
+
+    def handler(request):
+        timeouts.append(request.extensions["timeout"])
+        return httpx.Response(200, json={"ok": True})
+
+    service = mock_service(handler)
+    service.retry_policy = RetryPolicy(timeout=3.0)
+    asyncio.run(service.forward_full_request("POST", PATH, b'{"messages": []}', {}))
+    assert 0 < timeouts[0]["read"] <= 3.0
+    assert timeouts[0]["connect"] <= 3.0
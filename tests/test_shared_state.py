@@ -0,0 +1,111 @@
+import asyncio
+import struct
+import subprocess
+import sys
+import pytest
+from src.load_balancer.balancer import LoadBalancer
+from src.load_balancer.shared_state import SharedState
+
+INSTANCES = [
+    {"name": "a", "url": "https://a", "api_key": "k"},
+    {"name": "b", "url": "https://b", "api_key": "k"},
+]
+NAMES = [instance["name"] for instance in INSTANCES]
+EMPTY = (None, None, 0.0)
+
+
+@pytest.fixture
+def segment(tmp_path):
+    return SharedState.create(2, NAMES, path=str(tmp_path / "state"))
+
+
+def test_workers_claim_distinct_slots_and_see_each_other(segment):
+    first = SharedState.attach(segment, NAMES)
+    second = SharedState.attach(segment, NAMES)
+    assert (first.slot, second.slot) == (0, 1)
+
+    first.publish(1, 150.0, 3, (500.0, 1000.0, 90.0), (9.0, 10.0, 90.0))
+    assert second.open_until(1) == 150.0
+    assert second.open_until(0) == 0.0
+    assert second.peer_in_flight(1) == 3
+    assert second.freshest_buckets(1) == ((500.0, 1000.0, 90.0), (9.0, 10.0, 90.0))
+    # A worker never reads its own slot back as a peer
+    assert first.peer_in_flight(1) == 0
+    assert first.freshest_buckets(0) == (None, None)
+
+    with pytest.raises(RuntimeError):
+        SharedState.attach(segment, NAMES)
+    first.close()
+    second.close()
+
+
+def test_closed_slot_is_reclaimed_and_cleared(segment):
+    first = SharedState.attach(segment, NAMES)
+    peer = SharedState.attach(segment, NAMES)
+    first.publish(0, 0.0, 5, EMPTY, EMPTY)
+    first.close()
+    assert peer.peer_in_flight(0) == 0
+    replacement = SharedState.attach(segment, NAMES)
+    assert replacement.slot == 0
+    peer.close()
+    replacement.close()
+
+
+def test_slots_of_killed_workers_are_not_counted(segment):
+    first = SharedState.attach(segment, NAMES)
+    peer = SharedState.attach(segment, NAMES)
+    first.peer_check_interval = 0.0
+    peer.publish(0, 500.0, 4, (10.0, 100.0, 90.0), EMPTY)
+    assert first.peer_in_flight(0) == 4
+
+    # The peer's process dies without close(): its pid and records stay in the segment
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    struct.pack_into("<Q", first.buffer, first._pids_offset + 8 * peer.slot, dead.pid)
+    assert first.peer_in_flight(0) == 0
+    assert first.open_until(0) == 0.0
+    assert first.freshest_buckets(0) == (None, None)
+    peer.buffer.close()
+    first.close()
+
+
+def test_attach_rejects_a_different_instance_list(segment):
+    with pytest.raises(ValueError):
+        SharedState.attach(segment, ["a", "c"])
+
+
+def test_throttle_in_one_worker_is_honoured_by_the_other(segment):
+    workers = [LoadBalancer(INSTANCES, strategy="round_robin", shared=SharedState.attach(segment, NAMES))
+               for _ in range(2)]
+
+    lease = asyncio.run(workers[0].acquire())
+    assert lease.instance["name"] == "a"
+    lease.record_response(429, {"retry-after": "10"})
+    lease.release()
+
+    assert [i["name"] for i in workers[1].candidates()] == ["b"]
+    # The cooldown runs out and a probe succeeds
+    breaker = workers[0].breaker_for(lease.instance)
+    breaker.open_until = breaker.clock()
+    breaker.record_success()
+    workers[0].publish(lease.instance)
+    assert [i["name"] for i in workers[1].candidates()] == ["a", "b"]
+    for balancer in workers:
+        balancer.shared.close()
+
+
+def test_in_flight_and_budgets_are_shared(segment):
+    workers = [LoadBalancer(INSTANCES, strategy="least_in_flight", shared=SharedState.attach(segment, NAMES))
+               for _ in range(2)]
+
+    lease = asyncio.run(workers[0].acquire())
+    assert workers[1].in_flight(lease.instance) == 1
+    # The other worker sees the outstanding request and picks the idle instance
+    assert asyncio.run(workers[1].acquire()).instance["name"] != lease.instance["name"]
+
+    lease.record_response(200, {"x-ratelimit-remaining-tokens": "0", "x-ratelimit-limit-tokens": "60000"})
+    lease.release()
+    assert workers[1].in_flight(lease.instance) == 0
+    assert workers[1]._sync_budget(lease.instance).tokens.remaining == 0
+    for balancer in workers:
+        balancer.shared.close()
@@ -0,0 +1,120 @@
+import asyncio
+import httpx
+from fastapi.responses import StreamingResponse
+from src.services.singleflight import SingleFlight, StreamBroadcast
+
+PATH = "openai/deployments/gpt-4o/chat/completions?api-version=2025-01-01-preview"
+SSE_BODY = (
+    b'data: {"choices":[{"delta":{"content":"Hel"}}]}\n\n'
+    b'data: {"choices":[{"delta":{"content":"lo"}}]}\n\n'
+    b'data: [DONE]\n\n'
+)
+
+
+def slow_handler(calls, response):
+    async def handler(request: httpx.Request):
+        calls.append(request.content)
+        await asyncio.sleep(0.05)
+        return response()
+    return handler
+
+
+def enable(service, mode="deterministic", streams=False):
+    service.singleflight_mode = mode
+    service.singleflight = SingleFlight(fan_out_streams=streams)
+    return service
+
+
+def test_identical_requests_share_one_upstream_call(mock_service):
+    calls = []
+    service = enable(mock_service(slow_handler(calls, lambda: httpx.Response(200, json={"id": "one"}))))
+
+    async def scenario():
+        body = b'{"temperature": 0, "messages": []}'
+        return await asyncio.gather(*(service.forward_full_request("POST", PATH, body, {}) for _ in range(5)))
+
+    results = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert all(result == {"id": "one"} for result in results)
+    assert (service.singleflight.leaders, service.singleflight.shared) == (1, 4)
+    assert service.singleflight.calls == {}
+
+
+def test_waiters_get_their_own_copy_of_an_error(mock_service):
+    calls = []
+    service = enable(mock_service(slow_handler(calls, lambda: httpx.Response(400, json={"error": {"code": "bad"}}))))
+    # 400 is not retryable, so each flight makes a single upstream call
+    calls_per_flight = 1
+
+    async def scenario():
+        body = b'{"temperature": 0}'
+        return await asyncio.gather(*(service.forward_full_request("POST", PATH, body, {}) for _ in range(3)))
+
+    results = asyncio.run(scenario())
+    assert len(calls) == calls_per_flight
+    assert all(result["_azure_openai_status_code"] == 400 for result in results)
+    assert len({id(result) for result in results}) == 3
+
+
+def test_mode_controls_which_requests_are_merged(mock_service):
+    calls = []
+    service = enable(mock_service(slow_handler(calls, lambda: httpx.Response(200, json={"id": "x"}))))
+
+    async def scenario(body, headers=None):
+        await asyncio.gather(*(service.forward_full_request("POST", PATH, body, headers or {}) for _ in range(2)))
+
+    asyncio.run(scenario(b'{"temperature": 0.7}'))
+    assert len(calls) == 2
+    asyncio.run(scenario(b'{"temperature": 0}', {"x-lb-cache": "bypass"}))
+    assert len(calls) == 4
+    service.singleflight_mode = "all"
+    asyncio.run(scenario(b'{"temperature": 0.7}'))
+    assert len(calls) == 5
+
+
+def test_identical_streams_share_one_upstream_stream(mock_service):
+    calls = []
+    service = enable(mock_service(slow_handler(
+        calls, lambda: httpx.Response(200, headers={"content-type": "text/event-stream"}, content=SSE_BODY)
+    )), streams=True)
+
+    async def read(response):
+        return b"".join([chunk async for chunk in response.body_iterator])
+
+    async def scenario():
+        body = b'{"temperature": 0, "stream": true}'
+        responses = await asyncio.gather(*(service.forward_streaming_request("POST", PATH, body, {}) for _ in range(3)))
+        assert all(isinstance(response, StreamingResponse) for response in responses)
+        return await asyncio.gather(*(read(response) for response in responses))
+
+    assert asyncio.run(scenario()) == [SSE_BODY] * 3
+    assert len(calls) == 1
+    assert service.singleflight.streams == {}
+
+
+def test_broadcast_replays_to_late_subscribers_and_stops_when_all_leave():
+    async def upstream(gate):
+        yield b"a"
+        await gate.wait()
+        yield b"b"
+
+    async def scenario():
+        gate = asyncio.Event()
+        broadcast = StreamBroadcast(upstream(gate), "text/event-stream", on_done=lambda: None)
+        first = broadcast.response().body_iterator
+        assert await first.__anext__() == b"a"
+        late = broadcast.response().body_iterator
+        assert await late.__anext__() == b"a"
+        gate.set()
+        assert await first.__anext__() == b"b"
+        assert await late.__anext__() == b"b"
+
+        gate = asyncio.Event()
+        abandoned = StreamBroadcast(upstream(gate), "text/event-stream", on_done=lambda: None)
+        iterator = abandoned.response().body_iterator
+        await iterator.__anext__()
+        await iterator.aclose()
+        await asyncio.sleep(0)
+        assert abandoned.task.cancelled()
+
+    asyncio.run(scenario())
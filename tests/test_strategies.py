@@ -0,0 +1,77 @@
+import asyncio
+from collections import Counter
+import pytest
+from src.load_balancer.balancer import STRATEGIES, LoadBalancer
+
+INSTANCES = [
+    {"name": "fast", "url": "https://fast", "api_key": "k", "weight": 3},
+    {"name": "slow", "url": "https://slow", "api_key": "k", "weight": 1},
+]
+
+
+def pick(balancer, exclude=()):
+    lease = asyncio.run(balancer.acquire(exclude))
+    lease.release()
+    return lease.instance["name"]
+
+
+def test_round_robin_alternates():
+    balancer = LoadBalancer(INSTANCES, strategy="round_robin")
+    assert [pick(balancer) for _ in range(4)] == ["fast", "slow", "fast", "slow"]
+
+
+def test_weighted_follows_instance_weights():
+    balancer = LoadBalancer(INSTANCES, strategy="weighted")
+    assert Counter(pick(balancer) for _ in range(40)) == {"fast": 30, "slow": 10}
+
+
+def test_least_in_flight_avoids_busy_instance():
+    balancer = LoadBalancer(INSTANCES, strategy="least_in_flight")
+    busy = [asyncio.run(balancer.acquire(exclude=["slow"])) for _ in range(4)]
+    assert pick(balancer) == "slow"
+    for lease in busy:
+        lease.release()
+    assert balancer.stats_for(INSTANCES[0]).in_flight == 0
+
+
+@pytest.mark.parametrize("strategy", ["p2c_ewma", "peak_ewma"])
+def test_latency_aware_strategies_prefer_faster_instance(strategy):
+    balancer = LoadBalancer(INSTANCES, strategy=strategy)
+    balancer.record_response(INSTANCES[0], 200, {}, 0.05)
+    balancer.record_response(INSTANCES[1], 200, {}, 2.0)
+    assert Counter(pick(balancer) for _ in range(20)) == {"fast": 20}
+
+
+def test_open_breaker_and_exclusions_are_skipped():
+    balancer = LoadBalancer(INSTANCES, strategy="random")
+    balancer.record_response(INSTANCES[0], 429, {"retry-after": "30"}, 0.1)
+    assert {pick(balancer) for _ in range(10)} == {"slow"}
+    assert asyncio.run(balancer.acquire(exclude=["slow"])) is None
+    assert 29 < balancer.breaker_for(INSTANCES[0]).remaining_cooldown() <= 30
+    assert balancer.min_cooldown() == 0.0
+
+
+def test_unknown_strategy_is_rejected():
+    with pytest.raises(ValueError):
+        LoadBalancer(INSTANCES, strategy="fastest")
+    assert set(STRATEGIES) == {"random", "round_robin", "weighted", "least_in_flight", "p2c_ewma", "peak_ewma"}
+
+
+@pytest.mark.parametrize("strategy", ["p2c_ewma", "peak_ewma"])
+def test_unobserved_instances_count_as_typical_not_free(strategy):
+    balancer = LoadBalancer([dict(instance, weight=1) for instance in INSTANCES], strategy=strategy)
+    balancer.record_response(balancer.instances[0], 200, {}, 0.5)
+    busy = [asyncio.run(balancer.acquire(exclude=["fast"])) for _ in range(4)]
+    # "slow" has no latency samples but four requests in flight: the idle observed instance wins
+    assert Counter(pick(balancer) for _ in range(10)) == {"fast": 10}
+    for lease in busy:
+        lease.release()
+
+
+def test_stream_ttft_and_full_response_latencies_are_compared_per_kind():
+    balancer = LoadBalancer(INSTANCES, strategy="p2c_ewma")
+    for _ in range(20):
+        balancer.record_response(INSTANCES[0], 200, {}, 0.3, kind="ttft")
+        balancer.record_response(INSTANCES[1], 200, {}, 6.0, kind="response")
+    fast, slow = (balancer.stats_for(instance).ewma for instance in INSTANCES)
+    assert 0.5 < fast / slow < 2
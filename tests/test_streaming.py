@@ -0,0 +1,131 @@
+import asyncio
+import httpx
+from fastapi.testclient import TestClient
+from src.main import app
+
+client = TestClient(app)
+
+PATH = "/openai/deployments/gpt-4o/chat/completions?api-version=2025-01-01-preview"
+SSE_BODY = (
+    b'data: {"choices":[{"delta":{"content":"Hel"}}]}\n\n'
+    b'data: {"choices":[{"delta":{"content":"lo"}}]}\n\n'
+    b'data: [DONE]\n\n'
+)
+
+
+def test_stream_is_relayed_byte_for_byte(mock_service):
+    seen = {}
+
+    def handler(request: httpx.Request):
+        seen["accept-encoding"] = request.headers.get("accept-encoding")
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=SSE_BODY)
+
+    mock_service(handler)
+    response = client.post(PATH, content=b'{"messages":[],"stream":true}',
+                           headers={"content-type": "application/json"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert response.content == SSE_BODY
+    assert seen["accept-encoding"] == "identity"
+
+
+def test_stream_fails_over_before_first_byte(mock_service):
+    calls = []
+
+    def handler(request: httpx.Request):
+        calls.append(request.url.host)
+        if len(calls) == 1:
+            return httpx.Response(429, headers={"retry-after": "5"}, json={"error": {"code": "429"}})
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=SSE_BODY)
+
+    mock_service(handler)
+    response = client.post(PATH, content=b'{"stream":true}', headers={"content-type": "application/json"})
+    assert response.status_code == 200
+    assert response.content == SSE_BODY
+    assert len(set(calls)) == 2
+
+
+def test_stream_returns_upstream_error_when_all_instances_fail(mock_service):
+    def handler(request: httpx.Request):
+        return httpx.Response(429, headers={"retry-after": "7"}, json={"error": {"code": "429"}})
+
+    mock_service(handler)
+    response = client.post(PATH, content=b'{"stream":true}', headers={"content-type": "application/json"})
+    assert response.status_code == 429
+    assert response.headers["retry-after"] == "7"
+    assert response.json() == {"error": {"code": "429"}}
+
+
+class SlowStream(httpx.AsyncByteStream):
+    def __init__(self, delay):
+        self.delay = delay
+
+    async def __aiter__(self):
+        await asyncio.sleep(self.delay)
+        yield SSE_BODY
+
+
+def test_stream_fails_over_when_first_event_is_too_slow(mock_service):
+    hosts = []
+
+    def handler(request: httpx.Request):
+        hosts.append(request.url.host)
+        delay = 5 if len(hosts) == 1 else 0
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, stream=SlowStream(delay))
+
+    service = mock_service(handler)
+    service.stream_ttft_timeout = 0.05
+    response = client.post(PATH, content=b'{"stream":true}', headers={"content-type": "application/json"})
+    assert response.status_code == 200
+    assert response.content == SSE_BODY
+    assert len(hosts) == 2
+
+
+class CarriageReturnStream(httpx.AsyncByteStream):
+    """首个事件以 CRLF 或 CR 空行结束，之后上游停顿"""
+
+    def __init__(self, newline: bytes):
+        self.newline = newline
+
+    async def __aiter__(self):
+        yield b'data: {"choices":[]}' + self.newline * 2
+        await asyncio.sleep(0.3)
+        yield b"data: [DONE]" + self.newline * 2
+
+
+def test_stream_first_event_accepts_crlf_and_cr_terminators(mock_service):
+    for newline in (b"\r\n", b"\r"):
+        hosts = []
+
+        def handler(request: httpx.Request):
+            hosts.append(request.url.host)
+            return httpx.Response(200, headers={"content-type": "text/event-stream"},
+                                  stream=CarriageReturnStream(newline))
+
+        service = mock_service(handler)
+        service.stream_ttft_timeout = 0.1
+        response = client.post(PATH, content=b'{"stream":true}', headers={"content-type": "application/json"})
+        assert response.status_code == 200
+        assert response.content == b'data: {"choices":[]}' + newline * 2 + b"data: [DONE]" + newline * 2
+        # 首个事件在超时前就已完整，不会因为等待 "\n\n" 而切换实例
+        assert len(hosts) == 1
+
+
+class BrokenStream(httpx.AsyncByteStream):
+    async def __aiter__(self):
+        yield b'data: {"choices":[]}\n\n'
+        yield b'data: {"choi'
+        raise httpx.ReadError("connection reset")
+
+
+def test_stream_interrupted_after_first_byte_sends_error_event(mock_service):
+    def handler(request: httpx.Request):
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, stream=BrokenStream())
+
+    mock_service(handler)
+    response = client.post(PATH, content=b'{"stream":true}', headers={"content-type": "application/json"})
+    assert response.status_code == 200
+    body = response.content
+    assert body.startswith(b'data: {"choices":[]}\n\ndata: {"choi\n\n')
+    assert b"event: error\ndata: " in body
+    assert body.endswith(b"\n\n")
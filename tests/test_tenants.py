@@ -0,0 +1,149 @@
+import hashlib
+from fastapi.testclient import TestClient
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
+from src.middleware.auth_middleware import ApiKeyMiddleware
+from src.services.tenants import Tenant, TenantRegistry
+from src.utils.metrics import render_metrics
+
+USAGE = b'{"choices": [], "usage": {"prompt_tokens": 60, "completion_tokens": 40, "total_tokens": 100}}'
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+async def usage_app(scope, receive, send):
+    if scope["path"] == "/stream":
+        async def chunks():
+            yield b'data: {"choices": [{"delta": {"content": "hi"}}]}\n\n'
+            yield b'data: {"choices": [], "usage": {"prompt_tokens": 5, "completion_tokens": 7}}\n\n'
+            yield b"data: [DONE]\n\n"
+        await StreamingResponse(chunks(), media_type="text/event-stream")(scope, receive, send)
+        return
+    await Response(USAGE, media_type="application/json")(scope, receive, send)
+
+
+def test_keys_are_found_by_digest_including_prehashed_ones():
+    registry = TenantRegistry.from_config([
+        {"name": "team-a", "key": "key-a", "rpm": 10},
+        {"name": "team-b", "key_sha256": hashlib.sha256(b"key-b").hexdigest()},
+        {"name": "broken", "key_sha256": "abc"},
+        {"key": "nameless"},
+    ])
+    assert len(registry) == 2
+    assert registry.lookup(b"key-a").name == "team-a"
+    assert registry.lookup(b"key-b").name == "team-b"
+    assert registry.lookup(b"key-c") is None
+
+
+def test_rpm_refills_over_the_minute():
+    clock = FakeClock()
+    tenant = Tenant("team", rpm=2, clock=clock)
+    assert [tenant.admit() for _ in range(3)][:2] == [0.0, 0.0]
+    assert tenant.rejected == 1
+    assert tenant.admit() == 30.0
+    clock.now += 30.0
+    assert tenant.admit() == 0.0
+
+
+def test_reported_usage_is_charged_against_tpm():
+    clock = FakeClock()
+    tenant = Tenant("team", tpm=120, clock=clock)
+    tenant.charge(60, 40)
+    assert tenant.admit() == 0.0
+    tenant.charge(60, 40)
+    assert (tenant.prompt_tokens, tenant.completion_tokens) == (120, 80)
+    assert tenant.admit() == 40.5
+    clock.now += 41.0
+    assert tenant.admit() == 0.0
+
+
+def test_middleware_rejects_over_quota_tenants_before_the_app_runs():
+    calls = []
+
+    async def app(scope, receive, send):
+        calls.append(scope.get("tenant"))
+        await usage_app(scope, receive, send)
+
+    registry = TenantRegistry.from_config([{"name": "team-a", "key": "key-a", "tpm": 150}])
+    client = TestClient(ApiKeyMiddleware(app, api_key="shared", tenants=registry))
+    headers = {"authorization": "Bearer key-a"}
+
+    assert client.post("/openai/x", headers=headers).content == USAGE
+    assert client.post("/openai/x", headers=headers).status_code == 200
+    rejected = client.post("/openai/x", headers=headers)
+    assert rejected.status_code == 429
+    assert rejected.json()["error"]["code"] == "tenant_quota_exceeded"
+    assert int(rejected.headers["retry-after"]) >= 1
+    assert calls == ["team-a", "team-a"]
+
+    assert client.get("/openai/x", headers={"authorization": "Bearer shared"}).status_code == 200
+    assert client.get("/openai/x", headers={"authorization": "Bearer other"}).status_code == 401
+    assert calls == ["team-a", "team-a", None]
+
+
+def test_stream_usage_chunk_is_charged_and_exported():
+    registry = TenantRegistry.from_config([{"name": "team-a", "key": "key-a"}])
+    client = TestClient(ApiKeyMiddleware(usage_app, tenants=registry))
+    assert client.get("/stream", headers={"authorization": "Bearer key-a"}).status_code == 200
+    tenant = registry.lookup(b"key-a")
+    assert (tenant.prompt_tokens, tenant.completion_tokens) == (5, 7)
+    assert 'lb_tenant_tokens_total{tenant="team-a",type="completion"} 7' in render_metrics(registry.collectors())
+
+
+def stream_app(chunks, status=200):
+    async def app(scope, receive, send):
+        await receive()
+
+        async def body():
+            for chunk in chunks:
+                yield chunk
+        await StreamingResponse(body(), status_code=status, media_type="text/event-stream")(scope, receive, send)
+    return app
+
+
+def test_stream_without_include_usage_is_charged_the_estimate():
+    clock = FakeClock()
+    registry = TenantRegistry.from_config([{"name": "team-a", "key": "key-a", "tpm": 1000}], clock=clock)
+    client = TestClient(ApiKeyMiddleware(stream_app([b'data: {"choices": []}\n\n', b"data: [DONE]\n\n"]),
+                                         tenants=registry))
+    headers = {"authorization": "Bearer key-a"}
+    body = {"stream": True, "max_tokens": 400, "messages": [{"role": "user", "content": "hi"}]}
+    assert client.post("/openai/x", headers=headers, json=body).status_code == 200
+    tenant = registry.lookup(b"key-a")
+    assert 400 < tenant.estimated_tokens < 450
+    for _ in range(2):
+        assert client.post("/openai/x", headers=headers, json=body).status_code == 200
+    assert client.post("/openai/x", headers=headers, json=body).status_code == 429
+    assert 'lb_tenant_tokens_total{tenant="team-a",type="estimated"}' in render_metrics(registry.collectors())
+
+
+def test_usage_split_across_chunks_replaces_the_estimate_and_failures_are_refunded():
+    clock = FakeClock()
+    registry = TenantRegistry.from_config([{"name": "team-a", "key": "key-a", "tpm": 1000}], clock=clock)
+    tenant = registry.lookup(b"key-a")
+    headers = {"authorization": "Bearer key-a"}
+    body = {"stream": True, "max_tokens": 400, "messages": []}
+    chunks = [b'data: {"choices": [], "usage": null}\n\ndata: {"choices": [], "usage": {"prompt_tok',
+              b'ens": 5, "completion_tokens": 7, "prompt_tokens_details": {"cached_tokens": 0}}}\n\n',
+              b"data: [DONE]\n\n"]
+    assert TestClient(ApiKeyMiddleware(stream_app(chunks), tenants=registry)).post(
+        "/openai/x", headers=headers, json=body).status_code == 200
+    assert (tenant.prompt_tokens, tenant.completion_tokens, tenant.estimated_tokens) == (5, 7, 0)
+    assert tenant.tokens_allowance.balance == 1000 - 12
+
+    failing = TestClient(ApiKeyMiddleware(stream_app([b'{"error": {}}'], status=400), tenants=registry))
+    assert failing.post("/openai/x", headers=headers, json=body).status_code == 400
+    assert tenant.tokens_allowance.balance == 1000 - 12
+    assert tenant.estimated_tokens == 0
+
+
+def test_tenants_alone_enable_authentication():
+    registry = TenantRegistry.from_config([{"name": "team-a", "key": "key-a"}])
+    client = TestClient(ApiKeyMiddleware(lambda s, r, se: PlainTextResponse("ok")(s, r, se), tenants=registry))
+    assert client.get("/x").status_code == 401
+    assert client.get("/x", headers={"authorization": "Bearer key-a"}).text == "ok"
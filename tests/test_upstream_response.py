@@ -0,0 +1,78 @@
+import asyncio
+import httpx
+from fastapi.testclient import TestClient
+from src.main import app
+from src.services.cache import ResponseCache
+from src.services.upstream_response import UpstreamResponse, filter_headers
+
+client = TestClient(app)
+
+PATH = "/openai/deployments/gpt-4o/chat/completions?api-version=2025-01-01-preview"
+BODY = b'{"id":"chatcmpl-1","choices":[],"usage":{"prompt_tokens":3,"completion_tokens":2}}'
+
+
+def test_only_passthrough_headers_are_kept():
+    headers = filter_headers({
+        "Content-Type": "application/json", "x-ratelimit-remaining-tokens": "900", "apim-request-id": "abc",
+        "content-length": "10", "content-encoding": "gzip", "connection": "keep-alive", "set-cookie": "a=b",
+    })
+    assert headers == {"content-type": "application/json", "x-ratelimit-remaining-tokens": "900",
+                       "apim-request-id": "abc"}
+
+
+def test_legacy_conversion_keeps_the_old_result_shapes():
+    ok = UpstreamResponse(200, {"content-type": "application/json"}, b'{"id": "x"}', "instance1")
+    assert ok.to_legacy() == {"id": "x"}
+    assert ok.to_legacy() is not ok.to_legacy()
+    assert UpstreamResponse(200, {"content-type": "text/plain"}, b"hello").to_legacy() == {"text": "hello"}
+
+    error = UpstreamResponse(429, {"content-type": "application/json"}, b'{"error": {"code": "429"}}', "instance1")
+    assert error.to_legacy() == {"error": {"code": "429"}, "_azure_openai_instance": "instance1",
+                                 "_azure_openai_status_code": 429}
+    gateway = UpstreamResponse(502, {"content-type": "text/html"}, b"<html>bad gateway</html>", "instance2")
+    assert gateway.to_legacy()["error"] == {"message": "<html>bad gateway</html>", "code": 502,
+                                            "_azure_openai_instance": "instance2"}
+
+
+def test_disk_cache_keeps_bytes_status_and_headers(tmp_path):
+    path = tmp_path / "cache.db"
+    original = UpstreamResponse(200, {"content-type": "application/json", "x-request-id": "r1"}, BODY, "instance1")
+
+    async def scenario():
+        cache = ResponseCache(path=path)
+        await cache.set("k", original)
+        cache.close()
+        restarted = ResponseCache(path=path)
+        try:
+            return await restarted.get("k")
+        finally:
+            restarted.close()
+
+    cached = asyncio.run(scenario())
+    assert (cached.status_code, cached.headers, cached.content, cached.instance) == (
+        200, original.headers, BODY, "instance1")
+
+
+def test_endpoint_returns_upstream_bytes_status_and_headers(mock_service):
+    def handler(request):
+        status = 429 if b"limit" in request.content else 200
+        body = b'{"error":{"code":"429","message":"slow down"}}' if status == 429 else BODY
+        return httpx.Response(status, content=body, headers={
+            "content-type": "application/json", "x-ratelimit-remaining-tokens": "42",
+            "apim-request-id": "req-1", "retry-after": "30", "set-cookie": "affinity=1",
+        })
+
+    service = mock_service(handler, instances=[{"name": "instance1", "url": "https://one.openai.azure.com",
+                                                "api_key": "key-one"}])
+    response = client.post(PATH, content=b'{"messages": []}', headers={"content-type": "application/json"})
+    assert response.status_code == 200
+    assert response.content == BODY
+    assert response.headers["x-ratelimit-remaining-tokens"] == "42"
+    assert response.headers["apim-request-id"] == "req-1"
+    assert "set-cookie" not in response.headers
+    assert service.metrics.tokens.values[("instance1", "gpt-4o", "prompt")] == 3
+
+    response = client.post(PATH, content=b'{"user": "limit"}', headers={"content-type": "application/json"})
+    assert response.status_code == 429
+    assert response.content == b'{"error":{"code":"429","message":"slow down"}}'
+    assert response.headers["retry-after"] == "30"